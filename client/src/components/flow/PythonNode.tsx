@@ -95,11 +95,13 @@ interface ExecutionResult {
   exit_code: number | null;
   error: string | null;
   duration_seconds: number | null;
+  result?: unknown; // JSON written to $RUNNER_RESULT_PATH
 }
 
-async function runPythonCode(code: string): Promise<ExecutionResult> {
+async function runPythonCode(code: string, input?: unknown, signal?: AbortSignal): Promise<ExecutionResult> {
   try {
-    const response = await axios.post<ExecutionResult>(`${config.apiUrl}/python-runner`, { code });
+    // Aborting closes the request, which stops the run on the server
+    const response = await axios.post<ExecutionResult>(`${config.apiUrl}/python-runner`, { code, input }, { signal });
     return response.data;
   } catch (e: unknown) {
     console.error("Error calling Python API:", e);
@@ -139,70 +141,55 @@ export const PythonNodeType: INodeType<IPythonNodeConfig, IPythonNodeState, IPyt
   }),
   async run(context: INodeContext<IPythonNodeConfig, IPythonNodeState, IPythonNodeInput>): Promise<IPythonNodeOutput> {
     context.updateState({ ...context.state, fullOutput: '' });
-    const params = [];
+    const params: Record<string, unknown> = {};
 
     for (const param of context.config.params) {
       if (context.input[param.id] === undefined) {
         throw new Error(`Input ${param.name} is undefined.`);
       }
-      params.push(`${param.name} = ${JSON.stringify(context.input[param.id])}`);
+      params[param.name] = context.input[param.id];
     }
 
-    const mainCode = `def main(${params.join(',')}):\n${context.config.code.replace(/^/gm, '  ')}`;
+    const mainCode = `def main(${Object.keys(params).join(',')}):\n${context.config.code.replace(/^/gm, '  ')}`;
 
-    // warp the output with special tags
-    const START_TAG = '<===PYTHON_OUTPUT_START===>';
-    const END_TAG = '<===PYTHON_OUTPUT_END===>';
-    const fullCode = `import json
+    // params are sent as the run's input file and the return value comes back as
+    // the result file, so neither has to pass through the code or the output.
+    // The value is wrapped so that a main() returning None is told apart from a
+    // run that never wrote the file, which the server reports as a null result.
+    const fullCode = `import json, os
 ${mainCode}
+with open(os.environ["RUNNER_INPUT_PATH"], encoding="utf-8") as f:
+    params = json.load(f)
 try:
-    result = main()
-    print("${START_TAG}")
-    print(json.dumps(result, ensure_ascii=False))
-    print("${END_TAG}")
+    result = {"value": main(**params)}
 except Exception as e:
-    print("${START_TAG}")
-    print(json.dumps({"error": str(e)}, ensure_ascii=False))
-    print("${END_TAG}")`;
+    result = {"error": str(e)}
+with open(os.environ["RUNNER_RESULT_PATH"], "w", encoding="utf-8") as f:
+    json.dump(result, f, ensure_ascii=False)`;
 
     console.log("Executing Python code:\n", fullCode);
 
-    const result = await runPythonCode(fullCode);
+    const result = await runPythonCode(fullCode, params, context.signal);
 
     if (result.error || (result.exit_code !== null && result.exit_code !== 0)) {
       const errorMessage = `Python script execution failed (Exit Code: ${result.exit_code}):\n${result.error || result.output || 'No error message provided.'}`;
       throw new Error(errorMessage);
     }
 
-    if (result.output === null) {
-      throw new Error('No output from Python script.');
-    }
-
     // 将完整输出存储到 state 中
-    context.updateState({ ...context.state, fullOutput: result.output });
+    context.updateState({ ...context.state, fullOutput: result.output ?? '' });
 
-    // 解析输出，提取特殊标记之间的内容
-    const outputText = result.output;
-    const outputMatch = outputText.match(new RegExp(`${START_TAG}\\n([\\s\\S]*?)\\n${END_TAG}`));
-
-    if (!outputMatch) {
-      throw new Error('Could not find output result in Python script execution.');
+    if (result.result === null || result.result === undefined) {
+      throw new Error('No result from Python script.');
     }
 
-    const jsonOutput = outputMatch[1].trim();
-
-    try {
-      const parsedOutput = JSON.parse(jsonOutput);
-
-      // 检查是否有错误
-      if (parsedOutput.error) {
-        throw new Error(`Python script error: ${parsedOutput.error}`);
-      }
-
-      return { output: parsedOutput };
-    } catch (parseError) {
-      throw new Error(`Failed to parse Python output: ${parseError}\nOutput: ${jsonOutput}`);
+    // 检查是否有错误
+    const parsedOutput = result.result as { value?: unknown; error?: unknown };
+    if (parsedOutput.error !== undefined) {
+      throw new Error(`Python script error: ${parsedOutput.error}`);
     }
+
+    return { output: parsedOutput.value };
   },
   ui:
     function PythonNodeUI(props: INodeProps<IPythonNodeConfig, IPythonNodeState, IPythonNodeInput, IPythonNodeOutput>) {
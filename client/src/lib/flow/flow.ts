@@ -89,6 +89,7 @@ export interface INodeContext<C extends IBaseNodeConfig, S extends IBaseNodeStat
   updateState: (state: S) => void;
   input: I;
   flowStack: IRunFlowStack[];
+  signal?: AbortSignal; // 流程中止时触发
 }
 
 // 节点运行日志格式化
@@ -281,6 +282,7 @@ export async function runFlow(
         // 特殊处理开始节点
         input: node.id === startNodeId ? flowInput : node.runState.input,
         flowStack: flowStack,
+        signal: signal,
       });
 
       // 检查是否已经中止
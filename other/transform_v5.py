@@ -155,11 +155,13 @@ class FlowTransformerV5:
                 system_prompt = config.get('systemPrompt', '').replace('"', '\\"')
                 model = config.get('model', 'gpt-3.5-turbo')
                 prompt_var = input_mapping.get('prompt', 'input_data')
+                # 流式输出交给下游节点增量消费
+                stream_arg = ",\n            stream=True" if config.get('stream') else ""
                 
                 execution_code.append(f'''        result_{node_id} = await llm_call(
             model="{model}",
             system_prompt="""{system_prompt}""",
-            user_prompt={prompt_var}
+            user_prompt={prompt_var}{stream_arg}
         )''')
         
             elif node_type == 'python':
@@ -179,15 +181,16 @@ class FlowTransformerV5:
             elif node_type == 'image':
                 src_var = input_mapping.get('src', 'input_data')
                 execution_code.append(f'''        result_{node_id} = await save_image(
-            src={src_var},
+            src=await collect_text({src_var}),
             node_id="{node_id}"
         )
         print(f"[{name}] 图像已保存: {{result_{node_id}}}")''')
                 
             elif node_type == 'display':
                 input_var = list(input_mapping.values())[0] if input_mapping else 'input_data'
-                execution_code.append(f'''        result_{node_id} = {input_var}
-        print(f"[{name}] 显示: {{result_{node_id}}}")''')
+                # display_node边生成边显示流式输出
+                display_config = json.dumps({'name': name}, ensure_ascii=False)
+                execution_code.append(f"        result_{node_id} = await display_node({display_config}, {input_var})")
                 
             elif node_type == 'branch':
                 code = config.get('code', '').replace('"""', '\\"\\"\\"')
@@ -211,7 +214,7 @@ class FlowTransformerV5:
                 
             elif node_type == 'end':
                 input_var = list(input_mapping.values())[0] if input_mapping else 'input_data'
-                execution_code.append(f"        result_{node_id} = {input_var}")
+                execution_code.append(f"        result_{node_id} = await collect_text({input_var})")
                 
             else:
                 # 通用节点处理
@@ -289,7 +292,8 @@ sys.path.insert(0, str(Path(__file__).parent))
 # 导入SDK函数
 from flow_sdk import (
     llm_call, execute_python_code, execute_javascript_code, 
-    save_image, log_node_execution, validate_node_config
+    save_image, log_node_execution, validate_node_config, close_sdk,
+    collect_text, display_node
 )
 
 {functions_str}
@@ -304,6 +308,8 @@ if __name__ == "__main__":
             import traceback
             traceback.print_exc()
             sys.exit(1)
+        finally:
+            await close_sdk()
             
     asyncio.run(main())
 '''
@@ -381,7 +387,8 @@ if __name__ == "__main__":
         for param in params:
             param_name = param['name']
             if param_name in input_mapping:
-                param_assignments.append(f"        {param_name} = {input_mapping[param_name]}")
+                # 内联代码不能增量消费流式输出，先汇总为完整文本
+                param_assignments.append(f"        {param_name} = await collect_text({input_mapping[param_name]})")
             else:
                 param_assignments.append(f"        {param_name} = None")
         
@@ -517,10 +524,14 @@ python flow_executor.py
 ```python
 import asyncio
 from flow_executor import execute_flow
+from flow_sdk import close_sdk
 
 async def main():
-    result = await execute_flow("你的输入数据")
-    print(f"执行结果: {{result}}")
+    try:
+        result = await execute_flow("你的输入数据")
+        print(f"执行结果: {{result}}")
+    finally:
+        await close_sdk()  # 关闭共享的HTTP会话和执行进程池
 
 asyncio.run(main())
 ```
@@ -10,145 +10,929 @@ import base64
 import asyncio
 import aiohttp
 import aiofiles
-import tempfile
 import hashlib
 import logging
-from typing import Any, Dict, Optional, Union, List
+import functools
+import multiprocessing
+import pickle
+import signal
+import threading
+import time
+import random
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Optional, Union, List, Tuple
 from pathlib import Path
 from urllib.parse import urlparse
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 
 # =============================================================================
-# 核心工具函数
+# Python代码执行后端
 # =============================================================================
 
-async def llm_call(model: str, system_prompt: str, user_prompt: str) -> str:
-    """调用LLM API"""
+# inline: 在事件循环线程中直接执行（默认）
+# thread: 在线程池中执行，同步main不再阻塞事件循环
+# process: 在常驻进程池中执行，CPU密集的节点可以真正并行
+PYTHON_BACKEND = os.getenv('FLOW_PYTHON_BACKEND', 'inline')
+PYTHON_BACKENDS = ('inline', 'thread', 'process')
+PYTHON_WORKERS = int(os.getenv('FLOW_PYTHON_WORKERS', '0')) or os.cpu_count() or 4
+# 单次执行超时（秒，0为不限制），inline后端不生效
+PYTHON_TIMEOUT = float(os.getenv('FLOW_PYTHON_TIMEOUT', '60'))
+# process后端每个进程的内存上限（MB，0为不限制）
+PYTHON_MEMORY_MB = int(os.getenv('FLOW_PYTHON_MEMORY_MB', '0'))
+# 子进程卡在C代码中时SIGALRM无法打断，超过宽限时间后结束这个子进程
+PYTHON_PROCESS_GRACE_SECONDS = 5
+# 编译结果缓存的条目数和源码总字节数上限
+CODE_CACHE_MAX_ENTRIES = int(os.getenv('FLOW_CODE_CACHE_MAX_ENTRIES', '256'))
+CODE_CACHE_MAX_BYTES = int(os.getenv('FLOW_CODE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+
+_python_executors: Dict[str, Executor] = {}
+
+
+class PythonMainNotFoundError(Exception):
+    """代码中未找到main函数"""
+
+
+class PythonTimeoutError(BaseException):
+    """Python代码执行超时，不是Exception的子类，用户代码的except Exception拦不住它"""
+
+
+class PythonProcessExitedError(Exception):
+    """Python执行进程异常退出"""
+
+
+class CompiledCodeCache:
+    """
+    按源码SHA-256缓存编译并执行后得到的main函数（LRU）
+    代码顶层语句只在首次调用时执行；同一段代码的多次调用共用一个main函数及其全局变量，
+    用global保存的状态会保留到下次调用
+    进程后端的每个工作进程各有一份缓存
+    """
+
+    def __init__(self, max_entries: int = CODE_CACHE_MAX_ENTRIES,
+                 max_bytes: int = CODE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # 源码哈希 -> (main函数, 源码字节数)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_main(self, code: str):
+        """返回代码中的main函数，未缓存时编译执行代码"""
+        key = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        main_func = _load_python_main(code)
+        size = len(code.encode('utf-8'))
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return main_func
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (main_func, size)
+                self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+        return main_func
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存命中统计"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+def _load_python_main(code: str):
+    """编译执行代码并返回其中的main函数"""
+    exec_globals = {
+        "json": json,
+        "os": os,
+        "base64": base64,
+        "hashlib": hashlib,
+        "asyncio": asyncio,
+    }
+    exec_locals = {}
+
+    exec(compile(code, '<string>', 'exec'), exec_globals, exec_locals)
+
+    if 'main' not in exec_locals:
+        raise PythonMainNotFoundError()
+    return exec_locals['main']
+
+
+code_cache = CompiledCodeCache()
+
+
+def _raise_python_timeout(signum, frame):
+    raise PythonTimeoutError()
+
+
+def _init_python_process(memory_mb: int):
+    """常驻子进程初始化: 设置内存上限"""
+    if memory_mb and resource is not None:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _run_python_in_process(code: str, params: Dict[str, Any], timeout: Optional[float]) -> Any:
+    """在子进程中调用main函数，异步main在独立的事件循环中运行，结果通过pickle返回"""
+    use_alarm = bool(timeout) and hasattr(signal, 'setitimer')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_python_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
     try:
-        api_key = os.getenv('OPENAI_API_KEY')
-        api_base = os.getenv('OPENAI_API_BASE_URL', 'https://api.openai.com/v1')
-        
-        if not api_key:
-            return "错误: 未设置OPENAI_API_KEY环境变量"
-            
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json'
-            }
-            
-            payload = {
-                'model': model,
-                'messages': [
-                    {'role': 'system', 'content': system_prompt},
-                    {'role': 'user', 'content': user_prompt}
-                ]
-            }
-            
-            async with session.post(f'{api_base}/chat/completions', 
-                                   headers=headers, 
-                                   json=payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result['choices'][0]['message']['content']
-                else:
+        result = code_cache.get_main(code)(**params)
+        if asyncio.iscoroutine(result):
+            result = asyncio.run(result)
+        return result
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _python_process_main(connection, memory_mb: int):
+    """常驻子进程: 依次接收 (code, params, timeout)，回复 (True, 结果) 或 (False, 异常)"""
+    _init_python_process(memory_mb)
+    while True:
+        try:
+            code, params, timeout = connection.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            reply = (True, _run_python_in_process(code, params, timeout))
+        except (Exception, PythonTimeoutError) as e:
+            reply = (False, e)
+        except BaseException as e:  # SystemExit等不能让父进程的调用方退出
+            reply = (False, RuntimeError(f"{type(e).__name__}: {e}"))
+        try:
+            try:
+                connection.send(reply)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                connection.send((False, RuntimeError(f"结果无法序列化: {e}")))
+        except OSError:
+            return
+
+
+class PythonWorker:
+    """一个常驻的Python子进程，一次执行一个任务"""
+
+    def __init__(self):
+        self.process: Optional[multiprocessing.Process] = None
+        self.connection = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive() and not self.connection.closed
+
+    def start(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_python_process_main, args=(child_connection, PYTHON_MEMORY_MB), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+
+    def call(self, code: str, params: Dict[str, Any], timeout: Optional[float]) -> Tuple[bool, Any]:
+        """在线程中调用，阻塞到子进程回复"""
+        self.connection.send((code, params, timeout))
+        try:
+            return self.connection.recv()
+        except (EOFError, OSError):
+            raise PythonProcessExitedError()
+
+    def kill(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+    def close(self):
+        """子进程读到EOF后自行退出，正在执行的任务不受影响"""
+        if self.connection is not None:
+            self.connection.close()
+
+
+class PythonProcessPool:
+    """
+    常驻Python子进程池，每个进程同时只执行一个任务
+    任务超时后只结束执行它的进程，其他进程中的任务不受影响；下次使用时重新启动
+    """
+
+    def __init__(self, size: int = PYTHON_WORKERS):
+        self._slots = asyncio.Semaphore(size)
+        # 与子进程的管道读写是阻塞的，在这些线程中进行
+        self._calls = ThreadPoolExecutor(size, thread_name_prefix='flow-python-process')
+        self._idle: List[PythonWorker] = []
+        self._workers: List[PythonWorker] = []
+        self.restarts = 0
+
+    async def run(self, code: str, params: Dict[str, Any], timeout: Optional[float]) -> Any:
+        async with self._slots:
+            worker = self._idle.pop() if self._idle else PythonWorker()
+            if not worker.alive:
+                if worker.process is not None:
+                    self.restarts += 1
+                worker.start()
+                if worker not in self._workers:
+                    self._workers.append(worker)
+            try:
+                ok, value = await asyncio.wait_for(
+                    asyncio.get_running_loop().run_in_executor(
+                        self._calls, worker.call, code, params, timeout
+                    ),
+                    timeout and timeout + PYTHON_PROCESS_GRACE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                worker.kill()
+                raise PythonTimeoutError()
+            except BaseException:
+                # 任务可能还在执行或进程已经退出，不能再用
+                worker.kill()
+                raise
+            finally:
+                self._idle.append(worker)
+            if ok:
+                return value
+            raise value
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers.clear()
+        self._idle.clear()
+        self._calls.shutdown(wait=False, cancel_futures=True)
+
+
+_python_process_pool: Optional[PythonProcessPool] = None
+_python_process_pool_loop = None
+
+
+def get_python_process_pool() -> PythonProcessPool:
+    """process后端共享的子进程池，首次使用时创建"""
+    global _python_process_pool, _python_process_pool_loop
+    loop = asyncio.get_running_loop()
+    if _python_process_pool is None or _python_process_pool_loop is not loop:
+        if _python_process_pool is not None:
+            _python_process_pool.close()
+        _python_process_pool = PythonProcessPool()
+        _python_process_pool_loop = loop
+    return _python_process_pool
+
+
+def _get_python_executor(backend: str) -> Executor:
+    """按需创建线程池，之后一直复用"""
+    executor = _python_executors.get(backend)
+    if executor is None:
+        executor = ThreadPoolExecutor(PYTHON_WORKERS, thread_name_prefix='flow-python')
+        _python_executors[backend] = executor
+    return executor
+
+
+def shutdown_python_backends():
+    """关闭Python执行后端的线程池和进程池"""
+    global _python_process_pool
+    while _python_executors:
+        _, executor = _python_executors.popitem()
+        executor.shutdown(wait=False, cancel_futures=True)
+    if _python_process_pool is not None:
+        _python_process_pool.close()
+        _python_process_pool = None
+
+
+# =============================================================================
+# JavaScript执行进程池
+# =============================================================================
+
+NODE_BINARY = os.getenv('FLOW_NODE_BINARY', 'node')
+JS_WORKERS = int(os.getenv('FLOW_JS_WORKERS', '4'))
+JS_TIMEOUT = float(os.getenv('FLOW_JS_TIMEOUT', '30'))  # 秒，0为不限制
+# 每个Node.js进程执行这么多次任务后重启，避免用户代码留下的状态和内存越积越多
+JS_WORKER_MAX_JOBS = int(os.getenv('FLOW_JS_WORKER_MAX_JOBS', '500'))
+JS_MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+# 常驻Node.js进程: 每行从stdin读取一个JSON任务 {"id", "code", "key", "params"}，
+# 向命令行参数给出的管道fd写回一行 {"id", "result"} 或 {"id", "error"}；批量任务用 "inputs"
+# 代替 "params"，写回 {"id", "results": [{"result"} 或 {"error"}, ...]}
+# 参数作为常量传入，代码在async函数中执行；代码定义了main函数且没有返回时，
+# 按参数顺序调用main。同一key和参数名的代码只编译一次（每个进程最多缓存256个）
+# 用户代码的console输出写到stderr，直接写stdout的内容原样输出，都不会混入结果
+JS_WORKER_SOURCE = r"""
+const fs = require('fs');
+const readline = require('readline');
+const responseFd = Number(process.argv[1]);
+const AsyncFunction = (async () => {}).constructor;
+const userConsole = new console.Console(process.stderr, process.stderr);
+process.on('unhandledRejection', (error) => userConsole.error(error));
+process.on('uncaughtException', (error) => userConsole.error(error));
+const compiled = new Map();
+
+function compile(job, names) {
+    const key = job.key && `${job.key}:${names.join(',')}`;
+    let fn = key && compiled.get(key);
+    if (fn) {
+        compiled.delete(key);  // 移到最近使用的位置
+        compiled.set(key, fn);
+        return fn;
+    }
+    const body = `const {${names.join(', ')}} = __params;
+return await (async function () {
+${job.code}
+;if (typeof main === 'function') { return await main(...Object.values(__params)); }
+}).apply(null, Object.values(__params));`;
+    fn = new AsyncFunction('require', 'console', '__params', body);
+    if (key) {
+        compiled.set(key, fn);
+        if (compiled.size > 256) {
+            compiled.delete(compiled.keys().next().value);
+        }
+    }
+    return fn;
+}
+
+async function run(job, params) {
+    params = params || {};
+    const result = await compile(job, Object.keys(params))(require, userConsole, params);
+    return JSON.stringify({ result: result === undefined ? null : result });
+}
+
+function failure(error) {
+    return JSON.stringify({ error: String(error && error.message || error) });
+}
+
+readline.createInterface({ input: process.stdin }).on('line', async (line) => {
+    let job;
+    try {
+        job = JSON.parse(line);
+    } catch (error) {
+        return;
+    }
+    const parts = [];
+    for (const params of job.inputs || [job.params]) {
+        try {
+            parts.push(await run(job, params));
+        } catch (error) {
+            parts.push(failure(error));
+        }
+    }
+    const id = JSON.stringify(job.id);
+    const response = job.inputs
+        ? `{"id": ${id}, "results": [${parts.join(', ')}]}`
+        : `{"id": ${id}, ${parts[0].slice(1)}`;
+    fs.writeSync(responseFd, response + '\n');
+});
+"""
+
+
+class NodeWorker:
+    """一个常驻的Node.js进程，一次执行一个任务"""
+
+    def __init__(self):
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.responses: Optional[asyncio.StreamReader] = None
+        self._responses_transport = None
+        self.jobs = 0
+        self.killed = False
+
+    @property
+    def alive(self) -> bool:
+        # 被结束的进程在退出码可见之前也不能再用
+        return self.process is not None and self.process.returncode is None and not self.killed
+
+    async def start(self):
+        # 响应走单独的管道，用户代码写stdout时不会打断协议
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                NODE_BINARY, '-e', JS_WORKER_SOURCE, str(write_fd),
+                stdin=asyncio.subprocess.PIPE,
+                pass_fds=(write_fd,)
+            )
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        self._close_responses()
+        self.responses = asyncio.StreamReader(limit=JS_MAX_MESSAGE_BYTES)
+        self._responses_transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.responses), os.fdopen(read_fd, 'rb', 0)
+        )
+        self.jobs = 0
+        self.killed = False
+
+    def _close_responses(self):
+        if self._responses_transport is not None:
+            self._responses_transport.close()
+            self._responses_transport = None
+
+    async def run(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """发送任务并等待对应的响应"""
+        self.jobs += 1
+        job_id = self.jobs
+        message = json.dumps({**job, 'id': job_id}, ensure_ascii=False)
+        self.process.stdin.write(message.encode('utf-8') + b'\n')
+        await self.process.stdin.drain()
+        line = await self.responses.readline()
+        if not line:
+            raise ConnectionError("Node.js进程意外退出")
+        response = json.loads(line)
+        if response.get('id') != job_id:
+            raise ConnectionError("Node.js进程返回了错误的响应")
+        return response
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+        self._close_responses()
+        self.killed = True
+
+    async def close(self):
+        if self.alive:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 1)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self._close_responses()
+
+
+class NodeWorkerPool:
+    """
+    常驻Node.js进程池，代替每次执行都启动新进程并写临时文件
+    任务超时或进程崩溃时结束该进程，下次使用时重新启动
+    """
+
+    def __init__(self, size: int = JS_WORKERS, max_jobs: int = JS_WORKER_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._slots = asyncio.Semaphore(size)
+        self._idle: List[NodeWorker] = []
+        self._workers: List[NodeWorker] = []
+        self.restarts = 0
+
+    async def run(self, job: Dict[str, Any], timeout: Optional[float] = JS_TIMEOUT) -> Dict[str, Any]:
+        async with self._slots:
+            worker = self._idle.pop() if self._idle else NodeWorker()
+            if not worker.alive:
+                if worker.process is not None:
+                    self.restarts += 1
+                await worker.start()
+                if worker not in self._workers:
+                    self._workers.append(worker)
+            try:
+                response = await asyncio.wait_for(worker.run(job), timeout)
+            except BaseException:
+                # 进程可能卡在死循环里或已经退出，不能再用
+                worker.kill()
+                self._idle.append(worker)
+                raise
+            if worker.jobs >= self.max_jobs:
+                await worker.close()
+            self._idle.append(worker)
+            return response
+
+    async def close(self):
+        await asyncio.gather(*(worker.close() for worker in self._workers))
+        self._workers.clear()
+        self._idle.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": sum(worker.alive for worker in self._workers),
+            "jobs": sum(worker.jobs for worker in self._workers),
+            "restarts": self.restarts,
+        }
+
+
+_js_pool: Optional[NodeWorkerPool] = None
+_js_pool_loop = None
+
+
+def get_js_pool() -> NodeWorkerPool:
+    """共享的Node.js进程池，首次使用时创建"""
+    global _js_pool, _js_pool_loop
+    loop = asyncio.get_running_loop()
+    if _js_pool is None or _js_pool_loop is not loop:
+        _js_pool = NodeWorkerPool()
+        _js_pool_loop = loop
+    return _js_pool
+
+
+# =============================================================================
+# 共享HTTP会话与LLM限流
+# =============================================================================
+
+HTTP_MAX_CONNECTIONS = int(os.getenv('FLOW_HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv('FLOW_HTTP_MAX_CONNECTIONS_PER_HOST', '32'))
+LLM_TIMEOUT_SECONDS = float(os.getenv('FLOW_LLM_TIMEOUT', '120'))
+# 每个模型的并发请求数、每分钟请求数和每分钟token数上限（0为不限制）
+LLM_MAX_CONCURRENCY = int(os.getenv('FLOW_LLM_MAX_CONCURRENCY', '8'))
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('FLOW_LLM_RPM', '0'))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('FLOW_LLM_TPM', '0'))
+# 429、5xx和连接错误的重试次数，等待时间按指数退避并加随机抖动
+LLM_MAX_RETRIES = int(os.getenv('FLOW_LLM_MAX_RETRIES', '3'))
+LLM_RETRY_BASE_SECONDS = float(os.getenv('FLOW_LLM_RETRY_BASE_SECONDS', '1'))
+LLM_RETRY_MAX_SECONDS = float(os.getenv('FLOW_LLM_RETRY_MAX_SECONDS', '30'))
+LLM_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_http_session: Optional[aiohttp.ClientSession] = None
+_http_session_loop = None
+_llm_limiters: Dict[str, 'LLMRateLimiter'] = {}
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """共享的HTTP会话，首次使用时创建，之后的请求复用DNS缓存和连接"""
+    global _http_session, _http_session_loop
+    loop = asyncio.get_running_loop()
+    if _http_session is None or _http_session.closed or _http_session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_MAX_CONNECTIONS,
+            limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+            ttl_dns_cache=300
+        )
+        _http_session = aiohttp.ClientSession(connector=connector)
+        _http_session_loop = loop
+    return _http_session
+
+
+class TokenBucket:
+    """每分钟补充per_minute个令牌的令牌桶，per_minute为0时不限制"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        if not self.capacity:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) * 60 / self.capacity)
+
+    def adjust(self, amount: float):
+        """按实际用量修正预扣的令牌，可以扣成负数"""
+        if self.capacity:
+            self._refill()
+            self.tokens -= amount
+
+
+class LLMRateLimiter:
+    """单个模型的并发、每分钟请求数和每分钟token数限制"""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = LLM_TOKENS_PER_MINUTE):
+        self.slots = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def __aenter__(self):
+        if self.slots:
+            await self.slots.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.slots:
+            self.slots.release()
+
+    async def acquire(self, estimated_tokens: int):
+        """发送请求前调用，等待请求数和token数的配额"""
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+
+def set_llm_limits(model: str, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                   requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+                   tokens_per_minute: int = LLM_TOKENS_PER_MINUTE):
+    """为单个模型设置与默认值不同的限制"""
+    _llm_limiters[model] = LLMRateLimiter(max_concurrency, requests_per_minute, tokens_per_minute)
+
+
+def _get_llm_limiter(model: str) -> LLMRateLimiter:
+    if model not in _llm_limiters:
+        _llm_limiters[model] = LLMRateLimiter()
+    return _llm_limiters[model]
+
+
+def _estimate_tokens(*texts: str) -> int:
+    """粗略估计token数，收到响应后再按usage修正"""
+    return max(1, sum(len(text) for text in texts) // 3)
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """第attempt次重试前的等待秒数，优先使用Retry-After"""
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_RETRY_MAX_SECONDS)
+        except ValueError:
+            pass
+    delay = min(LLM_RETRY_BASE_SECONDS * 2 ** attempt, LLM_RETRY_MAX_SECONDS)
+    return random.uniform(delay / 2, delay)
+
+
+async def close_sdk():
+    """关闭共享的HTTP会话、Node.js进程池和Python执行后端，流程执行结束时调用"""
+    global _http_session, _js_pool
+    loop = asyncio.get_running_loop()
+    if _http_session is not None:
+        if not _http_session.closed and _http_session_loop is loop:
+            await _http_session.close()
+        _http_session = None
+    if _js_pool is not None:
+        if _js_pool_loop is loop:
+            await _js_pool.close()
+        _js_pool = None
+    shutdown_python_backends()
+
+
+# =============================================================================
+# 核心工具函数
+# =============================================================================
+
+# 单个图像的大小上限，以及远程图像下载的超时
+IMAGE_MAX_BYTES = int(os.getenv('FLOW_IMAGE_MAX_BYTES', str(50 * 1024 * 1024)))
+IMAGE_TIMEOUT = float(os.getenv('FLOW_IMAGE_TIMEOUT', '60'))  # 连接和两段数据之间的秒数
+IMAGE_CHUNK_BYTES = 64 * 1024
+IMAGE_URL_INDEX = '.url_index.json'
+
+_image_url_indexes: Dict[str, Dict[str, str]] = {}
+
+
+class LLMCallError(Exception):
+    """LLM调用失败，消息即返回给节点的错误文本"""
+
+
+async def _llm_deltas(model: str, system_prompt: str, user_prompt: str,
+                      stream: bool = False) -> AsyncIterator[str]:
+    """
+    请求LLM并逐段产出回复文本，非流式时只产出一段；失败时抛出LLMCallError
+    429、5xx和连接错误在收到任何内容之前会重试
+    """
+    api_key = os.getenv('OPENAI_API_KEY')
+    api_base = os.getenv('OPENAI_API_BASE_URL', 'https://api.openai.com/v1')
+
+    if not api_key:
+        raise LLMCallError("错误: 未设置OPENAI_API_KEY环境变量")
+
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json'
+    }
+
+    payload = {
+        'model': model,
+        'messages': [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_prompt}
+        ]
+    }
+    if stream:
+        payload['stream'] = True
+
+    session = get_http_session()
+    limiter = _get_llm_limiter(model)
+    estimated_tokens = _estimate_tokens(system_prompt, user_prompt)
+    # 流式响应只限制两段数据之间的间隔
+    timeout = aiohttp.ClientTimeout(
+        total=None if stream else LLM_TIMEOUT_SECONDS, sock_read=LLM_TIMEOUT_SECONDS
+    )
+    attempt = 0
+    received = False
+    while True:
+        retry_after = None
+        try:
+            async with limiter:
+                await limiter.acquire(estimated_tokens)
+                async with session.post(f'{api_base}/chat/completions',
+                                        headers=headers,
+                                        json=payload,
+                                        timeout=timeout) as response:
+                    if response.status == 200 and not stream:
+                        result = await response.json()
+                        usage = result.get('usage') or {}
+                        limiter.tokens.adjust(usage.get('total_tokens', estimated_tokens) - estimated_tokens)
+                        yield result['choices'][0]['message']['content']
+                        return
+                    if response.status == 200:
+                        output_chars = 0
+                        async for line in response.content:
+                            line = line.strip()
+                            if not line.startswith(b'data:'):
+                                continue
+                            data = line[5:].strip()
+                            if data == b'[DONE]':
+                                break
+                            for choice in json.loads(data).get('choices') or []:
+                                delta = (choice.get('delta') or {}).get('content')
+                                if delta:
+                                    received = True
+                                    output_chars += len(delta)
+                                    yield delta
+                        limiter.tokens.adjust(output_chars // 3)
+                        return
                     error_text = await response.text()
-                    return f"LLM调用错误 ({response.status}): {error_text}"
-                    
+                    retry_after = response.headers.get('Retry-After')
+            error = f"LLM调用错误 ({response.status}): {error_text}"
+            retryable = response.status in LLM_RETRY_STATUSES
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            error = f"LLM调用错误: {str(e) or type(e).__name__}"
+            retryable = not received
+
+        if not retryable or attempt >= LLM_MAX_RETRIES:
+            raise LLMCallError(error)
+        await asyncio.sleep(_retry_delay(attempt, retry_after))
+        attempt += 1
+
+
+class LLMStream:
+    """
+    流式LLM输出，请求在创建时就已发出
+    async for逐段得到增量文本，await collect_text(stream)得到完整文本；多个下游节点
+    可以各自迭代，每个都从头收到全部内容。调用失败时错误文本作为最后一段输出
+    """
+
+    def __init__(self, deltas: AsyncIterator[str]):
+        self.deltas: List[str] = []
+        self.done = False
+        self.error: Optional[str] = None
+        self._changed = asyncio.Event()
+        self._task = asyncio.ensure_future(self._read(deltas))
+
+    async def _read(self, deltas: AsyncIterator[str]):
+        try:
+            async for delta in deltas:
+                self._append(delta)
+        except LLMCallError as e:
+            self.error = str(e)
+            self._append(self.error)
+        except Exception as e:
+            self.error = f"LLM调用错误: {str(e)}"
+            self._append(self.error)
+        finally:
+            self.done = True
+            self._changed.set()
+
+    def _append(self, delta: str):
+        self.deltas.append(delta)
+        # 唤醒所有等待中的读者，之后的读者等待新的事件
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def __aiter__(self):
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.deltas):
+                yield self.deltas[index]
+                index += 1
+            if self.done:
+                return
+            if changed is self._changed:
+                await changed.wait()
+
+    async def text(self) -> str:
+        """等待输出结束并返回完整文本"""
+        async for _ in self:
+            pass
+        return ''.join(self.deltas)
+
+
+async def collect_text(value: Any) -> Any:
+    """汇总流式输出: LLMStream返回完整文本，其他值原样返回"""
+    if isinstance(value, LLMStream):
+        return await value.text()
+    return value
+
+
+async def _collect_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """把参数中的LLMStream汇总为完整文本，用于不能增量消费的代码"""
+    if not any(isinstance(value, LLMStream) for value in params.values()):
+        return params
+    return {key: await collect_text(value) for key, value in params.items()}
+
+
+async def llm_call(model: str, system_prompt: str, user_prompt: str,
+                   stream: bool = False) -> Union[str, LLMStream]:
+    """
+    调用LLM API
+    stream为True时立即返回LLMStream，下游节点可以边生成边处理
+    """
+    try:
+        user_prompt = await collect_text(user_prompt)
+        if stream:
+            return LLMStream(_llm_deltas(model, system_prompt, user_prompt, stream=True))
+        return ''.join([delta async for delta in _llm_deltas(model, system_prompt, user_prompt)])
+    except LLMCallError as e:
+        return str(e)
     except Exception as e:
         return f"LLM调用错误: {str(e)}"
 
 
-async def execute_python_code(code: str, params: Dict[str, Any]) -> Any:
-    """执行Python代码"""
+async def execute_python_code(code: str, params: Dict[str, Any],
+                              backend: Optional[str] = None,
+                              timeout: Optional[float] = None) -> Any:
+    """
+    执行Python代码
+    backend为inline、thread或process，默认取FLOW_PYTHON_BACKEND；timeout默认取
+    FLOW_PYTHON_TIMEOUT。process后端的参数和返回值需要能被pickle
+    异步main收到的LLMStream参数可以增量消费，其他情况下先汇总为完整文本
+    """
+    backend = backend or PYTHON_BACKEND
+    timeout = (PYTHON_TIMEOUT if timeout is None else timeout) or None
     try:
-        exec_globals = {
-            "json": json,
-            "os": os,
-            "base64": base64,
-            "hashlib": hashlib,
-            "asyncio": asyncio,
-        }
-        exec_locals = {}
-        
-        exec(code, exec_globals, exec_locals)
-        
-        if 'main' in exec_locals:
-            main_func = exec_locals['main']
-            if asyncio.iscoroutinefunction(main_func):
+        if backend not in PYTHON_BACKENDS:
+            return f"错误: 不支持的Python执行后端 {backend}"
+
+        loop = asyncio.get_running_loop()
+        if backend == 'process':
+            params = await _collect_params(params)
+            return await get_python_process_pool().run(code, params, timeout)
+
+        main_func = code_cache.get_main(code)
+        if asyncio.iscoroutinefunction(main_func):
+            if backend == 'inline':
                 return await main_func(**params)
-            else:
-                return main_func(**params)
-        else:
-            return "错误: 代码中未找到main函数"
-            
+            return await asyncio.wait_for(main_func(**params), timeout)
+        params = await _collect_params(params)
+        if backend == 'inline':
+            return main_func(**params)
+        # 线程无法被中断，超时后只是不再等待结果
+        return await asyncio.wait_for(
+            loop.run_in_executor(_get_python_executor('thread'), functools.partial(main_func, **params)),
+            timeout
+        )
+
+    except PythonMainNotFoundError:
+        return "错误: 代码中未找到main函数"
+    except PythonProcessExitedError:
+        return "错误: Python执行进程异常退出"
+    except (PythonTimeoutError, asyncio.TimeoutError):
+        return "错误: Python代码执行超时"
+    except MemoryError:
+        return "错误: Python代码超出内存限制"
     except Exception as e:
         return f"Python代码执行错误: {str(e)}"
 
 
-async def execute_javascript_code(code: str, params: Dict[str, Any]) -> Any:
-    """执行JavaScript代码"""
+def _js_code_key(code: str) -> str:
+    """Node.js进程按这个key缓存编译后的代码"""
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def _js_result(response: Dict[str, Any]) -> Any:
+    if 'error' in response:
+        return f"JavaScript执行错误: {response['error']}"
+    return response.get('result')
+
+
+async def execute_javascript_code(code: str, params: Dict[str, Any],
+                                  timeout: Optional[float] = None) -> Any:
+    """执行JavaScript代码，在常驻Node.js进程池中运行，timeout默认取FLOW_JS_TIMEOUT"""
     try:
-        params_json = json.dumps(params, ensure_ascii=False)
-        
-        # 将JavaScript参数作为全局变量注入
-        param_assignments = []
-        for key, value in params.items():
-            param_assignments.append(f"const {key} = {json.dumps(value, ensure_ascii=False)};")
-        
-        full_code = f"""
-{chr(10).join(param_assignments)}
+        params = await _collect_params(params)
+        timeout = (JS_TIMEOUT if timeout is None else timeout) or None
+        job = {'code': code, 'key': _js_code_key(code), 'params': params}
+        return _js_result(await get_js_pool().run(job, timeout))
 
-// 用户代码
-const userCode = async () => {{
-{code}
-}};
-
-async function run() {{
-    try {{
-        let result;
-        if (typeof main === 'function') {{
-            const paramValues = Object.values({params_json});
-            result = await main(...paramValues);
-        }} else {{
-            // 执行用户代码
-            result = await userCode();
-        }}
-        console.log(JSON.stringify(result, null, 0));
-    }} catch (error) {{
-        console.error(JSON.stringify({{error: error.message}}, null, 0));
-    }}
-}}
-
-run();
-"""
-        
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False, encoding='utf-8') as f:
-            f.write(full_code)
-            temp_file = f.name
-            
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'node', temp_file,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await asyncio.wait_for(result.communicate(), timeout=30)
-            
-            if result.returncode == 0:
-                output = stdout.decode('utf-8').strip()
-                try:
-                    return json.loads(output)
-                except json.JSONDecodeError:
-                    return output
-            else:
-                error_msg = stderr.decode('utf-8')
-                return f"JavaScript执行错误: {error_msg}"
-                
-        finally:
-            os.unlink(temp_file)
-            
     except asyncio.TimeoutError:
         return "错误: JavaScript代码执行超时"
     except FileNotFoundError:
@@ -157,60 +941,137 @@ run();
         return f"JavaScript代码执行错误: {str(e)}"
 
 
+async def _run_javascript_batch(code: str, params_list: List[Dict[str, Any]],
+                                timeout: Optional[float] = None) -> List[Tuple[Any, Optional[str]]]:
+    """execute_javascript_batch的实现，返回(结果, 错误信息)对，出错的参数组结果为None"""
+    try:
+        params_list = [await _collect_params(params) for params in params_list]
+        if not params_list:
+            return []
+        timeout = (JS_TIMEOUT if timeout is None else timeout) or None
+        job = {'code': code, 'key': _js_code_key(code), 'inputs': params_list}
+        response = await get_js_pool().run(job, timeout)
+        return [(None, _js_result(item)) if 'error' in item else (item.get('result'), None)
+                for item in response['results']]
+
+    except asyncio.TimeoutError:
+        error = "错误: JavaScript代码执行超时"
+    except FileNotFoundError:
+        error = "错误: 未找到Node.js，请确保已安装"
+    except Exception as e:
+        error = f"JavaScript代码执行错误: {str(e)}"
+    return [(None, error)] * len(params_list)
+
+
+async def execute_javascript_batch(code: str, params_list: List[Dict[str, Any]],
+                                   timeout: Optional[float] = None) -> List[Any]:
+    """
+    用同一段JavaScript代码依次处理多组参数，只编译一次、只经过一次进程往返
+    返回与params_list一一对应的结果，出错的参数组得到错误信息；timeout是整批的时间上限
+    """
+    return [result if error is None else error
+            for result, error in await _run_javascript_batch(code, params_list, timeout)]
+
+
+def _image_ext(content_type: str, url: str = '') -> str:
+    """按MIME类型或URL后缀确定图像扩展名"""
+    if 'png' in content_type:
+        return 'png'
+    elif 'jpeg' in content_type or 'jpg' in content_type:
+        return 'jpg'
+    elif 'gif' in content_type:
+        return 'gif'
+    path_ext = Path(urlparse(url).path).suffix.lower()
+    return path_ext[1:] if path_ext in ['.png', '.jpg', '.jpeg', '.gif'] else 'png'
+
+
+def _image_part_path(images_dir: Path) -> Path:
+    """写入过程中的临时文件，完成后再改名，其他读者不会看到写了一半的图像"""
+    return images_dir / f".{os.urandom(8).hex()}.part"
+
+
+def _get_url_index(images_dir: Path) -> Dict[str, str]:
+    """已下载URL到文件名的索引，保存在图像目录中，跨多次运行有效"""
+    key = str(images_dir.resolve())
+    if key not in _image_url_indexes:
+        try:
+            with open(images_dir / IMAGE_URL_INDEX, encoding='utf-8') as f:
+                _image_url_indexes[key] = json.load(f)
+        except (OSError, ValueError):
+            _image_url_indexes[key] = {}
+    return _image_url_indexes[key]
+
+
+async def _save_url_index(images_dir: Path, url_index: Dict[str, str]):
+    part = _image_part_path(images_dir)
+    async with aiofiles.open(part, 'w', encoding='utf-8') as f:
+        await f.write(json.dumps(url_index, ensure_ascii=False))
+    os.replace(part, images_dir / IMAGE_URL_INDEX)
+
+
 async def save_image(src: str, node_id: str) -> str:
-    """保存图像文件"""
+    """
+    保存图像文件，文件名为内容的SHA-256，相同内容只保存一次
+    远程图像分块下载到磁盘并同时计算哈希，下载过的URL不再重复下载
+    node_id不再用于文件名，保留是为了兼容已生成的代码
+    """
+    part = None
     try:
+        src = await collect_text(src)
         images_dir = Path("images")
         images_dir.mkdir(exist_ok=True)
+        too_large = f"错误: 图像超过大小上限 ({IMAGE_MAX_BYTES} 字节)"
         
         if src.startswith('data:image/'):
             header, data = src.split(',', 1)
+            if len(data) * 3 // 4 > IMAGE_MAX_BYTES:
+                return too_large
             image_data = base64.b64decode(data)
             
-            if 'png' in header:
-                ext = 'png'
-            elif 'jpeg' in header or 'jpg' in header:
-                ext = 'jpg'
-            elif 'gif' in header:
-                ext = 'gif'
-            else:
-                ext = 'png'
-                
-            filename = f"{node_id}_{hash(src) % 100000}.{ext}"
+            filename = f"{hashlib.sha256(image_data).hexdigest()}.{_image_ext(header)}"
             filepath = images_dir / filename
             
-            async with aiofiles.open(filepath, 'wb') as f:
-                await f.write(image_data)
+            if not filepath.exists():
+                part = _image_part_path(images_dir)
+                async with aiofiles.open(part, 'wb') as f:
+                    await f.write(image_data)
+                os.replace(part, filepath)
                 
             return str(filepath)
             
         elif src.startswith(('http://', 'https://')):
-            async with aiohttp.ClientSession() as session:
-                async with session.get(src) as response:
-                    if response.status == 200:
-                        content = await response.read()
-                        
-                        content_type = response.headers.get('content-type', '')
-                        if 'png' in content_type:
-                            ext = 'png'
-                        elif 'jpeg' in content_type or 'jpg' in content_type:
-                            ext = 'jpg'
-                        elif 'gif' in content_type:
-                            ext = 'gif'
-                        else:
-                            parsed = urlparse(src)
-                            path_ext = Path(parsed.path).suffix.lower()
-                            ext = path_ext[1:] if path_ext in ['.png', '.jpg', '.jpeg', '.gif'] else 'png'
-                            
-                        filename = f"{node_id}_{hash(src) % 100000}.{ext}"
-                        filepath = images_dir / filename
+            url_index = _get_url_index(images_dir)
+            if src in url_index and (images_dir / url_index[src]).exists():
+                return str(images_dir / url_index[src])
+            
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=IMAGE_TIMEOUT, sock_read=IMAGE_TIMEOUT)
+            async with get_http_session().get(src, timeout=timeout) as response:
+                if response.status != 200:
+                    return f"错误: 无法下载图像 (HTTP {response.status})"
+                if (response.content_length or 0) > IMAGE_MAX_BYTES:
+                    return too_large
+                
+                digest = hashlib.sha256()
+                size = 0
+                part = _image_part_path(images_dir)
+                async with aiofiles.open(part, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(IMAGE_CHUNK_BYTES):
+                        size += len(chunk)
+                        if size > IMAGE_MAX_BYTES:
+                            return too_large
+                        digest.update(chunk)
+                        await f.write(chunk)
                         
-                        async with aiofiles.open(filepath, 'wb') as f:
-                            await f.write(content)
-                            
-                        return str(filepath)
-                    else:
-                        return f"错误: 无法下载图像 (HTTP {response.status})"
+                ext = _image_ext(response.headers.get('content-type', ''), src)
+            
+            filename = f"{digest.hexdigest()}.{ext}"
+            filepath = images_dir / filename
+            if not filepath.exists():
+                os.replace(part, filepath)
+            url_index[src] = filename
+            await _save_url_index(images_dir, url_index)
+            
+            return str(filepath)
         else:
             if os.path.exists(src):
                 return src
@@ -219,6 +1080,9 @@ async def save_image(src: str, node_id: str) -> str:
                 
     except Exception as e:
         return f"图像保存错误: {str(e)}"
+    finally:
+        if part is not None and part.exists():
+            part.unlink()
 
 
 # =============================================================================
@@ -233,8 +1097,8 @@ async def start_node(config: Dict[str, Any], input_data: Any = None) -> Any:
 
 async def end_node(config: Dict[str, Any], input_data: Any) -> Any:
     """通用结束节点"""
-    # 结束节点直接返回输入数据
-    return input_data
+    # 结束节点返回输入数据，流式输出先汇总为完整文本
+    return await collect_text(input_data)
 
 
 async def text_node(config: Dict[str, Any]) -> str:
@@ -246,16 +1110,23 @@ async def text_node(config: Dict[str, Any]) -> str:
 async def display_node(config: Dict[str, Any], input_data: Any) -> Any:
     """通用显示节点"""
     name = config.get('name', 'Display')
+    if isinstance(input_data, LLMStream):
+        # 流式输出边生成边显示
+        print(f"[{name}] 显示: ", end='', flush=True)
+        async for delta in input_data:
+            print(delta, end='', flush=True)
+        print()
+        return input_data
     print(f"[{name}] 显示: {input_data}")
     return input_data
 
 
-async def llm_node(config: Dict[str, Any], prompt: str) -> str:
-    """通用LLM节点"""
+async def llm_node(config: Dict[str, Any], prompt: str) -> Union[str, LLMStream]:
+    """通用LLM节点，配置stream为True时返回LLMStream"""
     system_prompt = config.get('systemPrompt', '')
     model = config.get('model', 'gpt-3.5-turbo')
     
-    return await llm_call(model, system_prompt, prompt)
+    return await llm_call(model, system_prompt, prompt, stream=config.get('stream', False))
 
 
 async def python_node(config: Dict[str, Any], **kwargs) -> Any:
@@ -271,7 +1142,7 @@ async def python_node(config: Dict[str, Any], **kwargs) -> Any:
             params[param_name] = kwargs[param_name]
     
     # 包装代码为main函数格式
-    if not code.strip().startswith('def main'):
+    if not code.strip().startswith(('def main', 'async def main')):
         param_names = [p['name'] for p in param_configs]
         wrapped_code = f"""def main({', '.join(param_names)}):
 {chr(10).join(['    ' + line for line in code.split(chr(10))])}
@@ -301,6 +1172,7 @@ async def image_node(config: Dict[str, Any], src: str, node_id: str = None) -> D
     """通用图像节点"""
     if not node_id:
         node_id = config.get('name', 'image').replace(' ', '_')
+    src = await collect_text(src)
     
     if src:
         image_path = await save_image(src, node_id)
@@ -311,30 +1183,31 @@ async def image_node(config: Dict[str, Any], src: str, node_id: str = None) -> D
         return {"error": "无图像源"}
 
 
-async def branch_node(config: Dict[str, Any], input_data: Any) -> Dict[str, Any]:
-    """通用分支节点"""
-    code = config.get('code', '')
-    branches = config.get('branches', [])
-    
-    # 构建分支变量映射
-    branch_vars = {}
-    for branch in branches:
-        branch_vars[branch['name']] = branch['id']
-    
+@functools.lru_cache(maxsize=256)
+def _branch_source(code: str, branches: tuple) -> str:
+    """按分支配置生成条件代码，相同配置只生成一次"""
     # 准备JavaScript执行环境
     branch_assignments = "; ".join([f"const {name} = '{branch_id}'" 
-                                   for name, branch_id in branch_vars.items()])
+                                   for name, branch_id in branches])
     
-    full_code = f"""
+    return f"""
 const input = arguments[0];
 {branch_assignments};
 
 {code}
 """
-    
-    result = await execute_javascript_code(full_code, {"input": input_data})
-    
-    # 处理分支结果
+
+
+def _branch_config_source(config: Dict[str, Any]) -> str:
+    # 构建分支变量映射
+    branch_vars = {}
+    for branch in config.get('branches', []):
+        branch_vars[branch['name']] = branch['id']
+    return _branch_source(config.get('code', ''), tuple(branch_vars.items()))
+
+
+def _branch_route(result: Any, input_data: Any) -> Dict[str, Any]:
+    """处理分支结果"""
     if isinstance(result, str):
         # 单个分支
         return {"branch": result, "data": input_data}
@@ -348,6 +1221,36 @@ const input = arguments[0];
         raise ValueError(f"分支条件返回值格式错误: {type(result)}")
 
 
+def _branch_outcome(result: Any, error: Optional[str], input_data: Any) -> Dict[str, Any]:
+    """单个输入的路由结果，条件出错、超时或返回值格式错误时为 {"error": ...}"""
+    if error is not None:
+        return {"error": error}
+    try:
+        return _branch_route(result, input_data)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+async def branch_node(config: Dict[str, Any], input_data: Any) -> Dict[str, Any]:
+    """通用分支节点，条件出错时返回 {"error": ...}，与branch_node_batch一致"""
+    full_code = _branch_config_source(config)
+    input_data = await collect_text(input_data)
+    (result, error), = await _run_javascript_batch(full_code, [{"input": input_data}])
+    return _branch_outcome(result, error, input_data)
+
+
+async def branch_node_batch(config: Dict[str, Any], inputs: List[Any]) -> List[Dict[str, Any]]:
+    """
+    批量分支节点: 对每个输入求值同一个分支条件，返回与inputs一一对应的路由结果
+    条件只编译一次，所有输入在一次进程往返中求值；条件出错、超时或返回值格式错误的输入得到 {"error": ...}
+    """
+    full_code = _branch_config_source(config)
+    inputs = [await collect_text(input_data) for input_data in inputs]
+    results = await _run_javascript_batch(full_code, [{"input": input_data} for input_data in inputs])
+    return [_branch_outcome(result, error, input_data)
+            for (result, error), input_data in zip(results, inputs)]
+
+
 # =============================================================================
 # 节点类型映射
 # =============================================================================
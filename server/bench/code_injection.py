@@ -0,0 +1,105 @@
+"""
+Compares the ways code reaches containers created for a single run
+(CODE_INJECTION_MODE): a bind-mounted host temp file, put_archive, or streaming
+it to a one-shot worker on a tmpfs /app. Needs Docker and the python-runner image.
+The container pool stays off so every run is a cold one in the mode under test.
+
+    cd server && uv run python -m bench.code_injection --runs 30 --concurrency 4
+
+Prints one JSON document with latency percentiles and mean phase times per mode.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import main
+from bench.stats import latency_summary
+
+SCRIPTS = {
+    "trivial": "print('hello')",
+    "numpy": "import numpy as np\nprint(np.arange(1000).sum())",
+}
+MODES = ("bind", "archive", "channel")
+
+
+def phase_means(before: dict, after: dict) -> dict:
+    """Mean seconds per cold-run phase observed between two histogram snapshots."""
+    means = {}
+    for (mode, phase), (total, count) in after.items():
+        if mode != "cold":
+            continue
+        previous_total, previous_count = before.get((mode, phase), (0.0, 0))
+        if count > previous_count:
+            means[phase] = (total - previous_total) / (count - previous_count)
+    return means
+
+
+async def bench_mode(mode: str, code: str, runs: int, concurrency: int) -> dict:
+    main.CODE_INJECTION_MODE = mode
+    await main.run_code_in_docker(code)  # Warm the image and page cache
+
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def run_once():
+        nonlocal failures
+        async with slots:
+            start_time = time.perf_counter()
+            result = await main.run_code_in_docker(code)
+            latencies.append(time.perf_counter() - start_time)
+            if result.error or result.exit_code != 0:
+                failures += 1
+
+    phases_before = main.sandbox_phase_seconds.totals()
+    start_time = time.perf_counter()
+    await asyncio.gather(*(run_once() for _ in range(runs)))
+    wall_seconds = time.perf_counter() - start_time
+
+    return {
+        "runs": runs,
+        "failures": failures,
+        "throughput_per_second": runs / wall_seconds,
+        "latency_seconds": latency_summary(latencies),
+        "phase_mean_seconds": phase_means(
+            phases_before, main.sandbox_phase_seconds.totals()
+        ),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    main.CONTAINER_POOL_MAX_SIZE = 0
+    await main.docker_hosts.start()
+    results = {}
+    try:
+        for script in args.scripts:
+            results[script] = {}
+            for mode in args.modes:
+                results[script][mode] = await bench_mode(
+                    mode, SCRIPTS[script], args.runs, args.concurrency
+                )
+    finally:
+        await main.docker_hosts.close()
+    return {
+        "benchmark": "code_injection",
+        "runs": args.runs,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--modes", nargs="+", choices=MODES, default=list(MODES), metavar="MODE"
+    )
+    parser.add_argument("--scripts", nargs="+", choices=SCRIPTS, default=list(SCRIPTS))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(run(parse_args())), indent=2))
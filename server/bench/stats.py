@@ -0,0 +1,50 @@
+"""Summaries shared by the benchmarks."""
+
+import statistics
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    return {
+        "mean": statistics.fmean(latencies) if latencies else None,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies, default=None),
+    }
+
+
+def parse_histogram_totals(text: str) -> dict[str, tuple[float, int]]:
+    """
+    Sum and count of every histogram series in a Prometheus text exposition,
+    keyed by the series name without the `_sum` suffix, labels included.
+    """
+    sums = {}
+    counts = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, _, value = line.rpartition(" ")
+        name, brace, labels = series.partition("{")
+        if name.endswith("_sum"):
+            sums[name[: -len("_sum")] + brace + labels] = float(value)
+        elif name.endswith("_count"):
+            counts[name[: -len("_count")] + brace + labels] = int(float(value))
+    return {key: (total, counts.get(key, 0)) for key, total in sums.items()}
+
+
+def mean_deltas(before: dict, after: dict) -> dict[str, float]:
+    """Mean of the observations each histogram series gained between two snapshots."""
+    means = {}
+    for key, (total, count) in after.items():
+        previous_total, previous_count = before.get(key, (0.0, 0))
+        if count > previous_count:
+            means[key] = (total - previous_total) / (count - previous_count)
+    return means
@@ -0,0 +1,163 @@
+"""
+Stand-ins for the benchmark suite: an OpenAI-compatible chat completions server
+with configurable latency, a thread that serves an ASGI app over real HTTP, and a
+runner that replaces the Docker sandbox with local subprocesses so the server's
+own overhead can be measured without Docker.
+"""
+
+import asyncio
+import codecs
+import json
+import sys
+import threading
+import time
+
+import uvicorn
+from docker.errors import ImageNotFound
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+def create_openai_stub(
+    first_token_seconds: float, tokens: int, token_interval_seconds: float
+) -> FastAPI:
+    """Chat completions that wait `first_token_seconds`, then produce `tokens`
+    tokens `token_interval_seconds` apart."""
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        base = {
+            "id": "chatcmpl-stub",
+            "created": int(time.time()),
+            "model": payload.get("model") or "stub",
+        }
+        usage = {
+            "prompt_tokens": 10,
+            "completion_tokens": tokens,
+            "total_tokens": 10 + tokens,
+        }
+        await asyncio.sleep(first_token_seconds)
+
+        if not payload.get("stream"):
+            await asyncio.sleep(token_interval_seconds * max(tokens - 1, 0))
+            message = {"role": "assistant", "content": "token " * tokens}
+            return {
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        async def generate():
+            for i in range(tokens):
+                if i:
+                    await asyncio.sleep(token_interval_seconds)
+                choice = {"index": 0, "delta": {"content": "token "}}
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [choice]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            choice = {"index": 0, "delta": {}, "finish_reason": "stop"}
+            chunk = {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [choice],
+                "usage": usage,
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+class ServerThread:
+    """Serves an ASGI app on 127.0.0.1 from a background thread and event loop."""
+
+    def __init__(self, app, port: int = 0):
+        self.server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+        )
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self) -> str:
+        """Starts serving and returns the base URL."""
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("Server thread exited during startup.")
+            time.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+class StubDockerClient:
+    """Lets main import without a Docker daemon. Without an image there is no pool."""
+
+    @staticmethod
+    def ping():
+        return True
+
+    class images:
+        @staticmethod
+        def get(name: str):
+            raise ImageNotFound(f"No image {name} with the stub runner.")
+
+    class containers:
+        @staticmethod
+        def list(**kwargs):
+            return []
+
+
+def install_stub_runner(main):
+    """
+    Replaces main's sandbox with local subprocesses that yield the same events.
+    Nothing is isolated, so this is only for the benchmark's own scripts.
+    """
+
+    async def stream_code_in_subprocess(
+        user_code: str,
+        timeout_seconds: float = main.EXECUTION_TIMEOUT_SECONDS,
+        max_output_bytes: int = main.MAX_OUTPUT_BYTES,
+        input_data=None,
+        limits=None,
+    ):
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-c",
+            user_code,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        limiter = main.OutputLimiter(max_output_bytes)
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        deadline = start_time + timeout_seconds
+        try:
+            while chunk := await asyncio.wait_for(
+                process.stdout.read(64 * 1024), max(deadline - loop.time(), 0)
+            ):
+                data = limiter.take(decoder.decode(chunk))
+                if data:
+                    yield {"type": "stdout", "data": data}
+            exit_code = await asyncio.wait_for(
+                process.wait(), max(deadline - loop.time(), 0)
+            )
+            event = main.exit_event(exit_code, None, loop.time() - start_time)
+        except asyncio.TimeoutError:
+            event = main.exit_event(-1, main.TIMEOUT_ERROR, loop.time() - start_time)
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        event["output_truncated"] = limiter.truncated
+        main.record_run_metrics("stub", event)
+        yield event
+
+    main.stream_code_in_docker = stream_code_in_subprocess
@@ -0,0 +1,245 @@
+"""
+Drives /python-runner and /openai/chat/completions at a fixed concurrency and
+prints one JSON document with latency percentiles, throughput and a per-phase
+breakdown for each case.
+
+The server runs in-process behind a local HTTP port, with the proxy pointed at a
+stub OpenAI server. `--runner stub` also swaps the Docker sandbox for local
+subprocesses, so the suite runs without Docker:
+
+    cd server && uv run python -m bench.suite --requests 50 --concurrency 8
+    cd server && uv run python -m bench.suite --runner stub --cases trivial llm
+
+`--url` benchmarks a running server instead. Its proxy should point at the stub,
+e.g. OPENAI_API_BASE_URL=http://127.0.0.1:8900/v1 with `--stub-port 8900`.
+
+Phases come from the responses (queue, run, and the remaining server overhead, or
+the first streamed chunk). The server side is covered by the means its /metrics
+histograms gained over each case (Docker phases, upstream latency, CPU time...),
+reported as `server_histogram_means`.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+import docker
+import httpx
+
+from bench.stats import latency_summary, mean_deltas, parse_histogram_totals
+from bench.stubs import (
+    ServerThread,
+    StubDockerClient,
+    create_openai_stub,
+    install_stub_runner,
+)
+
+PYTHON_CASES = {
+    "trivial": "print('hello')",
+    "numpy": "import numpy as np\nprint(np.arange(1000).sum())",
+    "large_output": "import sys\nsys.stdout.write('x' * {large_output_bytes})",
+    "timeout": "import time\ntime.sleep(3600)",
+}
+LLM_CASES = {"llm": False, "llm_stream": True}
+CASES = (*PYTHON_CASES, *LLM_CASES)
+TIMEOUT_ERROR = "Execution timed out."
+
+
+async def python_request(
+    client: httpx.AsyncClient, case: str, args: argparse.Namespace
+) -> dict:
+    code = PYTHON_CASES[case].format(large_output_bytes=args.large_output_bytes)
+    payload = {"code": code}
+    if case == "timeout":
+        # Well under the server's time limit, so the case stays quick
+        payload["timeout_seconds"] = args.timeout_seconds
+    start_time = time.perf_counter()
+    response = await client.post("/python-runner", json=payload)
+    latency = time.perf_counter() - start_time
+    result = response.json() if response.is_success else {}
+    if case == "timeout":
+        ok = result.get("error") == TIMEOUT_ERROR
+    else:
+        ok = result.get("error") is None and result.get("exit_code") == 0
+    queue_seconds = result.get("queue_seconds") or 0.0
+    run_seconds = result.get("duration_seconds") or 0.0
+    return {
+        "latency": latency,
+        "ok": ok,
+        "phases": {
+            "queue": queue_seconds,
+            "run": run_seconds,
+            "overhead": latency - queue_seconds - run_seconds,
+        },
+    }
+
+
+async def llm_request(client: httpx.AsyncClient, case: str, index: int) -> dict:
+    stream = LLM_CASES[case]
+    payload = {
+        "model": "stub",
+        "messages": [{"role": "user", "content": f"Benchmark request {index}"}],
+        "stream": stream,
+    }
+    # Every request must reach the stub rather than the cache or another caller
+    headers = {"Cache-Control": "no-store"}
+    start_time = time.perf_counter()
+    if not stream:
+        response = await client.post(
+            "/openai/chat/completions", json=payload, headers=headers
+        )
+        return {"latency": time.perf_counter() - start_time, "ok": response.is_success}
+
+    first_chunk_seconds = None
+    ok = False
+    async with client.stream(
+        "POST", "/openai/chat/completions", json=payload, headers=headers
+    ) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.perf_counter() - start_time
+            ok = line == "data: [DONE]"
+    phases = {"first_chunk": first_chunk_seconds} if first_chunk_seconds else {}
+    return {
+        "latency": time.perf_counter() - start_time,
+        "ok": ok and response.is_success,
+        "phases": phases,
+    }
+
+
+async def server_histograms(client: httpx.AsyncClient) -> dict:
+    response = await client.get("/metrics")
+    response.raise_for_status()
+    return parse_histogram_totals(response.text)
+
+
+async def bench_case(
+    client: httpx.AsyncClient, case: str, args: argparse.Namespace
+) -> dict:
+    def request(index: int):
+        if case in LLM_CASES:
+            return llm_request(client, case, index)
+        return python_request(client, case, args)
+
+    for index in range(args.warmup):
+        await request(-index - 1)
+
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def run_once(index: int) -> dict:
+        async with slots:
+            try:
+                return await request(index)
+            except httpx.HTTPError:
+                return {"latency": None, "ok": False}
+
+    histograms_before = await server_histograms(client)
+    start_time = time.perf_counter()
+    samples = await asyncio.gather(*(run_once(i) for i in range(args.requests)))
+    wall_seconds = time.perf_counter() - start_time
+    histograms_after = await server_histograms(client)
+
+    latencies = [sample["latency"] for sample in samples if sample["ok"]]
+    phases = {}
+    for sample in samples:
+        if sample["ok"]:
+            for phase, seconds in sample.get("phases", {}).items():
+                phases.setdefault(phase, []).append(seconds)
+    return {
+        "requests": args.requests,
+        "failures": sum(not sample["ok"] for sample in samples),
+        "throughput_per_second": args.requests / wall_seconds,
+        "latency_seconds": latency_summary(latencies),
+        "phase_mean_seconds": {
+            phase: sum(values) / len(values) for phase, values in phases.items()
+        },
+        "server_histogram_means": mean_deltas(histograms_before, histograms_after),
+    }
+
+
+async def run_cases(base_url: str, args: argparse.Namespace) -> dict:
+    results = {}
+    timeout = httpx.Timeout(args.timeout_seconds + 120)
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=timeout, limits=limits
+    ) as client:
+        for case in args.cases:
+            results[case] = await bench_case(client, case, args)
+    return results
+
+
+def run(args: argparse.Namespace) -> dict:
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # One line per request
+    stub = ServerThread(
+        create_openai_stub(
+            args.stub_first_token_seconds, args.stub_tokens, args.stub_token_interval
+        ),
+        args.stub_port,
+    )
+    stub_url = stub.start()
+    server = None
+    try:
+        base_url = args.url
+        if not base_url:
+            # main reads its configuration when it is imported
+            os.environ["OPENAI_API_BASE_URL"] = f"{stub_url}/v1"
+            os.environ["OPENAI_API_KEY"] = "stub"
+            os.environ["OPENAI_DEFAULT_MODEL"] = "stub"
+            if args.runner == "stub":
+                os.environ["DOCKER_CLIENT_MODE"] = "sdk"
+                docker.from_env = StubDockerClient
+            import main
+
+            if args.runner == "stub":
+                install_stub_runner(main)
+            server = ServerThread(main.app)
+            base_url = server.start()
+        results = asyncio.run(run_cases(base_url, args))
+    finally:
+        if server:
+            server.stop()
+        stub.stop()
+
+    return {
+        "benchmark": "suite",
+        "target": args.url or f"in-process ({args.runner} runner)",
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "stub_openai": {
+            "first_token_seconds": args.stub_first_token_seconds,
+            "tokens": args.stub_tokens,
+            "token_interval_seconds": args.stub_token_interval,
+        },
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20, help="Per case.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=2, help="Requests per case.")
+    parser.add_argument(
+        "--cases", nargs="+", choices=CASES, default=list(CASES), metavar="CASE"
+    )
+    parser.add_argument("--url", help="Benchmark a running server at this URL.")
+    parser.add_argument("--runner", choices=("docker", "stub"), default="docker")
+    parser.add_argument("--large-output-bytes", type=int, default=8 * 1024 * 1024)
+    parser.add_argument(
+        "--timeout-seconds", type=float, default=1, help="Of the timeout case."
+    )
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--stub-first-token-seconds", type=float, default=0.2)
+    parser.add_argument("--stub-tokens", type=int, default=50)
+    parser.add_argument("--stub-token-interval", type=float, default=0.01)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(parse_args()), indent=2))
@@ -0,0 +1,659 @@
+"""
+Long-lived job worker that runs inside the python-runner container.
+
+The server talks to it over the container's attached stdin/stdout. Every message
+in both directions is a frame: a 4-byte big-endian length followed by a UTF-8
+JSON object.
+
+Server -> worker:
+    {"type": "ping"}
+    {"type": "run", "id": str, "code": str, "timeout": float,
+     "input": Any, "max_result_bytes": int}  (the last two are optional)
+    {"type": "cancel", "id": str}
+
+Worker -> server:
+    {"type": "pong"}
+    {"type": "stdout" | "stderr", "id": str, "data": str}
+    {"type": "exit", "id": str, "exit_code": int, "timed_out": bool,
+     "cancelled": bool, "duration_seconds": float, "usage": dict,
+     "result": str | None, "result_error": str | None, "clean": bool}
+    {"type": "error", "message": str}
+
+Servers that share the files of $RUNNER_INPUT_PATH and $RUNNER_RESULT_PATH with
+the container exchange them directly. Others, such as ones using a remote Docker
+daemon, send the input with the job and set max_result_bytes to get the result
+file's text back in the exit message; the worker then clears the I/O directory
+after the job.
+
+The heavy libraries are imported once in this parent process, and every job runs
+in a freshly forked child so user code never sees state from a previous job. Jobs
+run as the worker's user, so the worker makes itself non-dumpable: a job can then
+neither ptrace it nor open its /proc entries to change what later children
+inherit. After
+each job the worker kills every other process in the container but init, including
+ones that left the job's process group, and wipes SCRATCH_DIRS. The exit message's
+"clean" is false when it could not make sure of that, and the server then retires
+the container.
+
+With --check-scratch-dirs the worker lists the directories its user can write to
+outside SCRATCH_DIRS and exits with 1 if there are any. The image build runs it so
+an image that would let files outlive a job is never built.
+
+With --once the worker skips the preload, runs a single job and exits. The server
+uses this to stream code into one-off containers instead of mounting it.
+
+With --script PATH [--usage-file PATH] there is no channel: the worker runs the
+script with its output going straight to the container's stdout and stderr, exits
+with its exit code and writes the run's usage as JSON to the usage file.
+
+Usage is measured from the container's cgroup (v2 or v1) and network counters
+around each job, falling back to the child's rusage where those are unavailable.
+Only one job runs in a container at a time, so the deltas belong to that job.
+"""
+
+import builtins
+import codecs
+import ctypes
+import json
+import os
+import selectors
+import shutil
+import signal
+import stat
+import struct
+import sys
+import time
+import traceback
+
+FRAME_HEADER = struct.Struct(">I")
+WORK_DIR = "/app"
+SCRIPT_PATH = "/app/user_script.py"
+# Every directory the image lets user code write to, other than the I/O directory
+SCRATCH_DIRS = [WORK_DIR, "/tmp", "/var/tmp", "/dev/shm", "/dev/mqueue"]
+PRELOAD_MODULES = [
+    "numpy",
+    "matplotlib",
+    "matplotlib.pyplot",
+    "requests",
+    "bs4",
+]
+READ_CHUNK_SIZE = 64 * 1024
+PROCESS_SWEEP_ATTEMPTS = 20
+PROCESS_SWEEP_INTERVAL_SECONDS = 0.01
+CHILD_POLL_INTERVAL_SECONDS = 0.05
+PR_SET_DUMPABLE = 4
+CGROUP_ROOT = "/sys/fs/cgroup"
+NET_DEV_PATH = "/proc/net/dev"
+
+
+def preload():
+    for module in PRELOAD_MODULES:
+        try:
+            __import__(module)
+        except Exception as e:  # The image may not ship every module
+            print(f"worker: could not preload {module}: {e}", file=sys.stderr)
+
+
+class Channel:
+    def __init__(self, read_fd: int, write_fd: int):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+
+    def _read_exact(self, size: int) -> bytes | None:
+        data = bytearray()
+        while len(data) < size:
+            chunk = os.read(self.read_fd, size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def receive(self) -> dict | None:
+        header = self._read_exact(FRAME_HEADER.size)
+        if header is None:
+            return None
+        (size,) = FRAME_HEADER.unpack(header)
+        payload = self._read_exact(size)
+        if payload is None:
+            return None
+        return json.loads(payload)
+
+    def send(self, message: dict):
+        payload = json.dumps(message).encode("utf-8")
+        data = memoryview(FRAME_HEADER.pack(len(payload)) + payload)
+        while data:
+            written = os.write(self.write_fd, data)
+            data = data[written:]
+
+
+def read_file(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def read_cgroup_counters() -> dict:
+    """
+    Cumulative CPU microseconds, block I/O bytes and OOM kills of the container's
+    cgroup. Counters the kernel does not expose are left out.
+    """
+    counters = {}
+    cpu_stat = read_file(f"{CGROUP_ROOT}/cpu.stat")
+    if cpu_stat is not None:  # cgroup v2
+        for line in cpu_stat.splitlines():
+            key, _, value = line.partition(" ")
+            if key in ("user_usec", "system_usec"):
+                counters[key] = int(value)
+        io_stat = read_file(f"{CGROUP_ROOT}/io.stat") or ""
+        for line in io_stat.splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                if key in ("rbytes", "wbytes"):
+                    counters[key] = counters.get(key, 0) + int(value)
+        memory_events = read_file(f"{CGROUP_ROOT}/memory.events") or ""
+    else:  # cgroup v1
+        for key, name in (("user_usec", "usage_user"), ("system_usec", "usage_sys")):
+            value = read_file(f"{CGROUP_ROOT}/cpuacct/cpuacct.{name}")
+            if value is not None:
+                counters[key] = int(value) // 1000
+        blkio = read_file(
+            f"{CGROUP_ROOT}/blkio/blkio.throttle.io_service_bytes_recursive"
+        )
+        for line in (blkio or "").splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[1] in ("Read", "Write"):
+                key = "rbytes" if fields[1] == "Read" else "wbytes"
+                counters[key] = counters.get(key, 0) + int(fields[2])
+        memory_events = read_file(f"{CGROUP_ROOT}/memory/memory.oom_control") or ""
+    for line in memory_events.splitlines():
+        key, _, value = line.partition(" ")
+        if key == "oom_kill":
+            counters["oom_kill"] = int(value)
+    return counters
+
+
+def read_pids_current() -> int | None:
+    for path in (f"{CGROUP_ROOT}/pids.current", f"{CGROUP_ROOT}/pids/pids.current"):
+        value = read_file(path)
+        if value is not None:
+            return int(value)
+    return None
+
+
+def read_net_counters() -> tuple[int, int] | None:
+    """Received and sent bytes of the container's interfaces, loopback excluded."""
+    net_dev = read_file(NET_DEV_PATH)
+    if net_dev is None:
+        return None
+    rx_bytes = tx_bytes = 0
+    for line in net_dev.splitlines()[2:]:
+        name, _, data = line.partition(":")
+        fields = data.split()
+        if name.strip() == "lo" or len(fields) < 9:
+            continue
+        rx_bytes += int(fields[0])
+        tx_bytes += int(fields[8])
+    return rx_bytes, tx_bytes
+
+
+class UsageMeter:
+    """Resource usage of one job, from counter snapshots taken around it."""
+
+    def __init__(self):
+        self.cgroup = read_cgroup_counters()
+        self.net = read_net_counters()
+        self.pids_baseline = read_pids_current()
+        self.pids_peak = None
+        self.sampled_at = 0.0
+
+    def sample(self):
+        """Tracks the job's peak process count; cheap enough to call in a loop."""
+        now = time.monotonic()
+        if (
+            self.pids_baseline is None
+            or now - self.sampled_at < CHILD_POLL_INTERVAL_SECONDS
+        ):
+            return
+        self.sampled_at = now
+        current = read_pids_current()
+        if current is not None:
+            self.pids_peak = max(self.pids_peak or 0, current - self.pids_baseline)
+
+    def finish(self, rusage) -> dict:
+        cgroup = read_cgroup_counters()
+        net = read_net_counters()
+
+        def delta(key: str) -> int | None:
+            if key in cgroup and key in self.cgroup:
+                return cgroup[key] - self.cgroup[key]
+            return None
+
+        user_usec = delta("user_usec")
+        system_usec = delta("system_usec")
+        read_bytes = delta("rbytes")
+        write_bytes = delta("wbytes")
+        oom_kills = delta("oom_kill")
+        return {
+            "cpu_user_seconds": (
+                user_usec / 1e6 if user_usec is not None else rusage.ru_utime
+            ),
+            "cpu_system_seconds": (
+                system_usec / 1e6 if system_usec is not None else rusage.ru_stime
+            ),
+            "max_rss_bytes": rusage.ru_maxrss * 1024,  # Reported in KiB on Linux
+            # rusage counts 512-byte blocks
+            "block_read_bytes": (
+                read_bytes if read_bytes is not None else rusage.ru_inblock * 512
+            ),
+            "block_write_bytes": (
+                write_bytes if write_bytes is not None else rusage.ru_oublock * 512
+            ),
+            "net_rx_bytes": net[0] - self.net[0] if net and self.net else None,
+            "net_tx_bytes": net[1] - self.net[1] if net and self.net else None,
+            "pids_peak": self.pids_peak,
+            "oom_killed": oom_kills > 0 if oom_kills is not None else None,
+        }
+
+
+def set_dumpable(dumpable: bool) -> bool:
+    """Sets whether processes of the same user may ptrace this one or open its
+    /proc/<pid> entries; True if that worked."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_DUMPABLE, int(dumpable), 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def run_child(code: str, stdout_fd: int, stderr_fd: int, save_script=True) -> int:
+    """Runs user code in the forked child with its output redirected to pipes."""
+    os.setsid()
+    set_dumpable(True)  # Only the worker itself needs the protection
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+    os.chdir(WORK_DIR)
+    sys.argv = [SCRIPT_PATH]
+    sys.path[0] = WORK_DIR
+
+    exit_code = 0
+    try:
+        if save_script:
+            # Keeps __file__ valid and gives tracebacks their source lines
+            with open(SCRIPT_PATH, "w", encoding="utf-8") as f:
+                f.write(code)
+        compiled = compile(code, SCRIPT_PATH, "exec")
+        exec(
+            compiled,
+            {"__name__": "__main__", "__file__": SCRIPT_PATH, "__builtins__": builtins},
+        )
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException as e:
+        # Skip this function's frame so the traceback starts at the user script
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        exit_code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+    return exit_code
+
+
+def child_exited(pid: int) -> bool:
+    # WNOWAIT leaves the child unreaped, which keeps its process group id reserved
+    return os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+
+
+def remove_entry(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        # User code may have taken the permissions it needs to empty a directory
+        def make_writable(function, failed_path, _):
+            for target in (os.path.dirname(failed_path), failed_path):
+                try:
+                    os.chmod(target, 0o700, follow_symlinks=False)
+                except (OSError, NotImplementedError):
+                    pass
+            try:
+                function(failed_path)
+            except OSError:
+                pass
+
+        os.chmod(path, 0o700)
+        shutil.rmtree(path, onerror=make_writable)
+    else:
+        os.unlink(path)
+
+
+def wipe_dir(directory: str) -> bool:
+    """Empties a directory; True if nothing is left in it."""
+    try:
+        entries = os.listdir(directory)
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+    for entry in entries:
+        try:
+            remove_entry(os.path.join(directory, entry))
+        except OSError:
+            pass
+    try:
+        return not os.listdir(directory)
+    except OSError:
+        return False
+
+
+def wipe_scratch_dirs() -> bool:
+    wiped = True
+    for directory in SCRATCH_DIRS:
+        wiped = wipe_dir(directory) and wiped
+    return wiped
+
+
+def unlisted_writable_dirs() -> list[str]:
+    """Directories user code could write to that are not in SCRATCH_DIRS. Anything
+    written there would outlive the job."""
+    listed = set(SCRATCH_DIRS)
+    found = []
+    for root, dirs, _ in os.walk("/"):
+        kept = []
+        for name in dirs:
+            path = os.path.join(root, name)
+            # A link's target is checked where it really is
+            if path in listed or path in ("/proc", "/sys") or os.path.islink(path):
+                continue
+            if os.access(path, os.W_OK):
+                found.append(path)
+            else:
+                kept.append(name)
+        dirs[:] = kept
+    return found
+
+
+def stray_processes() -> list[int]:
+    """Live processes in the container other than init and this worker."""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) in (1, os.getpid()):
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat_line = f.read()
+        except OSError:
+            continue  # Already gone
+        # The state follows the command name, which may contain ")" itself
+        if stat_line.rpartition(")")[2].split()[0] != "Z":
+            pids.append(int(entry))
+    return pids
+
+
+def kill_stray_processes() -> bool:
+    """
+    Kills every process in the container except init and this worker, including
+    ones a job moved out of its process group with setsid() or a double fork.
+    True once none are left. Killed processes are reaped by init.
+    """
+    if os.getppid() != 1:
+        # Not the container's main process, so other processes here may not be
+        # the job's to kill
+        return False
+    for _ in range(PROCESS_SWEEP_ATTEMPTS):
+        try:
+            os.kill(-1, signal.SIGKILL)  # Everything but init and the caller
+        except ProcessLookupError:
+            pass
+        if not stray_processes():
+            return True
+        time.sleep(PROCESS_SWEEP_INTERVAL_SECONDS)
+    return False
+
+
+def write_input_file(path: str, value):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644)
+    with open(fd, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
+
+
+def read_result_file(path: str, max_bytes: int) -> tuple[str | None, str | None]:
+    """The result file's text and an error, for a server that cannot read it."""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except FileNotFoundError:
+        return None, None
+    except OSError as e:
+        return None, f"Could not open the result file: {e.strerror}"
+    with open(fd, "rb") as f:
+        info = os.fstat(f.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            return None, "The result file is not a regular file."
+        if info.st_size > max_bytes:
+            return None, f"The result exceeds {max_bytes} bytes."
+        return f.read().decode("utf-8", errors="replace") or None, None
+
+
+def cancel_requested(channel: Channel, job_id) -> bool:
+    """Reads a message that arrived during a job. A cancel of the job stops it, and
+    so does the server closing the channel."""
+    message = channel.receive()
+    if message is None:
+        return True
+    return message.get("type") == "cancel" and message.get("id") == job_id
+
+
+def run_job(channel: Channel, job: dict, reusable: bool = True):
+    job_id = job.get("id")
+    timeout = float(job.get("timeout") or 60)
+    start_time = time.monotonic()
+    meter = UsageMeter()
+    input_path = os.environ.get("RUNNER_INPUT_PATH")
+    result_path = os.environ.get("RUNNER_RESULT_PATH")
+    if "input" in job and input_path:
+        write_input_file(input_path, job["input"])
+
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            exit_code = run_child(job.get("code", ""), stdout_w, stderr_w)
+        finally:
+            os._exit(exit_code)
+
+    os.close(stdout_w)
+    os.close(stderr_w)
+
+    selector = selectors.DefaultSelector()
+    streams = {
+        stdout_r: ("stdout", codecs.getincrementaldecoder("utf-8")("replace")),
+        stderr_r: ("stderr", codecs.getincrementaldecoder("utf-8")("replace")),
+    }
+    for fd in streams:
+        selector.register(fd, selectors.EVENT_READ)
+    selector.register(channel.read_fd, selectors.EVENT_READ)
+
+    deadline = start_time + timeout
+    timed_out = False
+    cancelled = False
+    while streams and not cancelled:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        events = selector.select(min(remaining, CHILD_POLL_INTERVAL_SECONDS))
+        meter.sample()
+        for key, _ in events:
+            if key.fd == channel.read_fd:
+                cancelled = cancel_requested(channel, job_id)
+                continue
+            name, decoder = streams[key.fd]
+            chunk = os.read(key.fd, READ_CHUNK_SIZE)
+            data = decoder.decode(chunk, final=not chunk)
+            if data:
+                channel.send({"type": name, "id": job_id, "data": data})
+            if not chunk:
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                del streams[key.fd]
+        # Background processes may keep the pipes open after the child is gone
+        if not events and child_exited(pid):
+            break
+
+    # The child may also close its output early and keep running
+    while not (timed_out or cancelled) and not child_exited(pid):
+        if time.monotonic() >= deadline:
+            timed_out = True
+            break
+        meter.sample()
+        if selector.select(0.005):  # Only the channel is left
+            cancelled = cancel_requested(channel, job_id)
+
+    # Kill the whole process group so background processes do not outlive the job
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    _, status, rusage = os.wait4(pid, 0)
+    for fd in streams:
+        selector.unregister(fd)
+        os.close(fd)
+    selector.close()
+    # Before the result is read, so nothing can still change it
+    clean = kill_stray_processes()
+    clean = wipe_scratch_dirs() and clean and reusable
+
+    result = result_error = None
+    if job.get("max_result_bytes") is not None and result_path:
+        result, result_error = read_result_file(result_path, job["max_result_bytes"])
+        clean = wipe_dir(os.path.dirname(result_path)) and clean
+
+    channel.send(
+        {
+            "type": "exit",
+            "id": job_id,
+            "exit_code": (
+                -1 if timed_out or cancelled else os.waitstatus_to_exitcode(status)
+            ),
+            "timed_out": timed_out,
+            "cancelled": cancelled,
+            "duration_seconds": time.monotonic() - start_time,
+            "usage": meter.finish(rusage),
+            "result": result,
+            "result_error": result_error,
+            "clean": clean,
+        }
+    )
+
+
+def run_script(script_path: str, usage_path: str | None) -> int:
+    with open(script_path, encoding="utf-8") as f:
+        code = f.read()
+    meter = UsageMeter()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            exit_code = run_child(code, 1, 2, save_script=False)
+        finally:
+            os._exit(exit_code)
+
+    # A pidfd wakes the wait as soon as the child exits, between process samples
+    with selectors.DefaultSelector() as selector:
+        pidfd = os.pidfd_open(pid)
+        selector.register(pidfd, selectors.EVENT_READ)
+        while not selector.select(CHILD_POLL_INTERVAL_SECONDS):
+            meter.sample()
+        selector.unregister(pidfd)
+        os.close(pidfd)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    _, status, rusage = os.wait4(pid, 0)
+
+    if usage_path:
+        # The script could have left a link in its place
+        try:
+            os.unlink(usage_path)
+        except OSError:
+            pass
+        fd = os.open(usage_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(meter.finish(rusage), f)
+    exit_code = os.waitstatus_to_exitcode(status)
+    # Report a signal the way a shell (and Docker) would
+    return 128 - exit_code if exit_code < 0 else exit_code
+
+
+def option_value(args: list[str], name: str) -> str | None:
+    return args[args.index(name) + 1] if name in args[:-1] else None
+
+
+def main():
+    args = sys.argv[1:]
+    script_path = option_value(args, "--script")
+    if script_path:
+        sys.exit(run_script(script_path, option_value(args, "--usage-file")))
+    if "--check-scratch-dirs" in args:
+        unlisted = unlisted_writable_dirs()
+        for path in unlisted:
+            print(f"worker: {path} is writable and not wiped between jobs")
+        sys.exit(1 if unlisted else 0)
+
+    once = "--once" in args
+    # Keep the channel on private descriptors so stray prints cannot corrupt it
+    channel = Channel(os.dup(0), os.dup(1))
+    os.dup2(2, 1)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+
+    reusable = set_dumpable(False)
+    if not reusable:
+        print("worker: could not make the worker non-dumpable", file=sys.stderr)
+    if not once:
+        preload()
+
+    while True:
+        message = channel.receive()
+        if message is None:
+            break
+        message_type = message.get("type")
+        try:
+            if message_type == "ping":
+                channel.send({"type": "pong"})
+            elif message_type == "run":
+                run_job(channel, message, reusable)
+                if once:
+                    break
+            elif message_type == "cancel":
+                pass  # The job finished before the cancel arrived
+            else:
+                channel.send(
+                    {"type": "error", "message": f"Unknown message: {message_type}"}
+                )
+        except Exception as e:
+            traceback.print_exc()
+            channel.send({"type": "error", "message": str(e)})
+
+
+if __name__ == "__main__":
+    main()
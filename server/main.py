@@ -1,17 +1,33 @@
 import asyncio
+import codecs
+import functools
+import hashlib
+import io
 import json
 import logging
+import math
+import mmap
 import os
+import shutil
+import socket
+import stat
+import struct
+import tarfile
 import tempfile
-from contextlib import asynccontextmanager
-from typing import List
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager, contextmanager, suppress
+from typing import Any, AsyncIterator, Awaitable, Callable, Coroutine, List, Literal
 
 import docker
+import httpx
 from docker.errors import APIError, ImageNotFound, NotFound
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 
 import openai
 
@@ -21,39 +37,594 @@ load_dotenv()
 
 # --- Configuration ---
 DOCKER_IMAGE_NAME = "python-runner"  # Image built from Dockerfile
-EXECUTION_TIMEOUT_SECONDS = 60  # Max execution time for user code
+# Time limit of a run, and the most a request may ask for
+EXECUTION_TIMEOUT_SECONDS = float(os.getenv("EXECUTION_TIMEOUT_SECONDS", "60"))
+EXECUTION_MAX_TIMEOUT_SECONDS = max(
+    float(os.getenv("EXECUTION_MAX_TIMEOUT_SECONDS", "300")), EXECUTION_TIMEOUT_SECONDS
+)
+MAX_OUTPUT_BYTES = int(os.getenv("MAX_OUTPUT_BYTES", str(16 * 1024 * 1024)))
 DOCKER_CONTAINER_USER = "appuser"  # User inside the Docker container
+# How the runner talks to Docker: "sdk" runs docker SDK calls on executor threads,
+# "async" speaks the Engine API over httpx so waits and log streams hold no thread
+DOCKER_CLIENT_MODE = os.getenv("DOCKER_CLIENT_MODE", "sdk")
+DOCKER_HOST = os.getenv("DOCKER_HOST", "unix:///var/run/docker.sock")
+DOCKER_API_VERSION = os.getenv("DOCKER_API_VERSION", "1.41")  # Except sdk DOCKER_HOST
+DOCKER_API_TIMEOUT_SECONDS = float(os.getenv("DOCKER_API_TIMEOUT_SECONDS", "60"))
+# Docker daemons to place runs on, comma-separated (unix:// or tcp://). Each gets
+# its own pool; defaults to DOCKER_HOST alone
+DOCKER_HOSTS = [
+    host.strip()
+    for host in (os.getenv("DOCKER_HOSTS") or DOCKER_HOST).split(",")
+    if host.strip()
+]
+DOCKER_HOST_MAX_RUNS = int(os.getenv("DOCKER_HOST_MAX_RUNS", "8"))  # Per host
+DOCKER_HOST_HEALTH_INTERVAL_SECONDS = float(
+    os.getenv("DOCKER_HOST_HEALTH_INTERVAL_SECONDS", "10")
+)
+# Consecutive failed health checks before a host gets no more runs
+DOCKER_HOST_MAX_FAILURES = int(os.getenv("DOCKER_HOST_MAX_FAILURES", "3"))
+# Default resource limits of a run, and the most a request may ask for
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "256"))
+SANDBOX_CPUS = float(os.getenv("SANDBOX_CPUS", "1"))
+SANDBOX_PIDS = int(os.getenv("SANDBOX_PIDS", "64"))
+SANDBOX_MAX_MEMORY_MB = int(os.getenv("SANDBOX_MAX_MEMORY_MB", "1024"))
+SANDBOX_MAX_CPUS = float(os.getenv("SANDBOX_MAX_CPUS", "2"))
+SANDBOX_MAX_PIDS = int(os.getenv("SANDBOX_MAX_PIDS", "256"))
+SANDBOX_MIN_MEMORY_MB = 32  # Below this the interpreter itself does not start
+SANDBOX_MIN_PIDS = 8  # Room for init, the worker and the code's process
+# How code reaches containers created for a single run (the pool always streams it
+# over the job channel): "bind" mounts a host temp file, "archive" copies it in
+# with put_archive, and "channel" streams it to a one-shot worker on a tmpfs /app
+CODE_INJECTION_MODE = os.getenv("CODE_INJECTION_MODE", "bind")
+APP_TMPFS_SIZE = os.getenv("APP_TMPFS_SIZE", "64m")  # Counts toward the memory limit
+
+# Structured input and result files are exchanged through a host directory that is
+# bind-mounted into the sandbox; /dev/shm keeps them in memory
+IO_DIR_BASE = os.getenv(
+    "IO_DIR_BASE", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
+IO_DIR_CONTAINER = "/io"
+INPUT_FILE_NAME = "input.json"
+RESULT_FILE_NAME = "result.json"
+USAGE_FILE_NAME = ".usage.json"  # Written by the worker after script runs
+MAX_RESULT_BYTES = int(os.getenv("MAX_RESULT_BYTES", str(64 * 1024 * 1024)))
+# Containers on other machines keep the files on a tmpfs, which counts toward the
+# memory limit
+IO_TMPFS_SIZE = os.getenv("IO_TMPFS_SIZE", "128m")
+
+# Container Pool Configuration (set CONTAINER_POOL_MAX_SIZE=0 to disable the pool)
+CONTAINER_POOL_MIN_SIZE = int(os.getenv("CONTAINER_POOL_MIN_SIZE", "2"))
+CONTAINER_POOL_MAX_SIZE = int(os.getenv("CONTAINER_POOL_MAX_SIZE", "8"))
+CONTAINER_POOL_MAX_RUNS = int(os.getenv("CONTAINER_POOL_MAX_RUNS", "50"))
+CONTAINER_POOL_MAX_AGE_SECONDS = float(
+    os.getenv("CONTAINER_POOL_MAX_AGE_SECONDS", "1800")
+)
+CONTAINER_POOL_HEALTH_INTERVAL_SECONDS = float(
+    os.getenv("CONTAINER_POOL_HEALTH_INTERVAL_SECONDS", "30")
+)
+WORKER_SCRIPT_CONTAINER = "/opt/runner/worker.py"  # Job worker baked into the image
+WORKER_READY_TIMEOUT_SECONDS = 30  # Time allowed for the worker's preload imports
+WORKER_EXIT_GRACE_SECONDS = 5  # Extra wait beyond the job timeout before recycling
+
+# Container Lifecycle Configuration. Sandbox containers are labelled with the server
+# instance ID, and the ones of this instance found at startup were left by an
+# earlier process and are removed, so servers sharing a Docker daemon need their
+# own IDs. Unset, the ID is the host name and process ID, which no other server
+# shares; set a stable one to have a restarted server clean up after the last. The
+# janitor also removes containers older than CONTAINER_MAX_AGE_SECONDS
+SERVER_INSTANCE_ID = (
+    os.getenv("SERVER_INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+)
+CONTAINER_INSTANCE_LABEL = "autovp.instance"
+CONTAINER_MAX_AGE_SECONDS = float(os.getenv("CONTAINER_MAX_AGE_SECONDS", "3600"))
+JANITOR_INTERVAL_SECONDS = float(os.getenv("JANITOR_INTERVAL_SECONDS", "60"))
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "30"))
+
+# Execution Scheduler Configuration
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "8"))
+SCHEDULER_MAX_QUEUE_DEPTH = int(os.getenv("SCHEDULER_MAX_QUEUE_DEPTH", "64"))
+SCHEDULER_MAX_QUEUE_PER_CLIENT = int(os.getenv("SCHEDULER_MAX_QUEUE_PER_CLIENT", "16"))
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "64"))
+# Jobs of one batch in flight at once; kept below the per-client queue limit
+BATCH_MAX_PARALLEL = int(
+    os.getenv(
+        "BATCH_MAX_PARALLEL",
+        str(min(SCHEDULER_MAX_CONCURRENCY, SCHEDULER_MAX_QUEUE_PER_CLIENT)),
+    )
+)
+
+# Result Cache Configuration (used by requests that set `cache: true`)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "3600"))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")  # Empty disables the disk tier
+RESULT_CACHE_DISK_MAX_BYTES = int(
+    os.getenv("RESULT_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024))
+)
 
 # OpenAI Configuration
 OPENAI_API_BASE_URL = os.getenv("OPENAI_API_BASE_URL")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_DEFAULT_MODEL = os.getenv("OPENAI_DEFAULT_MODEL")
 MAX_TOKENS = 16 * 1024
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = float(
+    os.getenv("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "60")
+)
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(
+    os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "10")
+)
+OPENAI_READ_TIMEOUT_SECONDS = float(os.getenv("OPENAI_READ_TIMEOUT_SECONDS", "600"))
+
+# OpenAI Response Cache Configuration. Off by default: a cached response is
+# replayed for identical requests even when they ask for sampled output
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "")  # Empty disables the disk tier
+LLM_CACHE_DISK_MAX_BYTES = int(
+    os.getenv("LLM_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024))
+)
+# Identical concurrent proxy requests share one upstream call
+LLM_COALESCE_ENABLED = os.getenv("LLM_COALESCE_ENABLED", "true").lower() == "true"
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Docker client
-try:
-    docker_client = docker.from_env()
-except docker.errors.DockerException as e:
-    logger.error(
-        f"Could not connect to Docker daemon: {e}. Please ensure Docker is running."
-    )
-    raise SystemExit(f"Docker connection failed: {e}")
+
+# --- Metrics ---
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.label_names, key)), value
+
+
+class Histogram:
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (per-bucket counts, sum, count)
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time, **labels)
+
+    def totals(self) -> dict[tuple, tuple[float, int]]:
+        """Sum and count of the observations per label values."""
+        with self._lock:
+            return {key: (entry[1], entry[2]) for key, entry in self._values.items()}
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (key, list(entry[0]), entry[1], entry[2])
+                for key, entry in self._values.items()
+            ]
+        for key, bucket_counts, total, count in values:
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", {
+                    **labels,
+                    "le": format_value(bound),
+                }, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class CallbackMetric:
+    """A metric whose samples are read from existing state when scraped."""
+
+    def __init__(self, name: str, help_text: str, kind: str, collect):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.collect = collect  # Returns a number or a list of (labels, value)
+
+    def samples(self):
+        collected = self.collect()
+        if collected is None:
+            return
+        if isinstance(collected, (int, float)):
+            collected = [({}, collected)]
+        for labels, value in collected:
+            if value is not None:
+                yield self.name, labels, value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> Counter:
+        return self._register(Counter(name, help_text, label_names))
+
+    def histogram(
+        self, name: str, help_text: str, label_names: tuple = (), **kwargs
+    ) -> Histogram:
+        return self._register(Histogram(name, help_text, label_names, **kwargs))
+
+    def callback(self, name: str, help_text: str, kind: str, collect) -> CallbackMetric:
+        return self._register(CallbackMetric(name, help_text, kind, collect))
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.warning(f"Could not collect metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+metrics = MetricsRegistry()
+
+sandbox_phase_seconds = metrics.histogram(
+    "autovp_sandbox_phase_seconds",
+    "Time spent in each Docker phase of a sandbox run.",
+    ("mode", "phase"),
+)
+sandbox_run_seconds = metrics.histogram(
+    "autovp_sandbox_run_seconds",
+    "Wall time of sandbox runs, from start to exit.",
+    ("mode",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+sandbox_runs_total = metrics.counter(
+    "autovp_sandbox_runs_total",
+    "Sandbox runs by outcome (ok, failed, timeout, error).",
+    ("mode", "outcome"),
+)
+sandbox_exit_codes_total = metrics.counter(
+    "autovp_sandbox_exit_codes_total",
+    "Exit codes of sandbox runs that finished.",
+    ("exit_code",),
+)
+sandbox_cpu_seconds = metrics.histogram(
+    "autovp_sandbox_cpu_seconds",
+    "CPU time (user + system) of sandbox runs.",
+    ("mode",),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+sandbox_max_rss_bytes = metrics.histogram(
+    "autovp_sandbox_max_rss_bytes",
+    "Peak resident set size of the largest process of sandbox runs.",
+    ("mode",),
+    buckets=tuple(2**power * 1024 * 1024 for power in range(4, 12)),  # 16MiB-2GiB
+)
+sandbox_pids_peak = metrics.histogram(
+    "autovp_sandbox_pids_peak",
+    "Most processes a sandbox run had at once.",
+    ("mode",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+sandbox_io_bytes_total = metrics.counter(
+    "autovp_sandbox_io_bytes_total",
+    "Block and network I/O of sandbox runs.",
+    ("mode", "kind"),
+)
+sandbox_oom_kills_total = metrics.counter(
+    "autovp_sandbox_oom_kills_total",
+    "Sandbox runs in which the kernel killed a process for running out of memory.",
+    ("mode",),
+)
+sandbox_runs_cancelled_total = metrics.counter(
+    "autovp_sandbox_runs_cancelled_total",
+    "Runs stopped before they finished, by reason (cancel, disconnect).",
+    ("reason",),
+)
+sandbox_containers_reaped_total = metrics.counter(
+    "autovp_sandbox_containers_reaped_total",
+    "Sandbox containers removed by the janitor (orphan, max_age, stopped, shutdown).",
+    ("reason",),
+)
+executor_wait_seconds = metrics.histogram(
+    "autovp_docker_executor_wait_seconds",
+    "Time Docker calls spent queued for an executor thread.",
+)
+llm_proxy_requests_total = metrics.counter(
+    "autovp_llm_proxy_requests_total",
+    "OpenAI proxy requests by cache status.",
+    ("stream", "cache"),
+)
+llm_upstream_requests_total = metrics.counter(
+    "autovp_llm_upstream_requests_total",
+    "Upstream chat completion calls by status (ok, error, cancelled).",
+    ("model", "stream", "status"),
+)
+llm_upstream_errors_total = metrics.counter(
+    "autovp_llm_upstream_errors_total",
+    "Failed upstream chat completion calls by exception type.",
+    ("model", "error"),
+)
+llm_upstream_seconds = metrics.histogram(
+    "autovp_llm_upstream_seconds",
+    "Total time of upstream chat completion calls.",
+    ("model", "stream"),
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+llm_time_to_first_token_seconds = metrics.histogram(
+    "autovp_llm_time_to_first_token_seconds",
+    "Time until the first chunk (or the whole response) arrives from upstream.",
+    ("model", "stream"),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 60),
+)
+llm_tokens_per_second = metrics.histogram(
+    "autovp_llm_tokens_per_second",
+    "Completion tokens per second of generation.",
+    ("model", "stream"),
+    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500),
+)
+llm_tokens_total = metrics.counter(
+    "autovp_llm_tokens_total",
+    "Token usage reported by upstream.",
+    ("model", "kind"),
+)
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that tracks queued and running calls for saturation
+    metrics."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = 0
+        self.active = 0
+        self._stats_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted_at = time.monotonic()
+        with self._stats_lock:
+            self.pending += 1
+
+        def run():
+            with self._stats_lock:
+                self.pending -= 1
+                self.active += 1
+            executor_wait_seconds.observe(time.monotonic() - submitted_at)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.active -= 1
+
+        try:
+            return super().submit(run)
+        except BaseException:
+            with self._stats_lock:
+                self.pending -= 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "pending": self.pending,
+            "max_workers": self._max_workers,
+        }
+
+
+# Dedicated threads for blocking Docker SDK calls, sized to the run concurrency so
+# sandbox runs cannot exhaust the default executor used by the rest of the app. A
+# cold run holds three at once (the container wait and a log pump per stream), and
+# the headroom covers pool refills, janitor sweeps and health checks.
+DOCKER_THREADS_PER_RUN = 3
+DOCKER_THREADS_HEADROOM = 8
+docker_executor = InstrumentedExecutor(
+    max_workers=SCHEDULER_MAX_CONCURRENCY * DOCKER_THREADS_PER_RUN
+    + DOCKER_THREADS_HEADROOM,
+    thread_name_prefix="docker",
+)
 
 
 # --- Pydantic Models ---
+class ResourceLimits(BaseModel):
+    memory_mb: int | None = Field(
+        None,
+        ge=SANDBOX_MIN_MEMORY_MB,
+        le=SANDBOX_MAX_MEMORY_MB,
+        description="Memory limit in MiB, swap included.",
+    )
+    cpus: float | None = Field(
+        None, gt=0, le=SANDBOX_MAX_CPUS, description="CPU quota in cores."
+    )
+    pids: int | None = Field(
+        None,
+        ge=SANDBOX_MIN_PIDS,
+        le=SANDBOX_MAX_PIDS,
+        description="Maximum number of processes and threads.",
+    )
+
+
 class CodeInput(BaseModel):
     code: str = Field(..., description="Python code to execute.")
+    priority: Literal["high", "normal", "low"] = Field(
+        "normal", description="Scheduling lane of the execution."
+    )
+    cache: bool = Field(
+        False,
+        description="Reuse the result of an identical earlier run. Only for "
+        "deterministic code.",
+    )
+    input: Any = Field(
+        None,
+        description="JSON value passed to the code as a file at $RUNNER_INPUT_PATH "
+        "instead of being embedded in the code.",
+    )
+    limits: ResourceLimits | None = Field(
+        None,
+        description="Resource limits of the run, each at most the server's cap. "
+        "Unset limits use the server defaults.",
+    )
+    timeout_seconds: float | None = Field(
+        None,
+        gt=0,
+        le=EXECUTION_MAX_TIMEOUT_SECONDS,
+        description="Time limit of the run, at most the server's cap. Defaults to "
+        "EXECUTION_TIMEOUT_SECONDS.",
+    )
+    run_id: str | None = Field(
+        None,
+        min_length=1,
+        max_length=64,
+        pattern=r"^[A-Za-z0-9_.-]+$",
+        description="ID to cancel the run with while it is queued or running. "
+        "Defaults to a random ID.",
+    )
+
+
+class ResourceUsage(BaseModel):
+    cpu_user_seconds: float | None = None
+    cpu_system_seconds: float | None = None
+    max_rss_bytes: int | None = Field(
+        None,
+        description="Peak resident set of the largest process, including libraries "
+        "the pooled worker preloaded.",
+    )
+    block_read_bytes: int | None = None
+    block_write_bytes: int | None = None
+    net_rx_bytes: int | None = None
+    net_tx_bytes: int | None = None
+    pids_peak: int | None = Field(
+        None, description="Most processes the run had at once, sampled."
+    )
+    oom_killed: bool | None = Field(
+        None, description="Whether a process was killed for running out of memory."
+    )
 
 
 class ExecutionResult(BaseModel):
+    run_id: str | None = None
     output: str | None = None
     exit_code: int | None = None
     error: str | None = None
-    duration_seconds: float | None = None
+    duration_seconds: float | None = Field(
+        None, description="Time spent running the code, excluding queueing."
+    )
+    queue_seconds: float | None = Field(
+        None, description="Time spent waiting for an execution slot."
+    )
+    output_truncated: bool = Field(
+        False, description="Whether output beyond MAX_OUTPUT_BYTES was dropped."
+    )
+    cache_hit: bool = Field(
+        False, description="Whether the result was served from the result cache."
+    )
+    result: Any = Field(
+        None,
+        description="JSON value the code wrote to $RUNNER_RESULT_PATH, if any.",
+    )
+    usage: ResourceUsage | None = Field(
+        None, description="Resources the run used, as measured in the sandbox."
+    )
+
+
+class BatchJob(CodeInput):
+    id: str | None = Field(
+        None, description="Identifies the job in the results. Defaults to its index."
+    )
+    max_output_bytes: int | None = Field(
+        None,
+        gt=0,
+        le=MAX_OUTPUT_BYTES,
+        description="Output kept for this job, at most the server's limit.",
+    )
+
+
+class BatchInput(BaseModel):
+    jobs: List[BatchJob] = Field(..., min_length=1, max_length=BATCH_MAX_JOBS)
+    stream: bool = Field(
+        False,
+        description="Send each result as a server-sent event as soon as it finishes.",
+    )
+
+
+class BatchJobResult(ExecutionResult):
+    id: str
+
+
+class BatchResult(BaseModel):
+    results: List[BatchJobResult]
 
 
 # Pydantic models for OpenAI Chat Completions Proxy
@@ -141,248 +712,3194 @@ class OpenAIChatCompletionsStreamResponse(BaseModel):
     choices: List[OpenAIChatChoiceDelta]
 
 
-# --- FastAPI Lifespan Management ---
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    logger.info("Application startup...")
-    try:
-        docker_client.images.get(DOCKER_IMAGE_NAME)
-        logger.info(f"Docker image '{DOCKER_IMAGE_NAME}' found.")
-    except ImageNotFound:
-        logger.warning(
-            f"Docker image '{DOCKER_IMAGE_NAME}' not found. Please build the image manually using the provided Dockerfile."
-        )
-    except APIError as e:
-        logger.error(f"Could not connect to Docker or other API error: {e}")
-        raise SystemExit(f"Docker API error: {e}")
+# --- Docker Backends ---
+# Both backends take and return the same things: containers are created from docker
+# SDK create() keyword arguments and come back as handles with `id` and `name`.
+def listed_container(container, attrs: dict) -> dict:
+    """An entry of list_containers() from the Engine API's container summary."""
+    names = attrs.get("Names") or [f"/{container.id[:12]}"]
+    return {
+        "container": container,
+        "name": names[0].lstrip("/"),
+        "state": attrs.get("State"),
+        "created_at": attrs.get("Created") or 0,
+        "mounts": attrs.get("Mounts") or [],
+    }
 
-    yield
-    logger.info("Application shutdown...")
 
+class SdkDocker:
+    """Docker SDK calls, each run on a docker_executor thread."""
 
-app = FastAPI(lifespan=lifespan)
+    def __init__(self, client: docker.DockerClient):
+        self.client = client
 
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,  # Allows cookies to be included in cross-origin requests
-    allow_methods=["*"],  # Allows all methods (GET, POST, PUT, DELETE, etc.)
-    allow_headers=["*"],  # Allows all headers
-)
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            docker_executor, functools.partial(fn, *args, **kwargs)
+        )
 
+    async def ping(self):
+        await self._call(self.client.ping)
 
-# --- Helper Function to Run Code in Docker ---
-async def run_code_in_docker(user_code: str) -> ExecutionResult:
-    # Create a temporary directory for the script on the host
-    # This directory will be automatically cleaned up when the 'with' block exits
-    with tempfile.TemporaryDirectory(prefix="code_executor_") as temp_dir_host:
-        script_path_host = os.path.join(temp_dir_host, "user_script.py")
-        script_path_container = "/app/user_script.py"  # Path inside container
+    async def image_id(self, image: str) -> str:
+        return (await self._call(self.client.images.get, image)).id
 
-        with open(script_path_host, "w", encoding="utf-8") as f:
-            f.write(user_code)
+    async def create(self, name: str, **options):
+        return await self._call(self.client.containers.create, name=name, **options)
 
-        container_name = f"executor_{os.urandom(8).hex()}"
-        container = None
-        start_time = asyncio.get_event_loop().time()
+    async def start(self, container):
+        await self._call(container.start)
 
-        try:
-            logger.info(
-                f"Running script in container {container_name} from image {DOCKER_IMAGE_NAME}"
-            )
-            # Run the container in a separate thread to avoid blocking asyncio event loop
-
-            loop = asyncio.get_event_loop()
-            container = await loop.run_in_executor(
-                None,
-                lambda: docker_client.containers.create(
-                    image=DOCKER_IMAGE_NAME,
-                    command=["python", script_path_container],
-                    volumes={
-                        script_path_host: {
-                            "bind": script_path_container,
-                            "mode": "ro",  # Read-only mount for security
-                        }
-                    },
-                    working_dir="/app",
-                    mem_limit="256m",  # Memory limit
-                    security_opt=["no-new-privileges"],  # Prevent privilege escalation
-                    cap_drop=["ALL"],  # Drop all Linux capabilities
-                    user=DOCKER_CONTAINER_USER,  # Run as non-root user defined in Dockerfile
-                    name=container_name,
+    async def wait(self, container) -> int:
+        return (await self._call(container.wait)).get("StatusCode", -1)
+
+    def logs(self, container) -> "BlockingStreamBridge":
+        bridge = BlockingStreamBridge()
+        for stream_name in ("stdout", "stderr"):
+            bridge.add(
+                stream_name,
+                lambda stream_name=stream_name: container.logs(
+                    stdout=stream_name == "stdout",
+                    stderr=stream_name == "stderr",
+                    stream=True,
+                    follow=True,
                 ),
             )
-            await loop.run_in_executor(None, container.start)
+        return bridge
 
-            # Wait for container to finish or timeout
-            try:
-                exit_info = await asyncio.wait_for(
-                    loop.run_in_executor(None, container.wait),
-                    timeout=EXECUTION_TIMEOUT_SECONDS,
-                )
-                exit_code = exit_info.get("StatusCode", -1)
-            except asyncio.TimeoutError:
-                logger.warning(
-                    f"Container {container_name} execution timed out after {EXECUTION_TIMEOUT_SECONDS}s. Killing."
-                )
-                await loop.run_in_executor(None, container.kill)
-                # Wait a bit for kill to take effect before trying to get logs
-                await asyncio.sleep(0.5)
-                return ExecutionResult(
-                    error="Execution timed out.",
-                    exit_code=-1,
-                    duration_seconds=asyncio.get_event_loop().time() - start_time,
-                )
+    async def kill(self, container):
+        await self._call(container.kill)
 
-            output_bytes = await loop.run_in_executor(
-                None, lambda: container.logs(stdout=True, stderr=True)
-            )
-            output = output_bytes.decode("utf-8", errors="replace")
+    async def remove(self, container):
+        await self._call(container.remove, force=True)
 
-            duration = asyncio.get_event_loop().time() - start_time
-            logger.info(
-                f"Container {container_name} finished. Exit code: {exit_code}, Duration: {duration}s"
+    async def put_archive(self, container, path: str, data: bytes):
+        await self._call(container.put_archive, path, data)
+
+    async def inspect(self, container) -> dict:
+        await self._call(container.reload)
+        return container.attrs
+
+    async def list_containers(self, label: str) -> list[dict]:
+        """Containers with the label, stopped ones included."""
+        containers = await self._call(
+            self.client.containers.list,
+            all=True,
+            sparse=True,  # Summaries only, without an inspect per container
+            filters={"label": label},
+        )
+        return [
+            listed_container(container, container.attrs) for container in containers
+        ]
+
+    async def attach(self, container):
+        """Attaches to stdin/stdout/stderr; returns (handle to keep, reader, writer)."""
+        socket_io = await self._call(
+            container.attach_socket,
+            params={"stdin": 1, "stdout": 1, "stderr": 1, "stream": 1},
+        )
+        sock = getattr(socket_io, "_sock", socket_io)
+        sock.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock=sock)
+        return socket_io, reader, writer
+
+
+class EngineContainer:
+    def __init__(self, container_id: str, name: str):
+        self.id = container_id
+        self.name = name
+
+
+class EngineLogStream:
+    """
+    Follows a container's multiplexed log stream over one connection. Same
+    interface as BlockingStreamBridge: get() returns (stream name, chunk), and
+    (stream name, None) for each stream once the log ends.
+    """
+
+    STREAM_HEADER = struct.Struct(">BxxxI")
+    STREAM_NAMES = {1: "stdout", 2: "stderr"}
+
+    def __init__(self, engine: "EngineDocker", container: EngineContainer):
+        self._engine = engine
+        self._container = container
+        self._response: httpx.Response | None = None
+        self._chunks = None
+        self._buffer = bytearray()
+        self._ended: list[str] | None = None
+
+    async def get(self) -> tuple:
+        if self._response is None:
+            self._response = await self._engine.request(
+                "GET",
+                f"/containers/{self._container.id}/logs",
+                params={"follow": 1, "stdout": 1, "stderr": 1},
+                stream=True,
             )
+            self._chunks = self._response.aiter_raw()
+        while True:
+            header_size = self.STREAM_HEADER.size
+            if len(self._buffer) >= header_size:
+                stream_type, size = self.STREAM_HEADER.unpack_from(self._buffer)
+                if len(self._buffer) >= header_size + size:
+                    data = bytes(self._buffer[header_size : header_size + size])
+                    del self._buffer[: header_size + size]
+                    if data:
+                        return self.STREAM_NAMES.get(stream_type, "stdout"), data
+                    continue
+            if self._ended is not None:
+                return (self._ended.pop(0) if self._ended else "stdout"), None
+            try:
+                self._buffer += await anext(self._chunks)
+            except StopAsyncIteration:
+                self._ended = ["stdout", "stderr"]
+
+    async def aclose(self):
+        if self._response is not None:
+            await self._response.aclose()
+
+
+class EngineDocker:
+    """
+    Talks to the Docker Engine API directly over httpx (a Unix socket or plain
+    tcp://). Waits and log streams are open requests on the event loop instead of
+    blocked threads, so concurrent runs are not limited by an executor's size.
+    """
+
+    HOST_CONFIG_OPTIONS = (
+        "mem_limit",
+        "memswap_limit",
+        "nano_cpus",
+        "pids_limit",
+        "security_opt",
+        "cap_drop",
+        "tmpfs",
+        "init",
+    )
+
+    def __init__(
+        self, docker_host: str = DOCKER_HOST, api_version: str = DOCKER_API_VERSION
+    ):
+        self.api_version = api_version
+        if docker_host.startswith("unix://"):
+            self._socket_path = docker_host[len("unix://") :]
+            self._address = None
+            transport = httpx.AsyncHTTPTransport(uds=self._socket_path)
+            base_url = "http://docker"
+        elif docker_host.startswith("tcp://"):
+            self._socket_path = None
+            host, _, port = docker_host[len("tcp://") :].rstrip("/").rpartition(":")
+            self._address = (host, int(port))
+            transport = httpx.AsyncHTTPTransport()
+            base_url = f"http://{host}:{port}"
+        else:
+            raise ValueError(f"Unsupported DOCKER_HOST for async mode: {docker_host}")
+        self.client = httpx.AsyncClient(
+            transport=transport,
+            base_url=f"{base_url}/v{api_version}",
+            timeout=DOCKER_API_TIMEOUT_SECONDS,
+            # Every running container holds a wait or log request open
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=32),
+        )
 
-            return ExecutionResult(
-                output=output,
-                exit_code=exit_code,
-                error=None,
-                duration_seconds=duration,
+    async def request(
+        self,
+        method: str,
+        path: str,
+        not_found=NotFound,
+        stream: bool = False,
+        **kwargs,
+    ) -> httpx.Response:
+        """Sends a request and raises the docker SDK's exceptions for errors."""
+        request = self.client.build_request(method, path, **kwargs)
+        try:
+            response = await self.client.send(request, stream=stream)
+        except httpx.TransportError as e:
+            raise APIError(f"Docker API request failed: {e!r}")
+        if response.is_error:
+            await response.aread()
+            await response.aclose()
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+            if response.status_code == 404:
+                raise not_found(message)
+            raise APIError(
+                f"{response.status_code} {response.reason_phrase}: {message}"
             )
-        except Exception as e:
+        return response
+
+    def create_body(self, options: dict) -> dict:
+        """Translates docker SDK create() keyword arguments into an API body."""
+        options = dict(options)
+        volumes = options.pop("volumes", None) or {}
+        host_config = docker.types.HostConfig(
+            version=self.api_version,
+            binds=volumes,
+            **{
+                key: options.pop(key)
+                for key in self.HOST_CONFIG_OPTIONS
+                if key in options
+            },
+        )
+        return docker.types.ContainerConfig(
+            version=self.api_version,
+            volumes=[spec["bind"] for spec in volumes.values()],
+            host_config=host_config,
+            **options,
+        )
+
+    async def ping(self):
+        await self.request("GET", "/_ping")
+
+    async def image_id(self, image: str) -> str:
+        response = await self.request(
+            "GET", f"/images/{image}/json", not_found=ImageNotFound
+        )
+        return response.json()["Id"]
+
+    async def create(self, name: str, **options) -> EngineContainer:
+        response = await self.request(
+            "POST",
+            "/containers/create",
+            params={"name": name},
+            json=self.create_body(options),
+            not_found=ImageNotFound,
+        )
+        return EngineContainer(response.json()["Id"], name)
+
+    async def start(self, container: EngineContainer):
+        await self.request("POST", f"/containers/{container.id}/start")
+
+    async def wait(self, container: EngineContainer) -> int:
+        # Answered by the daemon when the container exits
+        response = await self.request(
+            "POST",
+            f"/containers/{container.id}/wait",
+            timeout=httpx.Timeout(DOCKER_API_TIMEOUT_SECONDS, read=None),
+        )
+        return response.json().get("StatusCode", -1)
+
+    def logs(self, container: EngineContainer) -> EngineLogStream:
+        return EngineLogStream(self, container)
+
+    async def kill(self, container: EngineContainer):
+        await self.request("POST", f"/containers/{container.id}/kill")
+
+    async def remove(self, container: EngineContainer):
+        await self.request("DELETE", f"/containers/{container.id}", params={"force": 1})
+
+    async def put_archive(self, container: EngineContainer, path: str, data: bytes):
+        await self.request(
+            "PUT",
+            f"/containers/{container.id}/archive",
+            params={"path": path},
+            content=data,
+            headers={"Content-Type": "application/x-tar"},
+        )
+
+    async def inspect(self, container: EngineContainer) -> dict:
+        return (await self.request("GET", f"/containers/{container.id}/json")).json()
+
+    async def list_containers(self, label: str) -> list[dict]:
+        """Containers with the label, stopped ones included."""
+        response = await self.request(
+            "GET",
+            "/containers/json",
+            params={"all": 1, "filters": json.dumps({"label": [label]})},
+        )
+        return [
+            listed_container(EngineContainer(attrs["Id"], attrs["Names"][0][1:]), attrs)
+            for attrs in response.json()
+        ]
+
+    async def attach(self, container: EngineContainer):
+        """Attaches to stdin/stdout/stderr; returns (handle to keep, reader, writer)."""
+        # httpx cannot hand over an upgraded connection, so the request is raw
+        if self._socket_path:
+            reader, writer = await asyncio.open_unix_connection(self._socket_path)
+        else:
+            reader, writer = await asyncio.open_connection(*self._address)
+        writer.write(
+            (
+                f"POST /v{self.api_version}/containers/{container.id}/attach"
+                "?stream=1&stdin=1&stdout=1&stderr=1 HTTP/1.1\r\n"
+                "Host: docker\r\n"
+                "Connection: Upgrade\r\n"
+                "Upgrade: tcp\r\n"
+                "Content-Length: 0\r\n\r\n"
+            ).encode("ascii")
+        )
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        status_line = head.split(b"\r\n", 1)[0].decode("latin-1")
+        if status_line.split(" ")[1] not in ("101", "200"):
+            writer.close()
+            raise APIError(f"Could not attach to {container.name}: {status_line}")
+        return None, reader, writer
+
+
+def create_docker_backend(docker_host: str = DOCKER_HOST):
+    if DOCKER_CLIENT_MODE == "async":
+        logger.info(f"Using the async Docker Engine API client at {docker_host}.")
+        return EngineDocker(docker_host)
+    if docker_host == DOCKER_HOST:
+        try:
+            return SdkDocker(docker.from_env())
+        except docker.errors.DockerException as e:
             logger.error(
-                f"Unexpected error during Docker execution for {container_name}: {str(e)}",
-                exc_info=True,
+                f"Could not connect to Docker daemon: {e}. Please ensure Docker is running."
             )
-            duration = asyncio.get_event_loop().time() - start_time
-            return ExecutionResult(
-                output=None, exit_code=None, error=str(e), duration_seconds=duration
-            )
-        finally:
-            if container:
-                try:
-                    await loop.run_in_executor(
-                        None, lambda: container.remove(force=True)
-                    )
-                    logger.info(f"Container {container_name} removed.")
-                except NotFound:
-                    logger.info(
-                        f"Container {container_name} already removed or not found for removal."
-                    )
-                except APIError as e_rem:
-                    logger.error(f"Error removing container {container_name}: {e_rem}")
+            if len(DOCKER_HOSTS) == 1:
+                raise SystemExit(f"Docker connection failed: {e}")
+    # A fixed API version, as detecting it needs the daemon to be up right now
+    return SdkDocker(
+        docker.DockerClient(
+            base_url=docker_host,
+            version=DOCKER_API_VERSION,
+            timeout=int(DOCKER_API_TIMEOUT_SECONDS),
+        )
+    )
 
 
-# --- API Endpoint ---
-@app.post("/python-runner", response_model=ExecutionResult)
-async def execute_code_endpoint(payload: CodeInput):
+# --- Container Pool ---
+def resolve_limits(limits: ResourceLimits | None = None) -> ResourceLimits:
+    """The requested limits with the server defaults filled in."""
+    limits = limits or ResourceLimits()
+    return ResourceLimits(
+        memory_mb=limits.memory_mb or SANDBOX_MEMORY_MB,
+        cpus=limits.cpus or SANDBOX_CPUS,
+        pids=limits.pids or SANDBOX_PIDS,
+    )
+
+
+def sandbox_container_options(
+    io_dir: str | None, limits: ResourceLimits, tmpfs_app: bool = False
+) -> dict:
     """
-    Executes Python code in an isolated Docker container.
-    The environment includes `requests`, `matplotlib`, `numpy`.
-    The stdout and stderr are returned.
+    Security and resource options shared by every sandbox container. Without an
+    `io_dir` (a daemon on another machine) IO_DIR_CONTAINER is a tmpfs instead, and
+    with `tmpfs_app` so is /app, for code that arrives over the job channel.
     """
-    if not payload.code.strip():
-        raise HTTPException(status_code=400, detail="No code provided.")
+    tmpfs = {}
+    if tmpfs_app:
+        tmpfs["/app"] = f"size={APP_TMPFS_SIZE},mode=1777"
+    if io_dir is None:
+        tmpfs[IO_DIR_CONTAINER] = f"size={IO_TMPFS_SIZE},mode=1777"
+    options = {
+        "image": DOCKER_IMAGE_NAME,
+        "working_dir": "/app",
+        "mem_limit": f"{limits.memory_mb}m",  # Memory limit
+        "memswap_limit": f"{limits.memory_mb}m",  # No swap beyond it
+        "nano_cpus": int(limits.cpus * 1e9),  # CPU quota
+        "pids_limit": limits.pids,  # Stops fork bombs
+        "security_opt": ["no-new-privileges"],  # Prevent privilege escalation
+        "cap_drop": ["ALL"],  # Drop all Linux capabilities
+        "user": DOCKER_CONTAINER_USER,  # Run as non-root user defined in Dockerfile
+        "labels": {CONTAINER_INSTANCE_LABEL: SERVER_INSTANCE_ID},  # For the janitor
+        "environment": {
+            "RUNNER_INPUT_PATH": f"{IO_DIR_CONTAINER}/{INPUT_FILE_NAME}",
+            "RUNNER_RESULT_PATH": f"{IO_DIR_CONTAINER}/{RESULT_FILE_NAME}",
+        },
+    }
+    if io_dir:
+        options["volumes"] = {io_dir: {"bind": IO_DIR_CONTAINER, "mode": "rw"}}
+    if tmpfs:
+        options["tmpfs"] = tmpfs
+    return options
+
+
+def create_io_dir() -> str:
+    io_dir = tempfile.mkdtemp(prefix="code_executor_io_", dir=IO_DIR_BASE)
+    # The sandbox user must be able to create the result file
+    os.chmod(io_dir, 0o733)
+    return io_dir
+
+
+def clear_io_dir(io_dir: str):
+    for entry in os.scandir(io_dir):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def write_input_file(io_dir: str, value):
+    # O_EXCL and O_NOFOLLOW so a link planted by earlier code is never written through
+    fd = os.open(
+        os.path.join(io_dir, INPUT_FILE_NAME),
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+        0o644,
+    )
+    with open(fd, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
 
+
+def read_result_file(io_dir: str):
+    """
+    Returns the JSON value the code wrote to the result file, or None without one.
+    The file is mapped rather than read, and is never followed if it is a link.
+    """
     try:
-        result = await run_code_in_docker(payload.code)
-        if result.error and result.error.startswith(
-            "Docker API error:"
-        ):  # Critical Docker issue
-            raise HTTPException(status_code=503, detail=result.error)
-        return result
-    except Exception as e:
-        logger.error(
-            f"Unhandled exception in execute_code_endpoint: {str(e)}", exc_info=True
+        fd = os.open(
+            os.path.join(io_dir, RESULT_FILE_NAME),
+            os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK,
         )
-        raise HTTPException(
-            status_code=500, detail=f"An unexpected server error occurred: {str(e)}"
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        raise ValueError(f"Could not open the result file: {e.strerror}")
+    with open(fd, "rb") as f:
+        info = os.fstat(f.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            raise ValueError("The result file is not a regular file.")
+        if info.st_size > MAX_RESULT_BYTES:
+            raise ValueError(f"The result exceeds {MAX_RESULT_BYTES} bytes.")
+        if not info.st_size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                return json.loads(str(data, "utf-8"))
+            except ValueError as e:
+                raise ValueError(f"The result file is not valid JSON: {e}")
+
+
+def read_usage_file(io_dir: str) -> dict | None:
+    """Usage the worker wrote after a script run; None if it is missing or invalid."""
+    try:
+        fd = os.open(
+            os.path.join(io_dir, USAGE_FILE_NAME),
+            os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK,
         )
+    except OSError:
+        return None
+    with open(fd, "rb") as f:
+        if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            return None
+        try:
+            return json.loads(f.read(64 * 1024))
+        except ValueError:
+            return None
 
 
-# --- OpenAI Proxy Endpoint ---
-@app.post("/openai/chat/completions")
-async def proxy_openai_chat_completions(payload: OpenAIChatCompletionsRequest):
+def parse_usage(value) -> dict | None:
+    """Validates usage reported from inside the sandbox, dropping it if malformed."""
+    if not isinstance(value, dict):
+        return None
+    try:
+        return ResourceUsage.model_validate(value).model_dump()
+    except ValidationError:
+        return None
+
+
+class WorkerChannel:
     """
-    Proxies requests to OpenAI's Chat Completions API.
-    You need to have the OPENAI_API_KEY environment variable set.
+    Framed message channel to the job worker (docker/worker.py) over the
+    container's attached stdin/stdout. Frames are a 4-byte big-endian length
+    followed by a UTF-8 JSON object; Docker multiplexes the attached stdout and
+    stderr, so the stream headers are stripped before frames are parsed.
     """
-    if not OPENAI_API_KEY:
-        raise HTTPException(
-            status_code=503,
-            detail="OpenAI API key not configured on the server. Proxy is unavailable.",
-        )
 
-    try:
-        client = openai.AsyncOpenAI(
-            base_url=OPENAI_API_BASE_URL, api_key=OPENAI_API_KEY
-        )
+    FRAME_HEADER = struct.Struct(">I")
+    DOCKER_STREAM_HEADER = struct.Struct(">BxxxI")
+
+    def __init__(self, socket_io, reader: asyncio.StreamReader, writer):
+        self._socket_io = socket_io  # Keeps the hijacked HTTP connection alive
+        self._reader = reader
+        self._writer = writer
+        self._buffer = bytearray()
+        self._stream_header: tuple[int, int] | None = None
+        self.job_id: str | None = None  # Job sent to the worker and not finished
+        # False once the worker could not clear up after a job (see worker.py)
+        self.clean = True
+
+    @classmethod
+    async def open(cls, docker_api, container) -> "WorkerChannel":
+        return cls(*await docker_api.attach(container))
+
+    async def send(self, message: dict):
+        payload = json.dumps(message).encode("utf-8")
+        self._writer.write(self.FRAME_HEADER.pack(len(payload)) + payload)
+        await self._writer.drain()
+
+    async def receive(self) -> dict:
+        while True:
+            if len(self._buffer) >= self.FRAME_HEADER.size:
+                (size,) = self.FRAME_HEADER.unpack_from(self._buffer)
+                end = self.FRAME_HEADER.size + size
+                if len(self._buffer) >= end:
+                    payload = bytes(self._buffer[self.FRAME_HEADER.size : end])
+                    del self._buffer[:end]
+                    return json.loads(payload)
+            # Kept across reads so a cancelled receive leaves the stream in sync
+            if self._stream_header is None:
+                self._stream_header = self.DOCKER_STREAM_HEADER.unpack(
+                    await self._reader.readexactly(self.DOCKER_STREAM_HEADER.size)
+                )
+            stream_type, size = self._stream_header
+            data = await self._reader.readexactly(size)
+            self._stream_header = None
+            if stream_type == 1:  # stdout carries the frames
+                self._buffer += data
+            else:
+                logger.warning(
+                    f"Worker stderr: {data.decode('utf-8', errors='replace').rstrip()}"
+                )
 
-        if payload.stream:
-            # 流式响应
-            async def generate_stream():
-                try:
-                    # 构建请求参数
-                    request_params = {
-                        "model": payload.model or OPENAI_DEFAULT_MODEL,
-                        "messages": [
-                            msg.model_dump(exclude_none=True)
-                            for msg in payload.messages
-                        ],
-                        "max_tokens": MAX_TOKENS,
-                        "stream": True,
-                    }
-
-                    # 如果有 tools，添加到请求中
-                    if payload.tools:
-                        request_params["tools"] = [
-                            tool.model_dump() for tool in payload.tools
-                        ]
-
-                    # 如果有 tool_choice，添加到请求中
-                    if payload.tool_choice:
-                        request_params["tool_choice"] = payload.tool_choice
-
-                    stream = await client.chat.completions.create(**request_params)
-                    async for chunk in stream:
-                        chunk_data = chunk.model_dump()
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-                    yield "data: [DONE]\n\n"
-                except Exception as e:
-                    logger.error(
-                        f"Error in streaming response: {str(e)}", exc_info=True
-                    )
-                    error_data = {"error": str(e)}
-                    yield f"data: {json.dumps(error_data)}\n\n"
+    async def ping(self, timeout: float) -> bool:
+        try:
+            await self.send({"type": "ping"})
+            message = await asyncio.wait_for(self.receive(), timeout=timeout)
+            return message.get("type") == "pong"
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+
+    async def cancel_job(self, timeout: float) -> bool:
+        """Has the worker kill the current job; True once it confirmed in time."""
+        try:
+            await self.send({"type": "cancel", "id": self.job_id})
+            async with asyncio.timeout(timeout):
+                while (message := await self.receive()).get("type") != "exit":
+                    pass
+        except (OSError, asyncio.IncompleteReadError, TimeoutError):
+            return False
+        self.job_id = None
+        self.clean = self.clean and message.get("clean", False)
+        return True
+
+    def close(self):
+        self._writer.close()
+        if self._socket_io is None:
+            return
+        try:
+            self._socket_io.close()
+        except OSError:
+            pass
 
-            return StreamingResponse(
-                generate_stream(),
-                media_type="text/event-stream",
-                headers={"Cache-Control": "no-cache"},
-            )
-        else:
-            # 非流式响应
-            # 构建请求参数
-            request_params = {
-                "model": payload.model or OPENAI_DEFAULT_MODEL,
-                "messages": [
-                    msg.model_dump(exclude_none=True) for msg in payload.messages
-                ],
-                "max_tokens": MAX_TOKENS,
-            }
 
-            # 如果有 tools，添加到请求中
-            if payload.tools:
-                request_params["tools"] = [tool.model_dump() for tool in payload.tools]
+class PooledContainer:
+    def __init__(self, container, channel: WorkerChannel, io_dir: str | None):
+        self.container = container
+        self.channel = channel
+        self.io_dir = io_dir  # Host side of IO_DIR_CONTAINER, if this machine has it
+        self.lock = asyncio.Lock()  # One conversation with the worker at a time
+        self.runs = 0
+        self.created_at = time.monotonic()
+        self.discard = False  # Set by the lessee when the container must not be reused
+
+    @property
+    def name(self) -> str:
+        return self.container.name
+
+    @property
+    def age_seconds(self) -> float:
+        return time.monotonic() - self.created_at
 
-            # 如果有 tool_choice，添加到请求中
-            if payload.tool_choice:
-                request_params["tool_choice"] = payload.tool_choice
 
-            response = await client.chat.completions.create(**request_params)
-            return response.model_dump()
+class ContainerPool:
+    """
+    Keeps pre-started sandbox containers idle so runs can lease one instead of
+    paying the create/start/remove cycle. Each container runs the job worker, which
+    has the heavy libraries imported already and forks a fresh child per run, and
+    containers are recycled after CONTAINER_POOL_MAX_RUNS runs,
+    CONTAINER_POOL_MAX_AGE_SECONDS, or a run the worker could not clear up after.
+    Unless `shares_files`, the daemon is on another
+    machine and containers get no I/O directory here.
+    """
+
+    def __init__(
+        self,
+        docker_api: SdkDocker | EngineDocker,
+        shares_files: bool = True,
+        min_size: int = CONTAINER_POOL_MIN_SIZE,
+        max_size: int = CONTAINER_POOL_MAX_SIZE,
+        max_runs: int = CONTAINER_POOL_MAX_RUNS,
+        max_age_seconds: float = CONTAINER_POOL_MAX_AGE_SECONDS,
+        health_interval_seconds: float = CONTAINER_POOL_HEALTH_INTERVAL_SECONDS,
+    ):
+        self.docker = docker_api
+        self.shares_files = shares_files
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.max_runs = max_runs
+        self.max_age_seconds = max_age_seconds
+        self.health_interval_seconds = health_interval_seconds
+
+        self._idle: deque[PooledContainer] = deque()
+        self._size = 0  # Idle, leased and in-creation containers
+        self._leased = 0
+        self._cond = asyncio.Condition()
+        self._closed = False
+        self._tasks: set[asyncio.Task] = set()
+        self._health_task: asyncio.Task | None = None
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.created = 0
+        self.recycled = 0
+        self.unhealthy = 0
+        self.create_errors = 0
+
+    async def start(self):
+        await self._fill_to_min()
+        self._health_task = asyncio.create_task(self._health_loop())
+        logger.info(
+            f"Container pool started with {len(self._idle)} idle containers "
+            f"(min={self.min_size}, max={self.max_size})."
+        )
+
+    async def close(self):
+        self._closed = True
+        if self._health_task:
+            self._health_task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        async with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        await asyncio.gather(*(self._remove(pc) for pc in idle))
+        logger.info("Container pool closed.")
+
+    @asynccontextmanager
+    async def lease(self):
+        pc = await self._acquire()
+        try:
+            async with pc.lock:
+                yield pc
+        except (asyncio.CancelledError, GeneratorExit):
+            # Reusable if the worker stopped the job (see stream_worker_job)
+            pc.discard = pc.discard or pc.channel.job_id is not None
+            raise
+        except BaseException:
+            pc.discard = True
+            raise
+        finally:
+            self._spawn(self._release(pc))
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    def stats(self) -> dict:
+        leases = self.hits + self.misses
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "leased": self._leased,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / leases if leases else None,
+            "waits": self.waits,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_avg": self.wait_seconds_total / leases if leases else None,
+            "wait_seconds_max": self.wait_seconds_max,
+            "created": self.created,
+            "recycled": self.recycled,
+            "unhealthy": self.unhealthy,
+            "create_errors": self.create_errors,
+        }
+
+    async def _acquire(self) -> PooledContainer:
+        loop = asyncio.get_event_loop()
+        start_time = loop.time()
+        waited = False
+        must_create = False
+        async with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Container pool is closed.")
+                if self._idle:
+                    pc = self._idle.popleft()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    must_create = True
+                    break
+                waited = True
+                await self._cond.wait()
+            self._leased += 1
+
+        if must_create:
+            try:
+                pc = await self._create()
+            except BaseException:
+                async with self._cond:
+                    self._size -= 1
+                    self._leased -= 1
+                    self._cond.notify()
+                raise
+
+        wait_seconds = loop.time() - start_time
+        if must_create or waited:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if waited:
+            self.waits += 1
+        self.wait_seconds_total += wait_seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+        sandbox_phase_seconds.observe(wait_seconds, mode="pooled", phase="lease")
+        return pc
+
+    async def _release(self, pc: PooledContainer):
+        pc.runs += 1
+        reusable = (
+            not pc.discard
+            and pc.channel.clean
+            and not self._closed
+            and pc.runs < self.max_runs
+            and pc.age_seconds < self.max_age_seconds
+        )
+        async with self._cond:
+            self._leased -= 1
+            if reusable:
+                self._idle.append(pc)
+            else:
+                self._size -= 1
+            self._cond.notify()
+        if not reusable:
+            self.recycled += 1
+            await self._remove(pc)
+            await self._fill_to_min()
+
+    async def _create(self) -> PooledContainer:
+        container_name = f"executor_pool_{os.urandom(8).hex()}"
+        io_dir = create_io_dir() if self.shares_files else None
+        try:
+            with sandbox_phase_seconds.time(mode="pooled", phase="create"):
+                container = await self.docker.create(
+                    container_name,
+                    command=["python", WORKER_SCRIPT_CONTAINER],
+                    stdin_open=True,  # Job channel
+                    init=True,  # Reap processes orphaned by user code
+                    **sandbox_container_options(
+                        io_dir, resolve_limits(), tmpfs_app=True
+                    ),
+                )
+            channel = None
+            try:
+                with sandbox_phase_seconds.time(mode="pooled", phase="start"):
+                    await self.docker.start(container)
+                with sandbox_phase_seconds.time(mode="pooled", phase="ready"):
+                    channel = await WorkerChannel.open(self.docker, container)
+                    if not await channel.ping(WORKER_READY_TIMEOUT_SECONDS):
+                        raise RuntimeError(
+                            f"Worker in {container_name} did not become ready."
+                        )
+            except BaseException:
+                await self._remove(PooledContainer(container, channel, io_dir))
+                raise
+        except BaseException:
+            if io_dir:
+                shutil.rmtree(io_dir, ignore_errors=True)
+            self.create_errors += 1
+            raise
+        self.created += 1
+        logger.info(f"Pool container {container_name} created.")
+        return PooledContainer(container, channel, io_dir)
+
+    async def _remove(self, pc: PooledContainer):
+        if pc.channel:
+            pc.channel.close()
+        try:
+            with sandbox_phase_seconds.time(mode="pooled", phase="remove"):
+                await self.docker.remove(pc.container)
+            logger.info(f"Pool container {pc.name} removed.")
+        except NotFound:
+            logger.info(f"Pool container {pc.name} already removed or not found.")
+        except APIError as e:
+            logger.error(f"Error removing pool container {pc.name}: {e}")
+        if pc.io_dir:
+            shutil.rmtree(pc.io_dir, ignore_errors=True)
+
+    async def _is_healthy(self, pc: PooledContainer) -> bool:
+        if pc.age_seconds >= self.max_age_seconds:
+            return False
+        if pc.lock.locked():  # Leased right now, so it is in use
+            return True
+        async with pc.lock:
+            return await pc.channel.ping(WORKER_READY_TIMEOUT_SECONDS)
+
+    async def _fill_to_min(self):
+        while not self._closed:
+            async with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                pc = await self._create()
+            except Exception as e:
+                logger.error(f"Could not create pool container: {e}")
+                async with self._cond:
+                    self._size -= 1
+                return
+            async with self._cond:
+                self._idle.append(pc)
+                self._cond.notify()
+
+    async def _health_loop(self):
+        while not self._closed:
+            await asyncio.sleep(self.health_interval_seconds)
+            for pc in list(self._idle):
+                if await self._is_healthy(pc):
+                    continue
+                async with self._cond:
+                    if pc not in self._idle:  # Leased in the meantime
+                        continue
+                    self._idle.remove(pc)
+                    self._size -= 1
+                self.unhealthy += 1
+                logger.warning(f"Recycling unhealthy pool container {pc.name}.")
+                await self._remove(pc)
+            await self._fill_to_min()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+# --- Container Janitor ---
+class RunTracker:
+    """Counts sandbox runs in progress, so shutdown can wait for them to finish."""
+
+    def __init__(self):
+        self.active = 0
+        self.draining = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @contextmanager
+    def track(self):
+        self.active += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if not self.active:
+                self._idle.set()
+
+    async def drain(self, timeout_seconds: float) -> bool:
+        """Turns away new runs and waits for the others; False if some remain."""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout_seconds)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class ContainerJanitor:
+    """
+    Removes sandbox containers of this server instance that nothing will clean up:
+    all of them at startup (left behind by a crashed or killed process) and after
+    the shutdown deadline, and periodically the ones older than `max_age_seconds`
+    or stopped for longer than a run takes. Their I/O directories go as well, when
+    the daemon is on this machine (`shares_files`).
+    """
+
+    def __init__(
+        self,
+        docker_api: SdkDocker | EngineDocker,
+        shares_files: bool = True,
+        instance_id: str = SERVER_INSTANCE_ID,
+        max_age_seconds: float = CONTAINER_MAX_AGE_SECONDS,
+        interval_seconds: float = JANITOR_INTERVAL_SECONDS,
+    ):
+        self.docker = docker_api
+        self.shares_files = shares_files
+        self.label = f"{CONTAINER_INSTANCE_LABEL}={instance_id}"
+        self.max_age_seconds = max_age_seconds
+        self.interval_seconds = interval_seconds
+        # Cold containers are stopped briefly between exiting and being removed
+        self.stopped_grace_seconds = (
+            EXECUTION_MAX_TIMEOUT_SECONDS + WORKER_EXIT_GRACE_SECONDS + interval_seconds
+        )
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def reap_all(self, reason: str) -> int:
+        """Removes every container of this instance; returns how many."""
+        entries = await self.docker.list_containers(self.label)
+        await asyncio.gather(*(self._remove(entry, reason) for entry in entries))
+        return len(entries)
+
+    async def sweep(self) -> int:
+        """Removes containers past their maximum age or stopped for too long."""
+        now = time.time()
+        expired = []
+        for entry in await self.docker.list_containers(self.label):
+            age_seconds = now - entry["created_at"]
+            if age_seconds > self.max_age_seconds:
+                expired.append((entry, "max_age"))
+            elif (
+                entry["state"] not in ("running", "restarting")
+                and age_seconds > self.stopped_grace_seconds
+            ):
+                expired.append((entry, "stopped"))
+        await asyncio.gather(
+            *(self._remove(entry, reason) for entry, reason in expired)
+        )
+        return len(expired)
+
+    async def _remove(self, entry: dict, reason: str):
+        try:
+            await self.docker.remove(entry["container"])
+        except NotFound:
+            return
+        except APIError as e:
+            logger.error(f"Error removing container {entry['name']}: {e}")
+            return
+        sandbox_containers_reaped_total.inc(reason=reason)
+        logger.warning(f"Removed container {entry['name']} ({reason}).")
+        if not self.shares_files:
+            return
+        for mount in entry["mounts"]:
+            source = mount.get("Source") or ""
+            # Only directories created by create_io_dir
+            if (
+                mount.get("Destination") == IO_DIR_CONTAINER
+                and os.path.basename(source).startswith("code_executor_io_")
+                and os.path.realpath(os.path.dirname(source))
+                == os.path.realpath(IO_DIR_BASE)
+            ):
+                shutil.rmtree(source, ignore_errors=True)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.sweep()
+            except Exception as e:  # The daemon may be unreachable for a while
+                logger.error(f"Container janitor sweep failed: {e}")
+
+
+run_tracker = RunTracker()
+
+
+# --- Docker Hosts ---
+class NoDockerHostError(RuntimeError):
+    pass
+
+
+class DockerHost:
+    """
+    A Docker daemon that runs are placed on, with its own container pool and
+    janitor. A daemon behind a Unix socket is on this machine and shares its files,
+    so its containers bind-mount I/O directories; containers on other daemons get
+    their input and results over the job channel instead.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        docker_api: SdkDocker | EngineDocker,
+        max_runs: int = DOCKER_HOST_MAX_RUNS,
+    ):
+        self.url = url
+        self.docker = docker_api
+        self.shares_files = url.startswith("unix://")
+        self.max_runs = max_runs
+        self.janitor = ContainerJanitor(docker_api, self.shares_files)
+        self.pool: ContainerPool | None = None
+        self.image_id: str | None = None
+        self.active = 0  # Runs placed here and not finished
+        self.started = False
+        self.healthy = False
+        self.failures = 0  # Consecutive failed health checks
+        self.ejections = 0
+
+    @property
+    def load(self) -> float:
+        return self.active / max(self.max_runs, 1)
+
+    async def start(self):
+        """Removes orphans, looks up the image and fills the pool. Raises APIError
+        (or the client's connection error) when the daemon cannot be reached."""
+        reaped = await self.janitor.reap_all("orphan")
+        if reaped:
+            logger.warning(
+                f"Removed {reaped} containers left on {self.url} by an earlier run of "
+                f"instance '{SERVER_INSTANCE_ID}'."
+            )
+        self.janitor.start()
+        self.started = True
+        self.healthy = True
+        await self.find_image()
+
+    async def find_image(self):
+        try:
+            self.image_id = await self.docker.image_id(DOCKER_IMAGE_NAME)
+        except ImageNotFound:
+            logger.warning(
+                f"Docker image '{DOCKER_IMAGE_NAME}' not found on {self.url}. Please "
+                "build the image manually using the provided Dockerfile."
+            )
+            return
+        logger.info(f"Docker image '{DOCKER_IMAGE_NAME}' found on {self.url}.")
+        if CONTAINER_POOL_MAX_SIZE > 0:
+            self.pool = ContainerPool(self.docker, self.shares_files)
+            await self.pool.start()
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+        await self.janitor.close()
+        if self.started and self.healthy:
+            try:
+                await self.janitor.reap_all("shutdown")  # Runs cut off by the deadline
+            except Exception as e:
+                logger.error(
+                    f"Could not remove remaining containers on {self.url}: {e}"
+                )
+
+    async def check_health(self):
+        """Pings the daemon; ejects the host after DOCKER_HOST_MAX_FAILURES failed
+        checks in a row and takes it back after a successful one."""
+        try:
+            await asyncio.wait_for(self.docker.ping(), DOCKER_API_TIMEOUT_SECONDS)
+            if not self.started:  # Was down at startup
+                await self.start()
+            elif self.image_id is None:  # Built since
+                await self.find_image()
+        except Exception as e:
+            self.failures += 1
+            if self.healthy and self.failures >= DOCKER_HOST_MAX_FAILURES:
+                self.healthy = False
+                self.ejections += 1
+                logger.error(f"Ejecting Docker host {self.url}: {e!r}")
+            return
+        if not self.healthy:
+            logger.info(f"Docker host {self.url} is healthy again.")
+        self.healthy = True
+        self.failures = 0
+
+    @contextmanager
+    def run_slot(self):
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "image_found": self.image_id is not None,
+            "active_runs": self.active,
+            "max_runs": self.max_runs,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "container_pool": self.pool.stats() if self.pool else None,
+        }
+
+
+class DockerHostSet:
+    """
+    Places runs on the Docker hosts: among the healthy ones with the image, a run
+    goes to the least loaded host that is below its DOCKER_HOST_MAX_RUNS, one with
+    an idle pooled container first when the run can use the pool. A background
+    loop health-checks every host.
+    """
+
+    def __init__(self, hosts: list[DockerHost]):
+        self.hosts = hosts
+        self._health_task: asyncio.Task | None = None
+
+    async def start(self):
+        async def start_host(host: DockerHost):
+            try:
+                await host.start()
+            except Exception as e:
+                logger.error(f"Could not connect to Docker host {host.url}: {e!r}")
+
+        await asyncio.gather(*(start_host(host) for host in self.hosts))
+        if not any(host.healthy for host in self.hosts):
+            raise SystemExit("Docker API error: no Docker host could be reached.")
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._health_task
+            self._health_task = None
+        await asyncio.gather(*(host.close() for host in self.hosts))
+
+    @property
+    def image_id(self) -> str | None:
+        """The image of the first host that has it; every host should run the same."""
+        return next((host.image_id for host in self.hosts if host.image_id), None)
+
+    def choose(self, pooled: bool) -> DockerHost:
+        candidates = [host for host in self.hosts if host.healthy and host.image_id]
+        if not candidates:
+            raise NoDockerHostError("No healthy Docker host with the runner image.")
+        return min(
+            candidates,
+            key=lambda host: (
+                host.active >= host.max_runs,
+                not (pooled and host.pool and host.pool.idle_count),
+                host.load,
+            ),
+        )
+
+    def stats(self) -> list[dict]:
+        return [host.stats() for host in self.hosts]
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(DOCKER_HOST_HEALTH_INTERVAL_SECONDS)
+            await asyncio.gather(*(host.check_health() for host in self.hosts))
+
+
+docker_hosts = DockerHostSet(
+    [DockerHost(url, create_docker_backend(url)) for url in DOCKER_HOSTS]
+)
+
+
+# --- Execution Scheduler ---
+class SchedulerFullError(Exception):
+    def __init__(self, message: str, retry_after_seconds: int):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+
+class ExecutionScheduler:
+    """
+    Admission control for sandbox runs. At most `max_concurrency` runs execute at
+    once; the rest wait in priority lanes, and within a lane clients are served
+    round-robin so one busy client cannot starve the others. Requests beyond the
+    queue limits are rejected so callers can back off instead of piling up.
+    """
+
+    PRIORITIES = ("high", "normal", "low")
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        max_queue_depth: int = SCHEDULER_MAX_QUEUE_DEPTH,
+        max_queue_per_client: int = SCHEDULER_MAX_QUEUE_PER_CLIENT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_per_client = max_queue_per_client
+
+        self._running = 0
+        # priority -> client id -> waiting futures; dict order is the round-robin
+        self._lanes: dict[str, dict[str, deque[asyncio.Future]]] = {
+            priority: {} for priority in self.PRIORITIES
+        }
+        self._queued = 0
+
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_seconds_total = 0.0
+        self.queue_seconds_max = 0.0
+        self.run_seconds_total = 0.0
+
+    @asynccontextmanager
+    async def slot(self, client_id: str, priority: str = "normal"):
+        """Waits for a run slot and yields the seconds spent queueing."""
+        loop = asyncio.get_event_loop()
+        queued_at = loop.time()
+        if self._running < self.max_concurrency and not self._queued:
+            self._running += 1
+        else:
+            await self._wait_in_queue(client_id, priority)
+        queue_seconds = loop.time() - queued_at
+        self.admitted += 1
+        self.queue_seconds_total += queue_seconds
+        self.queue_seconds_max = max(self.queue_seconds_max, queue_seconds)
+
+        started_at = loop.time()
+        try:
+            yield queue_seconds
+        finally:
+            self.run_seconds_total += loop.time() - started_at
+            self._running -= 1
+            self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "queued": self._queued,
+            "queued_by_priority": {
+                priority: sum(len(waiters) for waiters in lane.values())
+                for priority, lane in self._lanes.items()
+            },
+            "max_concurrency": self.max_concurrency,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_seconds_avg": (
+                self.queue_seconds_total / self.admitted if self.admitted else None
+            ),
+            "queue_seconds_max": self.queue_seconds_max,
+        }
+
+    def _retry_after_seconds(self) -> int:
+        completed = self.admitted - self._running
+        avg_run_seconds = self.run_seconds_total / completed if completed > 0 else 1.0
+        backlog = (self._queued + 1) / max(self.max_concurrency, 1)
+        return max(1, math.ceil(avg_run_seconds * backlog))
+
+    def check_admission(self, client_id: str, priority: str = "normal", count: int = 1):
+        """Raises SchedulerFullError if `count` runs would be rejected right now."""
+        free_slots = 0 if self._queued else self.max_concurrency - self._running
+        queueing = count - max(free_slots, 0)
+        if queueing <= 0:
+            return
+        waiters = self._lanes[priority].get(client_id)
+        if self._queued + queueing > self.max_queue_depth:
+            self.rejected += 1
+            raise SchedulerFullError(
+                "Execution queue is full.", self._retry_after_seconds()
+            )
+        if waiters and len(waiters) + queueing > self.max_queue_per_client:
+            self.rejected += 1
+            raise SchedulerFullError(
+                "Too many queued executions for this client.",
+                self._retry_after_seconds(),
+            )
+
+    async def _wait_in_queue(self, client_id: str, priority: str):
+        self.check_admission(client_id, priority)
+        lane = self._lanes[priority]
+        waiters = lane.get(client_id)
+        future = asyncio.get_event_loop().create_future()
+        if waiters is None:
+            waiters = lane[client_id] = deque()
+        waiters.append(future)
+        self._queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted right before the cancellation; pass it on
+                self._running -= 1
+                self._dispatch()
+            else:
+                self._remove_waiter(priority, client_id, future)
+            raise
+
+    def _remove_waiter(self, priority: str, client_id: str, future: asyncio.Future):
+        lane = self._lanes[priority]
+        waiters = lane.get(client_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self._queued -= 1
+            if not waiters:
+                del lane[client_id]
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._queued:
+            for priority in self.PRIORITIES:
+                lane = self._lanes[priority]
+                if lane:
+                    break
+            client_id = next(iter(lane))
+            waiters = lane.pop(client_id)
+            future = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                lane[client_id] = waiters  # Back of the round-robin
+            if not future.done():
+                self._running += 1
+                future.set_result(None)
+
+
+execution_scheduler = ExecutionScheduler()
+
+
+# --- Result Caches ---
+def cache_key(value) -> str:
+    """Content hash of a JSON-serializable value."""
+    payload = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    LRU cache for JSON-serializable values with a per-entry TTL and a byte budget.
+    When `disk_dir` is set, entries are also written to disk so they survive
+    restarts and memory evictions; disk hits are promoted back into memory. Disk
+    work runs on worker threads, so the disk byte count and the eviction and
+    expiration counters are only changed under `_lock`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int,
+        max_bytes: int,
+        ttl_seconds: float,
+        disk_dir: str | None = None,
+        disk_max_bytes: int = 0,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self._entries: OrderedDict[str, tuple[float, int, object]] = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+        # Metrics
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry:
+            expires_at, size, value = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return value
+            self._drop(key)
+            with self._lock:
+                self.expirations += 1
+
+        if self.disk_dir:
+            stored = await asyncio.to_thread(self._read_disk, key)
+            if stored:
+                expires_at, value = stored
+                self._store_in_memory(key, value, expires_at)
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value, ttl_seconds: float | None = None):
+        expires_at = time.time() + (ttl_seconds or self.ttl_seconds)
+        size = self._store_in_memory(key, value, expires_at)
+        self.stores += 1
+        if self.disk_dir and size <= self.disk_max_bytes:
+            try:
+                await asyncio.to_thread(self._write_disk, key, value, expires_at)
+            except OSError as e:  # The entry is still cached in memory
+                logger.warning(f"Could not write {self.name} cache entry to disk: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "disk_bytes": self._disk_bytes if self.disk_dir else None,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                (self.memory_hits + self.disk_hits) / lookups if lookups else None
+            ),
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _store_in_memory(self, key: str, value, expires_at: float) -> int:
+        size = len(json.dumps(value, default=str))
+        if key in self._entries:
+            self._drop(key)
+        if size > self.max_bytes:
+            return size
+        self._entries[key] = (expires_at, size, value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            with self._lock:
+                self.evictions += 1
+        return size
+
+    def _drop(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.disk_dir):
+            for file_name in files:
+                if file_name.endswith(".tmp"):
+                    continue  # Being written; not counted until it is in place
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _read_disk(self, key: str):
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored["expires_at"] <= time.time():
+            with self._lock:
+                if self._delete_disk_file(path):
+                    self.expirations += 1
+            return None
+        return stored["expires_at"], stored["value"]
+
+    def _write_disk(self, key: str, value, expires_at: float):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = json.dumps({"expires_at": expires_at, "value": value}, default=str)
+        temp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+            with self._lock:
+                try:
+                    self._disk_bytes -= os.path.getsize(path)
+                except OSError:
+                    pass  # A new entry
+                os.replace(temp_path, path)  # Readers never see a partial entry
+                self._disk_bytes += len(payload)
+                if self._disk_bytes > self.disk_max_bytes:
+                    self._evict_disk()
+        finally:
+            with suppress(OSError):
+                os.unlink(temp_path)  # Left only if the write failed
+
+    def _evict_disk(self):
+        """Called with `_lock` held."""
+        # Oldest entries go first until the tier is back under budget
+        for path, size, _ in sorted(self._disk_files(), key=lambda f: f[2]):
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            if self._delete_disk_file(path):
+                self.evictions += 1
+
+    def _delete_disk_file(self, path: str) -> bool:
+        """Called with `_lock` held; True if the file was there to delete."""
+        try:
+            size = os.path.getsize(path)
+            os.unlink(path)
+        except OSError:
+            return False
+        self._disk_bytes -= size
+        return True
+
+
+result_cache = TieredCache(
+    "python-runner",
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=RESULT_CACHE_MAX_BYTES,
+    ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+    disk_dir=RESULT_CACHE_DIR or None,
+    disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES,
+)
+llm_cache = TieredCache(
+    "openai",
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    max_bytes=LLM_CACHE_MAX_BYTES,
+    ttl_seconds=LLM_CACHE_TTL_SECONDS,
+    disk_dir=LLM_CACHE_DIR or None,
+    disk_max_bytes=LLM_CACHE_DISK_MAX_BYTES,
+)
+
+
+def execution_cache_key(
+    code: str,
+    timeout_seconds: float = EXECUTION_TIMEOUT_SECONDS,
+    max_output_bytes: int = MAX_OUTPUT_BYTES,
+    input_data=None,
+    limits: ResourceLimits | None = None,
+) -> str | None:
+    docker_image_id = docker_hosts.image_id  # Resolved at startup
+    if not docker_image_id:
+        return None
+    return cache_key(
+        {
+            "code": code,
+            "input": input_data,
+            "image": docker_image_id,
+            "limits": {
+                **resolve_limits(limits).model_dump(),
+                "timeout_seconds": timeout_seconds,
+                "max_output_bytes": max_output_bytes,
+            },
+        }
+    )
+
+
+# --- Request Coalescing ---
+class InFlightCall:
+    """An upstream call shared by every request that asked for the same thing."""
+
+    def __init__(self):
+        self.items: list = []
+        self.error: Exception | None = None
+        self.done = False
+        self.waiters = 0
+        self.total_waiters = 0
+        self.task: asyncio.Task | None = None
+        self.updated = asyncio.Event()
+
+    def notify(self):
+        # Swap the event first so waiters that wake up wait on a fresh one
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+
+class SingleFlight:
+    """
+    Merges concurrent identical calls onto one upstream call. The first caller for
+    a key starts the call in a background task; later callers replay the items it
+    has produced so far and then follow it live. The call is cancelled once every
+    caller has gone away.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, InFlightCall] = {}
+
+        # Metrics
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self.cancelled = 0
+        self.tokens_saved = 0
+
+    async def stream(
+        self,
+        key: str,
+        produce: Callable[[], AsyncIterator],
+        on_complete: Callable[[list], Awaitable] | None = None,
+    ) -> AsyncIterator:
+        """Yields the items of the call for `key`, starting it if none is running."""
+        call = self._calls.get(key)
+        if call is None:
+            call = InFlightCall()
+            self._calls[key] = call
+            call.task = asyncio.create_task(self._run(key, call, produce, on_complete))
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        call.total_waiters += 1
+        self.max_waiters = max(self.max_waiters, call.waiters)
+
+        try:
+            index = 0
+            while True:
+                updated = call.updated
+                while index < len(call.items):
+                    yield call.items[index]
+                    index += 1
+                if call.done:
+                    if call.error:
+                        raise call.error
+                    return
+                await updated.wait()
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.done:
+                # Nobody is listening any more, so stop paying for the call
+                self._forget(key, call)
+                call.task.cancel()
+                self.cancelled += 1
+
+    def stats(self) -> dict:
+        requests = self.upstream_calls + self.coalesced
+        return {
+            "in_flight": len(self._calls),
+            "waiters": sum(call.waiters for call in self._calls.values()),
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+            "dedup_rate": self.coalesced / requests if requests else None,
+            "max_waiters": self.max_waiters,
+            "cancelled": self.cancelled,
+            "tokens_saved": self.tokens_saved,
+        }
+
+    async def _run(
+        self,
+        key: str,
+        call: InFlightCall,
+        produce: Callable[[], AsyncIterator],
+        on_complete: Callable[[list], Awaitable] | None,
+    ):
+        try:
+            async for item in produce():
+                call.items.append(item)
+                call.notify()
+            if on_complete:
+                await on_complete(call.items)
+        except Exception as e:
+            call.error = e
+        finally:
+            self._forget(key, call)
+            call.done = True
+            call.notify()
+
+        usage = call.items[-1].get("usage") if call.items and not call.error else None
+        if usage:
+            self.tokens_saved += usage.get("total_tokens", 0) * (call.total_waiters - 1)
+
+    def _forget(self, key: str, call: InFlightCall):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+llm_single_flight = SingleFlight()
+
+
+# --- OpenAI Client ---
+openai_client: openai.AsyncOpenAI | None = None
+openai_http_client: httpx.AsyncClient | None = None
+
+
+class UpstreamRequestStats:
+    """
+    Counts upstream requests through httpx event hooks. httpx has no public view of
+    its connection pool, so this reports what the requests themselves show: how
+    many were sent and which HTTP version answered them.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.responses_by_http_version: dict[str, int] = {}
+
+    async def on_request(self, request: httpx.Request):
+        self.requests += 1
+
+    async def on_response(self, response: httpx.Response):
+        version = response.http_version
+        self.responses_by_http_version[version] = (
+            self.responses_by_http_version.get(version, 0) + 1
+        )
+
+
+openai_request_stats = UpstreamRequestStats()
+
+
+def create_openai_client() -> openai.AsyncOpenAI:
+    """One application-wide client so upstream connections and TLS sessions are
+    reused."""
+    global openai_http_client
+    openai_http_client = httpx.AsyncClient(
+        http2=OPENAI_HTTP2,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(
+            OPENAI_READ_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS
+        ),
+        event_hooks={
+            "request": [openai_request_stats.on_request],
+            "response": [openai_request_stats.on_response],
+        },
+    )
+    return openai.AsyncOpenAI(
+        base_url=OPENAI_API_BASE_URL,
+        api_key=OPENAI_API_KEY,
+        http_client=openai_http_client,
+    )
+
+
+def openai_pool_stats() -> dict | None:
+    if not openai_http_client:
+        return None
+    return {
+        "http2": OPENAI_HTTP2,
+        "max_connections": OPENAI_MAX_CONNECTIONS,
+        "max_keepalive_connections": OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        "requests": openai_request_stats.requests,
+        "responses_by_http_version": dict(
+            openai_request_stats.responses_by_http_version
+        ),
+    }
+
+
+# --- FastAPI Lifespan Management ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global openai_client
+    logger.info("Application startup...")
+    await docker_hosts.start()
+
+    if OPENAI_API_KEY:
+        openai_client = create_openai_client()
+
+    yield
+    logger.info("Application shutdown...")
+    if not await run_tracker.drain(SHUTDOWN_DRAIN_SECONDS):
+        logger.warning(
+            f"{run_tracker.active} runs still in progress after "
+            f"{SHUTDOWN_DRAIN_SECONDS}s; removing their containers."
+        )
+    if openai_client:
+        await openai_client.close()
+        openai_client = None
+    await docker_hosts.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Add CORS middleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Allows all origins
+    allow_credentials=True,  # Allows cookies to be included in cross-origin requests
+    allow_methods=["*"],  # Allows all methods (GET, POST, PUT, DELETE, etc.)
+    allow_headers=["*"],  # Allows all headers
+)
+
+
+# --- Helper Function to Run Code in Docker ---
+class OutputLimiter:
+    """Caps the output kept for a run so a chatty script cannot exhaust memory."""
+
+    def __init__(self, max_bytes: int = MAX_OUTPUT_BYTES):
+        self.remaining = max_bytes
+        self.truncated = False
+
+    def take(self, data: str) -> str:
+        if self.remaining <= 0:
+            self.truncated = self.truncated or bool(data)
+            return ""
+        encoded = data.encode("utf-8")
+        if len(encoded) <= self.remaining:
+            self.remaining -= len(encoded)
+            return data
+        self.truncated = True
+        kept = encoded[: self.remaining].decode("utf-8", errors="ignore")
+        self.remaining = 0
+        return kept
+
+
+class BlockingStreamBridge:
+    """
+    Feeds blocking iterators (e.g. Docker log streams) from executor threads into
+    one asyncio queue. At most `max_buffered` items are in flight, so a slow
+    consumer applies backpressure to the threads instead of growing the queue.
+    """
+
+    def __init__(self, max_buffered: int = 64):
+        self._loop = asyncio.get_event_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._slots = threading.Semaphore(max_buffered)
+        self._closed = threading.Event()
+
+    def add(self, name: str, make_iterator):
+        self._loop.run_in_executor(docker_executor, self._pump, name, make_iterator)
+
+    async def get(self) -> tuple:
+        """Returns (name, item); item is None once that iterator is exhausted."""
+        name, item = await self._queue.get()
+        if item is not None:
+            self._slots.release()
+        return name, item
+
+    def close(self):
+        self._closed.set()
+
+    async def aclose(self):
+        self.close()
+
+    def _pump(self, name: str, make_iterator):
+        try:
+            for item in make_iterator():
+                while not self._slots.acquire(timeout=0.5):
+                    if self._closed.is_set():
+                        return
+                if self._closed.is_set():
+                    return
+                self._put(name, item)
+        except Exception as e:
+            if not self._closed.is_set():
+                logger.warning(f"Stream {name} ended with an error: {e}")
+        finally:
+            self._put(name, None)
+
+    def _put(self, name: str, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (name, item))
+        except RuntimeError:  # Event loop already closed
+            pass
+
+
+async def stream_code_in_docker(
+    user_code: str,
+    timeout_seconds: float = EXECUTION_TIMEOUT_SECONDS,
+    max_output_bytes: int = MAX_OUTPUT_BYTES,
+    input_data=None,
+    limits: ResourceLimits | None = None,
+) -> AsyncIterator[dict]:
+    """
+    Runs code in the sandbox and yields events as they happen:
+    `{"type": "stdout" | "stderr", "data": str}` chunks followed by one
+    `{"type": "exit", "exit_code", "error", "duration_seconds", "output_truncated",
+    "result", "usage"}`. Output beyond `max_output_bytes` is dropped. `input_data`
+    is written to the input file and `result` is read from the result file.
+    """
+    if run_tracker.draining:
+        yield {**exit_event(None, SHUTDOWN_ERROR, 0.0), "output_truncated": False}
+        return
+
+    limits = resolve_limits(limits)
+    # Pooled containers are created with the default limits
+    pooled = limits == resolve_limits()
+    try:
+        host = docker_hosts.choose(pooled)
+    except NoDockerHostError as e:
+        yield {**exit_event(None, str(e), 0.0), "output_truncated": False}
+        return
+
+    if host.pool and pooled:
+        mode = "pooled"
+        events = stream_code_in_pooled_container(
+            host.pool, user_code, timeout_seconds, input_data
+        )
+    else:
+        mode = "cold"
+        events = stream_code_in_new_container(
+            host, user_code, timeout_seconds, input_data, limits
+        )
+
+    limiter = OutputLimiter(max_output_bytes)
+    with run_tracker.track(), host.run_slot():
+        async with aclosing(events):
+            async for event in events:
+                if event["type"] == "exit":
+                    event["output_truncated"] = limiter.truncated
+                    record_run_metrics(mode, event)
+                    yield event
+                    continue
+                data = limiter.take(event["data"])
+                if data:
+                    yield {"type": event["type"], "data": data}
+
+
+async def run_code_in_docker(
+    user_code: str,
+    timeout_seconds: float = EXECUTION_TIMEOUT_SECONDS,
+    max_output_bytes: int = MAX_OUTPUT_BYTES,
+    input_data=None,
+    limits: ResourceLimits | None = None,
+) -> ExecutionResult:
+    output_parts = []
+    result = None
+    async for event in stream_code_in_docker(
+        user_code, timeout_seconds, max_output_bytes, input_data, limits
+    ):
+        if event["type"] == "exit":
+            result = ExecutionResult(
+                output="".join(output_parts) if event["error"] is None else None,
+                exit_code=event["exit_code"],
+                error=event["error"],
+                duration_seconds=event["duration_seconds"],
+                output_truncated=event["output_truncated"],
+                result=event["result"],
+                usage=event["usage"],
+            )
+        else:
+            output_parts.append(event["data"])
+    if result is None:
+        raise RuntimeError("Execution ended without an exit status.")
+    return result
+
+
+TIMEOUT_ERROR = "Execution timed out."
+SHUTDOWN_ERROR = "Server is shutting down."
+
+
+def record_run_metrics(mode: str, event: dict):
+    exit_code = event["exit_code"]
+    if event["error"] == TIMEOUT_ERROR:
+        outcome = "timeout"
+    elif event["error"] is not None:
+        outcome = "error"
+    else:
+        outcome = "ok" if exit_code == 0 else "failed"
+        sandbox_exit_codes_total.inc(exit_code=exit_code)
+    sandbox_runs_total.inc(mode=mode, outcome=outcome)
+    sandbox_run_seconds.observe(event["duration_seconds"], mode=mode)
+
+    usage = event["usage"]
+    if not usage:
+        return
+    if (
+        usage["cpu_user_seconds"] is not None
+        and usage["cpu_system_seconds"] is not None
+    ):
+        sandbox_cpu_seconds.observe(
+            usage["cpu_user_seconds"] + usage["cpu_system_seconds"], mode=mode
+        )
+    if usage["max_rss_bytes"] is not None:
+        sandbox_max_rss_bytes.observe(usage["max_rss_bytes"], mode=mode)
+    if usage["pids_peak"] is not None:
+        sandbox_pids_peak.observe(usage["pids_peak"], mode=mode)
+    for kind in ("block_read", "block_write", "net_rx", "net_tx"):
+        if usage[f"{kind}_bytes"]:
+            sandbox_io_bytes_total.inc(usage[f"{kind}_bytes"], mode=mode, kind=kind)
+    if usage["oom_killed"]:
+        sandbox_oom_kills_total.inc(mode=mode)
+
+
+def exit_event(
+    exit_code: int | None,
+    error: str | None,
+    duration_seconds: float | None,
+    result=None,
+    usage: dict | None = None,
+) -> dict:
+    return {
+        "type": "exit",
+        "exit_code": exit_code,
+        "error": error,
+        "duration_seconds": duration_seconds,
+        "result": result,
+        "usage": usage,
+    }
+
+
+def prepare_io_dir(io_dir: str, input_data):
+    clear_io_dir(io_dir)
+    if input_data is not None:
+        write_input_file(io_dir, input_data)
+
+
+async def finished_exit_event(
+    io_dir: str, exit_code: int, duration: float, usage: dict | None = None
+) -> dict:
+    """Exit event of a run that finished, with the result file it left behind."""
+    try:
+        result = await asyncio.to_thread(read_result_file, io_dir)
+    except ValueError as e:
+        return exit_event(exit_code, str(e), duration, usage=usage)
+    return exit_event(exit_code, None, duration, result, usage)
+
+
+def reported_exit_event(
+    message: dict, exit_code: int, duration: float, usage: dict | None = None
+) -> dict:
+    """Exit event of a run whose worker sent the result file back, for a container
+    without a host IO dir."""
+    if message.get("result_error"):
+        return exit_event(exit_code, message["result_error"], duration, usage=usage)
+    if not message.get("result"):
+        return exit_event(exit_code, None, duration, usage=usage)
+    try:
+        result = json.loads(message["result"])
+    except ValueError as e:
+        error = f"The result file is not valid JSON: {e}"
+        return exit_event(exit_code, error, duration, usage=usage)
+    return exit_event(exit_code, None, duration, result, usage)
+
+
+class WorkerUnresponsiveError(RuntimeError):
+    pass
+
+
+async def stream_worker_job(
+    channel: WorkerChannel,
+    container_name: str,
+    io_dir: str | None,
+    user_code: str,
+    timeout_seconds: float,
+    start_time: float,
+    mode: str,
+    input_data=None,
+) -> AsyncIterator[dict]:
+    """
+    Sends one job to a container's worker and yields its output events, then the
+    exit event. Raises RuntimeError if the worker fails, or WorkerUnresponsiveError
+    if it stops answering; the container must not run more jobs after either.
+    Without an `io_dir` the input and result files travel over the channel.
+    """
+    loop = asyncio.get_event_loop()
+    job_id = os.urandom(8).hex()
+    run_started_at = loop.time()
+    logger.info(f"Running job {job_id} in container {container_name}")
+    job = {
+        "type": "run",
+        "id": job_id,
+        "code": user_code,
+        "timeout": timeout_seconds,
+    }
+    if io_dir is None:
+        job["max_result_bytes"] = MAX_RESULT_BYTES
+        if input_data is not None:
+            job["input"] = input_data
+    await channel.send(job)
+    channel.job_id = job_id
+
+    # The worker enforces the timeout itself; the grace period only covers
+    # a worker that stopped responding.
+    deadline = start_time + timeout_seconds + WORKER_EXIT_GRACE_SECONDS
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    channel.receive(), timeout=max(deadline - loop.time(), 0)
+                )
+            except asyncio.TimeoutError:
+                raise WorkerUnresponsiveError(
+                    f"Worker in container {container_name} stopped responding."
+                )
+            message_type = message.get("type")
+            if message_type in ("stdout", "stderr"):
+                yield {"type": message_type, "data": message["data"]}
+            elif message_type == "error":
+                raise RuntimeError(f"Worker error: {message.get('message')}")
+            elif message_type == "exit":
+                channel.job_id = None
+                channel.clean = channel.clean and message.get("clean", False)
+                duration = loop.time() - start_time
+                sandbox_phase_seconds.observe(
+                    loop.time() - run_started_at, mode=mode, phase="run"
+                )
+                usage = parse_usage(message.get("usage"))
+                if message.get("timed_out"):
+                    logger.warning(
+                        f"Job {job_id} in container {container_name} timed out after {timeout_seconds}s."
+                    )
+                    yield exit_event(-1, TIMEOUT_ERROR, duration, usage=usage)
+                else:
+                    exit_code = message.get("exit_code", -1)
+                    logger.info(
+                        f"Job {job_id} in container {container_name} finished. Exit code: {exit_code}, Duration: {duration}s"
+                    )
+                    if io_dir is None:
+                        yield reported_exit_event(message, exit_code, duration, usage)
+                    else:
+                        yield await finished_exit_event(
+                            io_dir, exit_code, duration, usage
+                        )
+                return
+    except (asyncio.CancelledError, GeneratorExit):
+        # Nobody waits for the run any more. A pooled worker kills the job and stays
+        # for the next one; other containers are removed, which stops it sooner
+        if (
+            mode == "pooled"
+            and channel.job_id
+            and await channel.cancel_job(WORKER_EXIT_GRACE_SECONDS)
+        ):
+            logger.info(f"Job {job_id} in container {container_name} cancelled.")
+        raise
+
+
+async def stream_code_in_pooled_container(
+    pool: ContainerPool, user_code: str, timeout_seconds: float, input_data=None
+) -> AsyncIterator[dict]:
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
+    result = None
+    try:
+        async with pool.lease() as pc:
+            if pc.io_dir:
+                await asyncio.to_thread(prepare_io_dir, pc.io_dir, input_data)
+            events = stream_worker_job(
+                pc.channel,
+                pc.name,
+                pc.io_dir,
+                user_code,
+                timeout_seconds,
+                start_time,
+                mode="pooled",
+                input_data=input_data,
+            )
+            async with aclosing(events):
+                async for event in events:
+                    if event["type"] == "exit":
+                        result = event
+                    else:
+                        yield event
+            if pc.io_dir:
+                await asyncio.to_thread(clear_io_dir, pc.io_dir)
+    except WorkerUnresponsiveError as e:
+        # The lease discards the container, and removing it kills the script
+        logger.warning(f"{e} Recycling.")
+        result = exit_event(-1, TIMEOUT_ERROR, loop.time() - start_time)
+    except Exception as e:
+        logger.error(
+            f"Unexpected error during pooled Docker execution: {str(e)}",
+            exc_info=True,
+        )
+        result = exit_event(None, str(e), loop.time() - start_time)
+    # Yielded after the lease ends so a consumer that stops here keeps the container
+    yield result
+
+
+async def stream_code_in_new_worker(
+    docker_api: SdkDocker | EngineDocker,
+    shares_files: bool,
+    user_code: str,
+    timeout_seconds: float,
+    input_data,
+    limits: ResourceLimits,
+) -> AsyncIterator[dict]:
+    """Runs code in a new container by streaming it to a one-shot worker, which
+    keeps it on a tmpfs /app instead of a host file. Without `shares_files` the
+    input and result files travel over the channel too."""
+    container_name = f"executor_{os.urandom(8).hex()}"
+    container = None
+    channel = None
+    io_dir = None
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
+
+    try:
+        if shares_files:
+            io_dir = create_io_dir()
+            await asyncio.to_thread(prepare_io_dir, io_dir, input_data)
+        with sandbox_phase_seconds.time(mode="cold", phase="create"):
+            container = await docker_api.create(
+                container_name,
+                command=["python", WORKER_SCRIPT_CONTAINER, "--once"],
+                stdin_open=True,  # Job channel
+                init=True,  # Reap processes orphaned by user code
+                **sandbox_container_options(io_dir, limits, tmpfs_app=True),
+            )
+        with sandbox_phase_seconds.time(mode="cold", phase="start"):
+            await docker_api.start(container)
+            channel = await WorkerChannel.open(docker_api, container)
+        events = stream_worker_job(
+            channel,
+            container_name,
+            io_dir,
+            user_code,
+            timeout_seconds,
+            start_time,
+            mode="cold",
+            input_data=input_data,
+        )
+        async with aclosing(events):
+            async for event in events:
+                yield event
+    except WorkerUnresponsiveError as e:
+        logger.warning(str(e))
+        yield exit_event(-1, TIMEOUT_ERROR, loop.time() - start_time)
+    except Exception as e:
+        logger.error(
+            f"Unexpected error during Docker execution for {container_name}: {str(e)}",
+            exc_info=True,
+        )
+        yield exit_event(None, str(e), loop.time() - start_time)
+    finally:
+        if channel:
+            channel.close()
+        if container:
+            try:
+                with sandbox_phase_seconds.time(mode="cold", phase="remove"):
+                    await docker_api.remove(container)
+                logger.info(f"Container {container_name} removed.")
+            except NotFound:
+                logger.info(
+                    f"Container {container_name} already removed or not found for removal."
+                )
+            except APIError as e_rem:
+                logger.error(f"Error removing container {container_name}: {e_rem}")
+        if io_dir:
+            shutil.rmtree(io_dir, ignore_errors=True)
+
+
+def script_archive(user_code: str) -> bytes:
+    """Tar archive holding the code as user_script.py, for put_archive."""
+    data = user_code.encode("utf-8")
+    info = tarfile.TarInfo("user_script.py")
+    info.size = len(data)
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+async def stream_code_in_new_container(
+    host: DockerHost,
+    user_code: str,
+    timeout_seconds: float,
+    input_data=None,
+    limits: ResourceLimits | None = None,
+) -> AsyncIterator[dict]:
+    limits = resolve_limits(limits)
+    # Scripts need the host's IO dir for their result, so other machines always
+    # stream the code to a worker
+    if CODE_INJECTION_MODE == "channel" or not host.shares_files:
+        events = stream_code_in_new_worker(
+            host.docker,
+            host.shares_files,
+            user_code,
+            timeout_seconds,
+            input_data,
+            limits,
+        )
+    else:
+        events = stream_code_in_new_script_container(
+            host.docker, user_code, timeout_seconds, input_data, limits
+        )
+    async with aclosing(events):
+        async for event in events:
+            yield event
+
+
+async def stream_code_in_new_script_container(
+    docker_api: SdkDocker | EngineDocker,
+    user_code: str,
+    timeout_seconds: float,
+    input_data,
+    limits: ResourceLimits,
+) -> AsyncIterator[dict]:
+    """Runs user_script.py through the worker's script mode in a new container,
+    with the script either bind-mounted from a host temp dir or copied in with
+    put_archive. The worker leaves the run's usage in the IO dir."""
+    # Create a temporary directory for the script on the host
+    # This directory will be automatically cleaned up when the 'with' block exits
+    with tempfile.TemporaryDirectory(prefix="code_executor_") as temp_dir_host:
+        script_path_host = os.path.join(temp_dir_host, "user_script.py")
+        script_path_container = "/app/user_script.py"  # Path inside container
+
+        if CODE_INJECTION_MODE == "bind":
+            with open(script_path_host, "w", encoding="utf-8") as f:
+                f.write(user_code)
+
+        container_name = f"executor_{os.urandom(8).hex()}"
+        container = None
+        logs = None
+        io_dir = None
+        loop = asyncio.get_event_loop()
+        start_time = loop.time()
+
+        try:
+            io_dir = create_io_dir()
+            await asyncio.to_thread(prepare_io_dir, io_dir, input_data)
+            logger.info(
+                f"Running script in container {container_name} from image {DOCKER_IMAGE_NAME}"
+            )
+            options = sandbox_container_options(io_dir, limits)
+            if CODE_INJECTION_MODE == "bind":
+                options["volumes"][script_path_host] = {
+                    "bind": script_path_container,
+                    "mode": "ro",  # Read-only mount for security
+                }
+            with sandbox_phase_seconds.time(mode="cold", phase="create"):
+                container = await docker_api.create(
+                    container_name,
+                    command=[
+                        "python",
+                        WORKER_SCRIPT_CONTAINER,
+                        "--script",
+                        script_path_container,
+                        "--usage-file",
+                        f"{IO_DIR_CONTAINER}/{USAGE_FILE_NAME}",
+                    ],
+                    **options,
+                )
+            if CODE_INJECTION_MODE == "archive":
+                # Lands in the container's writable layer; a tmpfs is not mounted
+                # until the container starts
+                with sandbox_phase_seconds.time(mode="cold", phase="inject"):
+                    await docker_api.put_archive(
+                        container, "/app", script_archive(user_code)
+                    )
+            with sandbox_phase_seconds.time(mode="cold", phase="start"):
+                await docker_api.start(container)
+
+            # Follow stdout and stderr until the container exits or times out
+            logs = docker_api.logs(container)
+            decoders = {
+                stream_name: codecs.getincrementaldecoder("utf-8")("replace")
+                for stream_name in ("stdout", "stderr")
+            }
+
+            deadline = start_time + timeout_seconds
+            phase_started_at = loop.time()
+            try:
+                while decoders:
+                    stream_name, chunk = await asyncio.wait_for(
+                        logs.get(), timeout=max(deadline - loop.time(), 0)
+                    )
+                    data = decoders[stream_name].decode(chunk or b"", final=not chunk)
+                    if chunk is None:
+                        del decoders[stream_name]
+                    if data:
+                        yield {"type": stream_name, "data": data}
+                sandbox_phase_seconds.observe(
+                    loop.time() - phase_started_at, mode="cold", phase="logs"
+                )
+
+                with sandbox_phase_seconds.time(mode="cold", phase="wait"):
+                    exit_code = await asyncio.wait_for(
+                        docker_api.wait(container),
+                        timeout=max(deadline - loop.time(), 0),
+                    )
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Container {container_name} execution timed out after {timeout_seconds}s. Killing."
+                )
+                await docker_api.kill(container)
+                yield exit_event(-1, TIMEOUT_ERROR, loop.time() - start_time)
+                return
+
+            duration = loop.time() - start_time
+            logger.info(
+                f"Container {container_name} finished. Exit code: {exit_code}, Duration: {duration}s"
+            )
+            usage = parse_usage(await asyncio.to_thread(read_usage_file, io_dir))
+            # Docker also notices an OOM kill of the worker itself
+            attrs = await docker_api.inspect(container)
+            if attrs.get("State", {}).get("OOMKilled"):
+                usage = {**(usage or ResourceUsage().model_dump()), "oom_killed": True}
+            yield await finished_exit_event(io_dir, exit_code, duration, usage)
+        except Exception as e:
+            logger.error(
+                f"Unexpected error during Docker execution for {container_name}: {str(e)}",
+                exc_info=True,
+            )
+            yield exit_event(None, str(e), loop.time() - start_time)
+        finally:
+            if logs:
+                await logs.aclose()
+            if container:
+                try:
+                    with sandbox_phase_seconds.time(mode="cold", phase="remove"):
+                        await docker_api.remove(container)
+                    logger.info(f"Container {container_name} removed.")
+                except NotFound:
+                    logger.info(
+                        f"Container {container_name} already removed or not found for removal."
+                    )
+                except APIError as e_rem:
+                    logger.error(f"Error removing container {container_name}: {e_rem}")
+            if io_dir:
+                shutil.rmtree(io_dir, ignore_errors=True)
+
+
+# --- Run Cancellation ---
+CANCELLED_ERROR = "Execution cancelled."
+DISCONNECTED_ERROR = "Client disconnected."
+
+
+class DuplicateRunError(Exception):
+    pass
+
+
+class RunRegistry:
+    """Runs in progress by run ID, so that another request can cancel them."""
+
+    def __init__(self):
+        self._runs: dict[str, tuple[str, asyncio.Event]] = {}
+
+    def __contains__(self, run_id: str) -> bool:
+        return run_id in self._runs
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    @contextmanager
+    def register(self, run_id: str, client_id: str):
+        """Registers a run; yields the event that is set when it is cancelled."""
+        if run_id in self._runs:
+            raise DuplicateRunError(f"Run {run_id} is already in progress.")
+        cancelled = asyncio.Event()
+        self._runs[run_id] = (client_id, cancelled)
+        try:
+            yield cancelled
+        finally:
+            del self._runs[run_id]
+
+    def cancel(self, run_id: str, client_id: str) -> bool:
+        """Cancels a run of the client; False if it has no such run in progress."""
+        run = self._runs.get(run_id)
+        if run is None or run[0] != client_id:
+            return False
+        run[1].set()
+        return True
+
+
+run_registry = RunRegistry()
+
+
+def new_run_id() -> str:
+    return os.urandom(8).hex()
+
+
+async def wait_for_disconnect(request: Request):
+    """Returns once the client has gone away. The request body must be read."""
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def run_cancellable(
+    run_id: str,
+    client_id: str,
+    run: Coroutine[Any, Any, ExecutionResult],
+    request: Request | None = None,
+) -> ExecutionResult:
+    """
+    Awaits `run` as run `run_id`. It is cancelled, which kills its container,
+    when the client cancels the run or, given `request`, when the client of that
+    request disconnects. A cancelled run returns a result with just the error.
+    """
+    if run_id in run_registry:
+        run.close()  # Never started
+        raise DuplicateRunError(f"Run {run_id} is already in progress.")
+    with run_registry.register(run_id, client_id) as cancelled:
+        task = asyncio.create_task(run)
+        stoppers = {asyncio.create_task(cancelled.wait())}
+        if request:
+            stoppers.add(asyncio.create_task(wait_for_disconnect(request)))
+        try:
+            await asyncio.wait({task, *stoppers}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for stopper in stoppers:
+                stopper.cancel()
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})  # Until the container is gone or reused
+    if not task.cancelled():
+        result = task.result()
+        result.run_id = run_id
+        return result
+    reason = "cancel" if cancelled.is_set() else "disconnect"
+    sandbox_runs_cancelled_total.inc(reason=reason)
+    logger.info(f"Run {run_id} stopped ({reason}).")
+    return ExecutionResult(
+        run_id=run_id,
+        error=CANCELLED_ERROR if reason == "cancel" else DISCONNECTED_ERROR,
+    )
+
+
+async def cancellable_events(
+    run_id: str, client_id: str, events: AsyncIterator[dict]
+) -> AsyncIterator[dict]:
+    """
+    Yields `events`, which a task of their own produces, until the client cancels
+    run `run_id`. Then the task is cancelled, which kills the container, and a
+    cancelled exit event ends the run. The task cleans up on its own even when the
+    consumer is cancelled in turn.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def produce():
+        try:
+            async with aclosing(events):
+                async for event in events:
+                    await queue.put(event)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(None)
+
+    with run_registry.register(run_id, client_id) as cancelled:
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                getter = asyncio.create_task(queue.get())
+                stopper = asyncio.create_task(cancelled.wait())
+                try:
+                    await asyncio.wait(
+                        {getter, stopper}, return_when=asyncio.FIRST_COMPLETED
+                    )
+                finally:
+                    getter.cancel()
+                    stopper.cancel()
+                if cancelled.is_set():
+                    break
+                item = getter.result()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()
+    sandbox_runs_cancelled_total.inc(reason="cancel")
+    logger.info(f"Run {run_id} stopped (cancel).")
+    yield {**exit_event(None, CANCELLED_ERROR, None), "output_truncated": False}
+
+
+# --- API Endpoint ---
+def get_client_id(request: Request) -> str:
+    return request.headers.get("X-Client-Id") or (
+        request.client.host if request.client else "unknown"
+    )
+
+
+async def execute_code(
+    code: str,
+    client_id: str,
+    priority: str = "normal",
+    cache: bool = False,
+    timeout_seconds: float = EXECUTION_TIMEOUT_SECONDS,
+    max_output_bytes: int = MAX_OUTPUT_BYTES,
+    input_data=None,
+    limits: ResourceLimits | None = None,
+) -> ExecutionResult:
+    """
+    Runs code through the result cache and the scheduler. Raises SchedulerFullError
+    when the run is rejected.
+    """
+    key = (
+        execution_cache_key(code, timeout_seconds, max_output_bytes, input_data, limits)
+        if cache
+        else None
+    )
+    if key:
+        cached = await result_cache.get(key)
+        if cached:
+            return ExecutionResult(**cached, cache_hit=True)
+
+    async with execution_scheduler.slot(client_id, priority) as queue_seconds:
+        result = await run_code_in_docker(
+            code, timeout_seconds, max_output_bytes, input_data, limits
+        )
+    result.queue_seconds = queue_seconds
+    if key and result.error is None and result.exit_code == 0:
+        await result_cache.set(
+            key, result.model_dump(exclude={"run_id", "queue_seconds", "cache_hit"})
+        )
+    return result
+
+
+@app.post("/python-runner", response_model=ExecutionResult)
+async def execute_code_endpoint(payload: CodeInput, request: Request):
+    """
+    Executes Python code in an isolated Docker container.
+    The environment includes `requests`, `matplotlib`, `numpy`.
+    The stdout and stderr are returned.
+    `input` is readable as JSON at $RUNNER_INPUT_PATH, and JSON the code writes to
+    $RUNNER_RESULT_PATH comes back as `result`, separate from the output.
+    `limits` sets the run's memory, CPU and process limits within the server's
+    caps, and `usage` reports the CPU time, peak memory, I/O and processes it used.
+    `timeout_seconds` sets the time limit within EXECUTION_MAX_TIMEOUT_SECONDS.
+    Runs are queued per client (the `X-Client-Id` header, or the client address)
+    and rejected with 429 when the queue is full. With `cache` set, successful
+    results are reused for identical code, input, image and limits.
+    The run stops, and its container is killed, when the client disconnects or
+    cancels it through `/python-runner/runs/{run_id}/cancel`.
+    """
+    if not payload.code.strip():
+        raise HTTPException(status_code=400, detail="No code provided.")
+
+    client_id = get_client_id(request)
+    try:
+        result = await run_cancellable(
+            payload.run_id or new_run_id(),
+            client_id,
+            execute_code(
+                payload.code,
+                client_id,
+                payload.priority,
+                payload.cache,
+                payload.timeout_seconds or EXECUTION_TIMEOUT_SECONDS,
+                input_data=payload.input,
+                limits=payload.limits,
+            ),
+            request,
+        )
+        if result.error and result.error.startswith(
+            "Docker API error:"
+        ):  # Critical Docker issue
+            raise HTTPException(status_code=503, detail=result.error)
+        return result
+    except SchedulerFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after_seconds)},
+        )
+    except DuplicateRunError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(
+            f"Unhandled exception in execute_code_endpoint: {str(e)}", exc_info=True
+        )
+        raise HTTPException(
+            status_code=500, detail=f"An unexpected server error occurred: {str(e)}"
+        )
+
+
+@app.post("/python-runner/stream")
+async def execute_code_stream_endpoint(payload: CodeInput, request: Request):
+    """
+    Executes Python code like `/python-runner`, but streams server-sent events while
+    the code runs: `{"type": "queued", "run_id"}`, then
+    `{"type": "start", "queue_seconds"}`,
+    `{"type": "stdout" | "stderr", "data"}` chunks, and finally
+    `{"type": "exit", "exit_code", "error", "duration_seconds", "queue_seconds",
+    "output_truncated", "result", "usage", "cache_hit"}` followed by `[DONE]`. Cached
+    results are replayed as a single stdout chunk.
+    """
+    if not payload.code.strip():
+        raise HTTPException(status_code=400, detail="No code provided.")
+
+    client_id = get_client_id(request)
+    run_id = payload.run_id or new_run_id()
+    if run_id in run_registry:
+        raise HTTPException(
+            status_code=409, detail=f"Run {run_id} is already in progress."
+        )
+    timeout_seconds = payload.timeout_seconds or EXECUTION_TIMEOUT_SECONDS
+    key = (
+        execution_cache_key(
+            payload.code,
+            timeout_seconds,
+            input_data=payload.input,
+            limits=payload.limits,
+        )
+        if payload.cache
+        else None
+    )
+    cached = await result_cache.get(key) if key else None
+    if not cached:
+        try:
+            execution_scheduler.check_admission(client_id, payload.priority)
+        except SchedulerFullError as e:
+            raise HTTPException(
+                status_code=429,
+                detail=str(e),
+                headers={"Retry-After": str(e.retry_after_seconds)},
+            )
+
+    async def replay_cached():
+        yield f"data: {json.dumps({'type': 'start', 'queue_seconds': 0.0})}\n\n"
+        if cached["output"]:
+            event = {"type": "stdout", "data": cached["output"]}
+            yield f"data: {json.dumps(event)}\n\n"
+        event = {
+            "type": "exit",
+            "exit_code": cached["exit_code"],
+            "error": cached["error"],
+            "duration_seconds": cached["duration_seconds"],
+            "queue_seconds": 0.0,
+            "output_truncated": cached["output_truncated"],
+            "result": cached.get("result"),
+            "usage": cached.get("usage"),
+            "cache_hit": True,
+        }
+        yield f"data: {json.dumps(event)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    async def run_events():
+        async with execution_scheduler.slot(
+            client_id, payload.priority
+        ) as queue_seconds:
+            yield {"type": "start", "queue_seconds": queue_seconds}
+            output_parts = []
+            async for event in stream_code_in_docker(
+                payload.code,
+                timeout_seconds,
+                input_data=payload.input,
+                limits=payload.limits,
+            ):
+                if event["type"] == "exit":
+                    event["queue_seconds"] = queue_seconds
+                    event["cache_hit"] = False
+                    if key and event["error"] is None and event["exit_code"] == 0:
+                        await result_cache.set(
+                            key,
+                            {
+                                "output": "".join(output_parts),
+                                "exit_code": event["exit_code"],
+                                "error": None,
+                                "duration_seconds": event["duration_seconds"],
+                                "output_truncated": event["output_truncated"],
+                                "result": event["result"],
+                                "usage": event["usage"],
+                            },
+                        )
+                elif key:
+                    output_parts.append(event["data"])
+                yield event
+
+    async def generate_stream():
+        try:
+            queued_event = {"type": "queued", "run_id": run_id}
+            yield f"data: {json.dumps(queued_event)}\n\n"
+            async for event in cancellable_events(run_id, client_id, run_events()):
+                yield f"data: {json.dumps(event)}\n\n"
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            logger.error(f"Error in streaming execution: {str(e)}", exc_info=True)
+            error_data = {"error": str(e)}
+            yield f"data: {json.dumps(error_data)}\n\n"
+
+    return StreamingResponse(
+        replay_cached() if cached else generate_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.post("/python-runner/batch", response_model=BatchResult)
+async def execute_batch_endpoint(payload: BatchInput, request: Request):
+    """
+    Executes several snippets in one request. Jobs run in parallel on the container
+    pool, each in its own process, with at most BATCH_MAX_PARALLEL of them in the
+    scheduler at once. Returns `{"results": [...]}` in job order; with `stream` set,
+    each result is sent as `{"type": "result", "id", ...}` as soon as it finishes,
+    followed by `[DONE]`. A job that fails or is rejected by the scheduler gets an
+    `error` in its result instead of failing the whole batch. Jobs can be
+    cancelled one by one by their `run_id`.
+    """
+    job_ids = [job.id or str(index) for index, job in enumerate(payload.jobs)]
+    if len(set(job_ids)) != len(job_ids):
+        raise HTTPException(status_code=400, detail="Job ids must be unique.")
+
+    client_id = get_client_id(request)
+    # Admit the batch as a whole: at most BATCH_MAX_PARALLEL of its jobs wait in the
+    # scheduler at once, and the lowest-priority lane is the first to fill up
+    lowest_priority = max(
+        (job.priority for job in payload.jobs),
+        key=ExecutionScheduler.PRIORITIES.index,
+    )
+    try:
+        execution_scheduler.check_admission(
+            client_id,
+            lowest_priority,
+            min(len(payload.jobs), BATCH_MAX_PARALLEL),
+        )
+    except SchedulerFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after_seconds)},
+        )
+
+    parallel = asyncio.Semaphore(BATCH_MAX_PARALLEL)
+
+    async def run_job(job_id: str, job: BatchJob) -> BatchJobResult:
+        if not job.code.strip():
+            return BatchJobResult(id=job_id, error="No code provided.")
+        async with parallel:
+            try:
+                result = await run_cancellable(
+                    job.run_id or new_run_id(),
+                    client_id,
+                    execute_code(
+                        job.code,
+                        client_id,
+                        job.priority,
+                        job.cache,
+                        job.timeout_seconds or EXECUTION_TIMEOUT_SECONDS,
+                        job.max_output_bytes or MAX_OUTPUT_BYTES,
+                        job.input,
+                        job.limits,
+                    ),
+                )
+            except (SchedulerFullError, DuplicateRunError) as e:
+                result = ExecutionResult(error=str(e))
+            except Exception as e:
+                logger.error(f"Error in batch job {job_id}: {str(e)}", exc_info=True)
+                result = ExecutionResult(error=str(e))
+        return BatchJobResult(id=job_id, **result.model_dump())
+
+    if not payload.stream:
+        results = await asyncio.gather(
+            *(run_job(job_id, job) for job_id, job in zip(job_ids, payload.jobs))
+        )
+        return BatchResult(results=results)
+
+    async def generate_stream():
+        tasks = [
+            asyncio.create_task(run_job(job_id, job))
+            for job_id, job in zip(job_ids, payload.jobs)
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                event = {"type": "result", **(await finished).model_dump()}
+                yield f"data: {json.dumps(event)}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            # Stop unfinished jobs if the client went away
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.post("/python-runner/runs/{run_id}/cancel")
+async def cancel_run_endpoint(run_id: str, request: Request):
+    """
+    Cancels a queued or running run of the client (the same `X-Client-Id` header,
+    or client address), killing its container. The run's request then gets the
+    error "Execution cancelled.".
+    """
+    if not run_registry.cancel(run_id, get_client_id(request)):
+        raise HTTPException(status_code=404, detail=f"No run {run_id} in progress.")
+    return {"run_id": run_id, "cancelled": True}
+
+
+def runtime_stats() -> dict:
+    """Statistics of every component, the single source of /stats and /metrics."""
+    return {
+        "docker_executor": docker_executor.stats(),
+        "docker_hosts": docker_hosts.stats(),
+        "scheduler": execution_scheduler.stats(),
+        "result_cache": result_cache.stats(),
+        "llm_cache": llm_cache.stats(),
+        "openai_pool": openai_pool_stats(),
+        "llm_single_flight": llm_single_flight.stats(),
+    }
+
+
+@app.get("/stats")
+async def stats_endpoint():
+    """
+    Returns runtime statistics of the sandbox runner, e.g. the Docker hosts with
+    their container pool hit/miss counts and lease wait times, and scheduler queue
+    depths.
+    """
+    return runtime_stats()
+
+
+# Point-in-time values read from runtime_stats() when /metrics is scraped
+metrics.callback(
+    "autovp_docker_executor_calls",
+    "Docker executor calls by state, with the thread limit as state=max.",
+    "gauge",
+    lambda: [
+        ({"state": state}, runtime_stats()["docker_executor"][key])
+        for state, key in (
+            ("active", "active"),
+            ("pending", "pending"),
+            ("max", "max_workers"),
+        )
+    ],
+)
+metrics.callback(
+    "autovp_container_pool_containers",
+    "Pooled sandbox containers by Docker host and state.",
+    "gauge",
+    lambda: [
+        ({"host": host["url"], "state": state}, host["container_pool"][state])
+        for host in runtime_stats()["docker_hosts"]
+        if host["container_pool"]
+        for state in ("idle", "leased", "size")
+    ],
+)
+metrics.callback(
+    "autovp_docker_host_runs",
+    "Sandbox runs placed on each Docker host, with its limit as state=max.",
+    "gauge",
+    lambda: [
+        ({"host": host["url"], "state": state}, host[key])
+        for host in runtime_stats()["docker_hosts"]
+        for state, key in (("active", "active_runs"), ("max", "max_runs"))
+    ],
+)
+metrics.callback(
+    "autovp_docker_host_healthy",
+    "Whether each Docker host currently receives runs.",
+    "gauge",
+    lambda: [
+        ({"host": host["url"]}, int(host["healthy"] and host["image_found"]))
+        for host in runtime_stats()["docker_hosts"]
+    ],
+)
+metrics.callback(
+    "autovp_docker_host_ejections_total",
+    "Times each Docker host was ejected after failed health checks.",
+    "counter",
+    lambda: [
+        ({"host": host["url"]}, host["ejections"])
+        for host in runtime_stats()["docker_hosts"]
+    ],
+)
+metrics.callback(
+    "autovp_scheduler_runs",
+    "Sandbox runs executing or waiting for a slot.",
+    "gauge",
+    lambda: [
+        ({"state": state}, runtime_stats()["scheduler"][state])
+        for state in ("running", "queued")
+    ],
+)
+metrics.callback(
+    "autovp_scheduler_rejected_total",
+    "Sandbox runs rejected because the queue was full.",
+    "counter",
+    lambda: runtime_stats()["scheduler"]["rejected"],
+)
+metrics.callback(
+    "autovp_cache_lookups_total",
+    "Cache lookups by cache and result.",
+    "counter",
+    lambda: [
+        ({"cache": name, "result": result}, runtime_stats()[key][result])
+        for name, key in (
+            (result_cache.name, "result_cache"),
+            (llm_cache.name, "llm_cache"),
+        )
+        for result in ("memory_hits", "disk_hits", "misses")
+    ],
+)
+metrics.callback(
+    "autovp_llm_coalesced_requests_total",
+    "Proxy requests served by joining an identical in-flight upstream call.",
+    "counter",
+    lambda: runtime_stats()["llm_single_flight"]["coalesced"],
+)
+metrics.callback(
+    "autovp_llm_coalesced_tokens_saved_total",
+    "Upstream tokens saved by request coalescing.",
+    "counter",
+    lambda: runtime_stats()["llm_single_flight"]["tokens_saved"],
+)
+metrics.callback(
+    "autovp_llm_single_flight_waiters",
+    "Requests currently waiting on an in-flight upstream call.",
+    "gauge",
+    lambda: runtime_stats()["llm_single_flight"]["waiters"],
+)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Exposes runner and proxy metrics in the Prometheus text format."""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# --- OpenAI Proxy Endpoint ---
+def build_chat_request_params(payload: OpenAIChatCompletionsRequest) -> dict:
+    # 构建请求参数
+    request_params = {
+        "model": payload.model or OPENAI_DEFAULT_MODEL,
+        "messages": [msg.model_dump(exclude_none=True) for msg in payload.messages],
+        "max_tokens": MAX_TOKENS,
+    }
+
+    # 如果有 tools，添加到请求中
+    if payload.tools:
+        request_params["tools"] = [tool.model_dump() for tool in payload.tools]
+
+    # 如果有 tool_choice，添加到请求中
+    if payload.tool_choice:
+        request_params["tool_choice"] = payload.tool_choice
+
+    if payload.stream:
+        request_params["stream"] = True
+    return request_params
+
+
+async def call_openai_upstream(request_params: dict) -> AsyncIterator[dict]:
+    """
+    Calls the upstream API and yields the response, or each chunk when streaming,
+    as dicts while recording latency, throughput and token usage metrics.
+    """
+    labels = {
+        "model": request_params["model"],
+        "stream": str(bool(request_params.get("stream"))).lower(),
+    }
+    start_time = time.monotonic()
+    first_item_at = None
+    chunks = 0
+    usage = None
+    status = "error"
+    try:
+        if request_params.get("stream"):
+            stream = await openai_client.chat.completions.create(**request_params)
+            async for chunk in stream:
+                chunk_data = chunk.model_dump()
+                if first_item_at is None:
+                    first_item_at = time.monotonic()
+                chunks += 1
+                usage = chunk_data.get("usage") or usage
+                yield chunk_data
+        else:
+            response = await openai_client.chat.completions.create(**request_params)
+            response_data = response.model_dump()
+            first_item_at = time.monotonic()
+            usage = response_data.get("usage")
+            yield response_data
+        status = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "cancelled"
+        raise
+    except Exception as e:
+        llm_upstream_errors_total.inc(model=labels["model"], error=type(e).__name__)
+        raise
+    finally:
+        end_time = time.monotonic()
+        llm_upstream_requests_total.inc(status=status, **labels)
+        llm_upstream_seconds.observe(end_time - start_time, **labels)
+        if first_item_at is not None:
+            llm_time_to_first_token_seconds.observe(
+                first_item_at - start_time, **labels
+            )
+        if usage:
+            for kind in ("prompt", "completion"):
+                llm_tokens_total.inc(
+                    usage.get(f"{kind}_tokens") or 0, model=labels["model"], kind=kind
+                )
+        if status == "ok":
+            # Without reported usage, one streamed chunk is roughly one token
+            completion_tokens = (usage or {}).get("completion_tokens") or chunks
+            generation_seconds = end_time - (
+                first_item_at if labels["stream"] == "true" else start_time
+            )
+            if completion_tokens and generation_seconds > 0:
+                llm_tokens_per_second.observe(
+                    completion_tokens / generation_seconds, **labels
+                )
+
+
+def cache_control_directives(request: Request) -> set[str]:
+    return {
+        directive.strip().lower()
+        for directive in request.headers.get("Cache-Control", "").split(",")
+    }
+
+
+def get_llm_cache_mode(request: Request) -> str:
+    """
+    Maps the caller's Cache-Control header to a cache mode: "no-store" bypasses the
+    cache entirely, "no-cache" skips the lookup but stores the fresh response.
+    """
+    if not LLM_CACHE_ENABLED:
+        return "bypass"
+    directives = cache_control_directives(request)
+    if "no-store" in directives:
+        return "bypass"
+    if "no-cache" in directives:
+        return "refresh"
+    return "use"
+
+
+@app.post("/openai/chat/completions")
+async def proxy_openai_chat_completions(
+    payload: OpenAIChatCompletionsRequest, request: Request
+):
+    """
+    Proxies requests to OpenAI's Chat Completions API.
+    You need to have the OPENAI_API_KEY environment variable set.
+    Responses are cached by model, messages, tools and tool_choice; send
+    `Cache-Control: no-cache` to refresh or `no-store` to bypass the cache. The
+    `X-Cache` response header reports HIT, MISS or BYPASS.
+    Identical requests that arrive while one is already in flight share its
+    upstream call unless they send `no-store`.
+    """
+    if not openai_client:
+        raise HTTPException(
+            status_code=503,
+            detail="OpenAI API key not configured on the server. Proxy is unavailable.",
+        )
+
+    request_params = build_chat_request_params(payload)
+    cache_mode = get_llm_cache_mode(request)
+    key = cache_key(request_params)
+    cached = await llm_cache.get(key) if cache_mode == "use" else None
+    cache_status = "HIT" if cached else ("BYPASS" if cache_mode == "bypass" else "MISS")
+    llm_proxy_requests_total.inc(
+        stream=str(bool(payload.stream)).lower(), cache=cache_status
+    )
+    no_store = "no-store" in cache_control_directives(request)
+    coalesce = LLM_COALESCE_ENABLED and not no_store
+
+    def upstream() -> AsyncIterator[dict]:
+        return call_openai_upstream(request_params)
+
+    async def store(items: list):
+        if cache_mode != "bypass":
+            await llm_cache.set(key, items if payload.stream else items[0])
+
+    def upstream_items() -> AsyncIterator:
+        if coalesce:
+            return llm_single_flight.stream(key, upstream, store)
+
+        async def direct():
+            items = []
+            async for item in upstream():
+                items.append(item)
+                yield item
+            await store(items)
+
+        return direct()
+
+    try:
+        if payload.stream:
+            # 流式响应
+            async def replay_stream():
+                for chunk_data in cached:
+                    yield f"data: {json.dumps(chunk_data)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            async def generate_stream():
+                try:
+                    async with aclosing(upstream_items()) as chunks:
+                        async for chunk_data in chunks:
+                            yield f"data: {json.dumps(chunk_data)}\n\n"
+                    yield "data: [DONE]\n\n"
+                except Exception as e:
+                    logger.error(
+                        f"Error in streaming response: {str(e)}", exc_info=True
+                    )
+                    error_data = {"error": str(e)}
+                    yield f"data: {json.dumps(error_data)}\n\n"
+
+            return StreamingResponse(
+                replay_stream() if cached else generate_stream(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Cache": cache_status},
+            )
+        else:
+            # 非流式响应
+            if cached:
+                return JSONResponse(cached, headers={"X-Cache": cache_status})
+
+            response_data = None
+            async with aclosing(upstream_items()) as items:
+                async for response_data in items:
+                    pass
+            return JSONResponse(response_data, headers={"X-Cache": cache_status})
 
     except Exception as e:
         logger.error(f"Unexpected error in OpenAI proxy: {str(e)}", exc_info=True)